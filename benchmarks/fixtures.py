@@ -0,0 +1,115 @@
+# -*- coding: utf-8 -*-
+
+#
+# Payload fixtures for the benchmarks
+#
+
+import json
+import struct
+import random
+from pypipboy.types import eValueType
+from pypipboy.dataparser import DataUpdateParser
+
+
+
+# Generates records (format of PipboyDataManager.exportData/importData) of a synthetic tree
+# shaped like the game data: player info, an inventory with item card infos, quests and
+# map locations. Children come before their parents, the root (id 0) is last.
+def syntheticTree(items = 500, quests = 200, locations = 300, seed = 42):
+    rnd = random.Random(seed)
+    records = []
+    nextId = [1]
+
+    def add(valuetype, value):
+        pipId = nextId[0]
+        nextId[0] += 1
+        records.append((pipId, valuetype, value))
+        return pipId
+
+    def addObject(members):
+        return add(eValueType.OBJECT, [list(members.items()), []])
+
+    playerInfo = addObject({
+        'CurrHP': add(eValueType.FLOAT, 250.0),
+        'MaxHP': add(eValueType.FLOAT, 300.0),
+        'CurrAP': add(eValueType.FLOAT, 90.0),
+        'XPLevel': add(eValueType.UINT_32, 20),
+        'PlayerName': add(eValueType.STRING, 'Nate'),
+    })
+    itemIds = []
+    for i in range(items):
+        infos = []
+        for text, value in (('$wt', rnd.uniform(0.1, 20.0)), ('$val', rnd.uniform(1, 500)),
+                            ('$dmg', rnd.uniform(5, 80)), ('$ROF', rnd.uniform(0, 10))):
+            infos.append(addObject({
+                'text': add(eValueType.STRING, text),
+                'Value': add(eValueType.FLOAT, value),
+                'damageType': add(eValueType.UINT_32, 1),
+                'showAsPercent': add(eValueType.BOOL, False),
+            }))
+        itemIds.append(addObject({
+            'text': add(eValueType.STRING, 'Item ' + str(i)),
+            'HandleID': add(eValueType.UINT_32, 1000 + i),
+            'formID': add(eValueType.UINT_32, rnd.randint(0, 1 << 24)),
+            'filterFlag': add(eValueType.UINT_32, 1 << rnd.choice([1, 2, 3, 7, 9, 10, 11, 12])),
+            'count': add(eValueType.UINT_32, rnd.randint(1, 50)),
+            'equipState': add(eValueType.UINT_8, 0),
+            'StackID': add(eValueType.ARRAY, [add(eValueType.UINT_32, i)]),
+            'itemCardInfoList': add(eValueType.ARRAY, infos),
+        }))
+    sortedIds = add(eValueType.ARRAY, [add(eValueType.UINT_32, i) for i in itemIds])
+    inventory = addObject({
+        '43': add(eValueType.ARRAY, itemIds),
+        'sortedIDS': sortedIds,
+        'Version': add(eValueType.UINT_32, 1),
+    })
+    questIds = []
+    for i in range(quests):
+        questIds.append(addObject({
+            'text': add(eValueType.STRING, 'Quest ' + str(i)),
+            'formID': add(eValueType.UINT_32, i),
+            'instance': add(eValueType.UINT_32, 0),
+            'type': add(eValueType.UINT_32, 1),
+            'enabled': add(eValueType.BOOL, rnd.random() > 0.5),
+        }))
+    locationIds = []
+    for i in range(locations):
+        locationIds.append(addObject({
+            'Name': add(eValueType.STRING, 'Location ' + str(i)),
+            'X': add(eValueType.FLOAT, rnd.uniform(-100000, 100000)),
+            'Y': add(eValueType.FLOAT, rnd.uniform(-100000, 100000)),
+            'Discovered': add(eValueType.BOOL, True),
+            'type': add(eValueType.UINT_32, rnd.randint(0, 71)),
+        }))
+    world = addObject({'Locations': add(eValueType.ARRAY, locationIds)})
+    root = [list({
+        'PlayerInfo': playerInfo,
+        'Inventory': inventory,
+        'Quests': add(eValueType.ARRAY, questIds),
+        'Map': addObject({'World': world}),
+    }.items()), []]
+    records.append((0, eValueType.OBJECT, root))
+    return records
+
+
+# Returns the payload of a LOCAL_MAP_UPDATE message with random pixels
+def syntheticLocalMap(width = 512, height = 512, seed = 42):
+    rnd = random.Random(seed)
+    header = struct.pack('<II', width, height)
+    header += struct.pack('<ffffff', 0.0, 0.0, 1000.0, 0.0, 0.0, 1000.0)
+    return header + bytes(rnd.getrandbits(8) for i in range(width * height))
+
+
+# Loads a recorded fixture
+#    *.json: list of records as returned by PipboyDataManager.exportData() (json.dump(pipboy.exportData(), f))
+#    *.bin: raw DATA_UPDATE payload
+def loadFixture(path):
+    if path.endswith('.json'):
+        with open(path) as f:
+            return [tuple(r) for r in json.load(f)]
+    else:
+        with open(path, 'rb') as f:
+            data = f.read()
+        records = []
+        DataUpdateParser().parse(data, lambda r: records.append((r.id, r.type, r.value)))
+        return records
@@ -0,0 +1,246 @@
+# -*- coding: utf-8 -*-
+
+#
+# Benchmarks for the hot paths: parser, encoder, data tree, event fan-out and relay fan-out.
+#
+# usage: python benchmarks/run.py [--fixture FILE] [--only NAME] [--json OUT] [--compare BASELINE]
+#
+# Every benchmark is run several times, the best run is reported as throughput. Peak memory
+# is measured with tracemalloc in an additional run. With --compare, benchmarks that are
+# more than --threshold percent slower than in the baseline json file are reported and the
+# script exits with status 1.
+#
+
+import os
+import sys
+import gc
+import json
+import time
+import socket
+import argparse
+import tracemalloc
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from pypipboy.types import eMessageType, eValueType
+from pypipboy.network import NetworkMessage, MessageFramer
+from pypipboy.dataparser import DataUpdateParser, LocalMapUpdateParser, DataUpdateRecord
+from pypipboy.dataencoder import DataUpdateEncoder
+from pypipboy.datamanager import PipboyDataManager
+from pypipboy.relayserver import RelayController
+from fixtures import syntheticTree, syntheticLocalMap, loadFixture
+
+
+
+# Base class: setup() prepares the input, run() (implemented by every subclass) executes
+# one measured iteration and returns the number of processed units (unit is the name of the unit).
+class Benchmark:
+    name = None
+    unit = 'ops'
+    repeat = 5
+
+    def __init__(self, records):
+        self.records = records
+
+    def setup(self):
+        pass
+
+    def teardown(self):
+        pass
+
+
+class ParseBenchmark(Benchmark):
+    name = 'DataUpdateParser.parse'
+    unit = 'records'
+    def setup(self):
+        self.payload = DataUpdateEncoder().encode(self.records)
+    def run(self):
+        count = [0]
+        def callback(r):
+            count[0] += 1
+        DataUpdateParser().parse(self.payload, callback)
+        return count[0]
+
+
+class LocalMapParseBenchmark(Benchmark):
+    name = 'LocalMapUpdateParser.parse'
+    unit = 'maps'
+    def setup(self):
+        self.payload = syntheticLocalMap()
+    def run(self):
+        parser = LocalMapUpdateParser()
+        for i in range(100):
+            parser.parse(self.payload)
+        return 100
+
+
+class EncodeBenchmark(Benchmark):
+    name = 'DataUpdateEncoder.encode'
+    unit = 'records'
+    def run(self):
+        DataUpdateEncoder().encode(self.records)
+        return len(self.records)
+
+
+class ImportBenchmark(Benchmark):
+    name = 'PipboyDataManager.importData'
+    unit = 'records'
+    def run(self):
+        PipboyDataManager().importData(self.records)
+        return len(self.records)
+
+
+class ExportBenchmark(Benchmark):
+    name = 'PipboyDataManager.exportData'
+    unit = 'records'
+    def setup(self):
+        self.datamanager = PipboyDataManager()
+        self.datamanager.importData(self.records)
+    def run(self):
+        return len(self.datamanager.exportData())
+
+
+class FanoutBenchmark(Benchmark):
+    name = 'PipboyValue event fan-out (100 listeners)'
+    unit = 'calls'
+    listeners = 100
+    updates = 1000
+    def setup(self):
+        self.datamanager = PipboyDataManager()
+        self.datamanager.importData(self.records)
+        self.value = self.datamanager.getPipValueByPath('PlayerInfo/CurrHP')
+        self.calls = [0]
+        def makeListener():
+            def listener(caller, value, pathObjs):
+                self.calls[0] += 1
+            return listener
+        # distinct function objects, the listener dict is keyed by listener
+        for i in range(self.listeners):
+            self.value.pipParent.registerValueUpdatedListener(makeListener(), 1)
+    def run(self):
+        self.calls[0] = 0
+        for i in range(self.updates):
+            self.datamanager._onRecordParsed(DataUpdateRecord(self.value.pipId, eValueType.FLOAT, float(i)))
+        return self.calls[0]
+
+
+class RelayFanoutBenchmark(Benchmark):
+    name = 'RelayController fan-out (20 clients)'
+    unit = 'messages'
+    repeat = 3
+    clients = 20
+    messages = 200
+    backend = RelayController.BACKEND_THREADED
+    def setup(self):
+        self.datamanager = PipboyDataManager()
+        self.datamanager.importData(self.records)
+        self.relay = RelayController(self.datamanager)
+        self.relay.startRelayService('127.0.0.1', 0, self.backend)
+        port = self.relay.relayServer.server_address[1]
+        self.sockets = []
+        for i in range(self.clients):
+            s = socket.create_connection(('127.0.0.1', port))
+            s.settimeout(30)
+            self.sockets.append((s, MessageFramer()))
+        # Wait for connection accept and initial data
+        for s, framer in self.sockets:
+            self._receive(s, framer, 2)
+        payload = DataUpdateEncoder().encode([(self.value().pipId, eValueType.FLOAT, 1.0)])
+        self.msg = NetworkMessage(eMessageType.DATA_UPDATE, len(payload), payload)
+    def value(self):
+        return self.datamanager.getPipValueByPath('PlayerInfo/CurrHP')
+    def _receive(self, s, framer, count):
+        received = 0
+        while received < count:
+            for msg in framer.feed(s.recv(65536)):
+                if msg.msgType != eMessageType.KEEP_ALIVE:
+                    received += 1
+    def run(self):
+        for i in range(self.messages):
+            self.relay._onMessageReceived(self.msg)
+        for s, framer in self.sockets:
+            self._receive(s, framer, self.messages)
+        return self.messages * self.clients
+    def teardown(self):
+        for s, framer in self.sockets:
+            s.close()
+        self.relay.stopRelayService()
+
+
+class SelectorRelayFanoutBenchmark(RelayFanoutBenchmark):
+    name = 'RelayController fan-out (20 clients, selector)'
+    backend = RelayController.BACKEND_SELECTOR
+
+
+BENCHMARKS = [ParseBenchmark, LocalMapParseBenchmark, EncodeBenchmark, ImportBenchmark, 
+              ExportBenchmark, FanoutBenchmark, RelayFanoutBenchmark, SelectorRelayFanoutBenchmark]
+
+
+def runBenchmark(cls, records):
+    bench = cls(records)
+    bench.setup()
+    try:
+        best = None
+        units = 0
+        for i in range(bench.repeat):
+            gc.collect()
+            start = time.perf_counter()
+            units = bench.run()
+            duration = time.perf_counter() - start
+            if best == None or duration < best:
+                best = duration
+        gc.collect()
+        tracemalloc.start()
+        bench.run()
+        peak = tracemalloc.get_traced_memory()[1]
+        tracemalloc.stop()
+    finally:
+        bench.teardown()
+    return {'name': cls.name, 'unit': bench.unit, 'units': units, 'seconds': best,
+            'throughput': units / best if best > 0 else 0.0, 'peakMemory': peak}
+
+
+def main():
+    parser = argparse.ArgumentParser(description = 'PyPipboy benchmarks')
+    parser.add_argument('--fixture', help = 'recorded fixture (.json export or .bin DATA_UPDATE payload)')
+    parser.add_argument('--items', type = int, default = 500, help = 'inventory size of the synthetic tree')
+    parser.add_argument('--only', help = 'run only benchmarks whose name contains this string')
+    parser.add_argument('--json', help = 'write the results to this file')
+    parser.add_argument('--compare', help = 'baseline json file to compare with')
+    parser.add_argument('--threshold', type = float, default = 10.0, help = 'allowed slowdown in percent')
+    args = parser.parse_args()
+
+    if args.fixture:
+        records = loadFixture(args.fixture)
+    else:
+        records = syntheticTree(items = args.items)
+    print('Fixture: %i records' % len(records))
+
+    results = []
+    for cls in BENCHMARKS:
+        if args.only and not args.only in cls.name:
+            continue
+        r = runBenchmark(cls, records)
+        results.append(r)
+        print('%-45s %14.1f %s/s  %10.2f ms  peak %8.1f KiB' % (r['name'], r['throughput'], r['unit'], 
+                r['seconds'] * 1000.0, r['peakMemory'] / 1024.0))
+
+    if args.json:
+        with open(args.json, 'w') as f:
+            json.dump(results, f, indent = 2)
+
+    if args.compare:
+        with open(args.compare) as f:
+            baseline = dict((r['name'], r) for r in json.load(f))
+        regressions = 0
+        for r in results:
+            b = baseline.get(r['name'])
+            if b and r['throughput'] < b['throughput'] * (1.0 - args.threshold / 100.0):
+                regressions += 1
+                print('REGRESSION %s: %.1f -> %.1f %s/s' % (r['name'], b['throughput'], r['throughput'], r['unit']))
+        if regressions > 0:
+            sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
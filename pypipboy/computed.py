@@ -0,0 +1,345 @@
+# -*- coding: utf-8 -*-
+
+import threading
+import logging
+from pypipboy.datamanager import ePipboyValueType
+
+
+
+# Read-only view of a PipboyValue handed to computations
+# Every access is recorded as a dependency of the running computation: reading the value
+# of a primitive, or the children of an object or array. Children are returned as tracked
+# values as well.
+class PipboyTrackedValue:
+    def __init__(self, pipValue, computed):
+        self._pipValue = pipValue
+        self._computed = computed
+        self.pipId = pipValue.pipId
+        self.pipType = pipValue.pipType
+        self.valueType = pipValue.valueType
+
+    # Returns the value (dict key -> PipboyTrackedValue for objects, list for arrays)
+    def value(self):
+        self._computed._addDependency(self.pipId)
+        value = self._pipValue.value()
+        if self.pipType == ePipboyValueType.OBJECT:
+            retval = dict()
+            for k in value:
+                retval[k] = PipboyTrackedValue(value[k], self._computed)
+            return retval
+        elif self.pipType == ePipboyValueType.ARRAY:
+            return [PipboyTrackedValue(v, self._computed) for v in value]
+        return value
+
+    # Returns the number of children
+    def childCount(self):
+        self._computed._addDependency(self.pipId)
+        return self._pipValue.childCount()
+
+    # Returns the child with given key/index or None
+    def child(self, key):
+        self._computed._addDependency(self.pipId)
+        child = self._pipValue.child(key)
+        if child:
+            return PipboyTrackedValue(child, self._computed)
+        return None
+
+    # Returns the key for the item with the given index
+    def key(self, index):
+        self._computed._addDependency(self.pipId)
+        return self._pipValue.key(index)
+
+    # Returns the value at the given path relative to this value (e.g. 'PlayerInfo/CurrHP') or None
+    def path(self, path):
+        value = self
+        for key in path.strip('/').split('/'):
+            if key == '':
+                continue
+            if value.pipType == ePipboyValueType.ARRAY:
+                try:
+                    key = int(key)
+                except ValueError:
+                    return None
+            value = value.child(key)
+            if not value:
+                return None
+        return value
+
+    # Returns the underlying PipboyValue (accesses to it are not tracked)
+    def pipValue(self):
+        return self._pipValue
+
+    def __repr__(self):
+        return 'PipTrackedValue(Id=' + str(self.pipId) + ')'
+
+
+
+# Argument of computation functions
+class PipboyComputationContext:
+    def __init__(self, computed):
+        self._computed = computed
+
+    # Returns the tracked root object or None
+    def root(self):
+        rootObject = self._computed.engine.datamanager.rootObject
+        self._computed._addRootDependency()
+        if rootObject:
+            return PipboyTrackedValue(rootObject, self._computed)
+        return None
+
+    # Returns the tracked value at the given path (e.g. 'PlayerInfo/CurrHP') or None
+    def path(self, path):
+        root = self.root()
+        if root:
+            return root.path(path)
+        return None
+
+    # Returns a tracked view of the given PipboyValue (e.g. an inventory item)
+    def wrap(self, pipValue):
+        if pipValue:
+            return PipboyTrackedValue(pipValue, self._computed)
+        return None
+
+
+
+# A value derived from the data tree (see PipboyComputedValues.computed())
+class PipboyComputedValue:
+    def __init__(self, engine, func, name):
+        self.engine = engine
+        self.name = name
+        self._func = func
+        self._value = None
+        self._error = None
+        self._dirty = True
+        self._closed = False
+        # pipIds read by the last computation
+        self._pipIds = set()
+        # Computed values read by the last computation and computed values reading this one
+        self._sources = set()
+        self._dependents = set()
+        self._listeners = set()
+        self._notifiedValue = None
+
+    # Returns the current result, recomputing it when a dependency has changed
+    # Exceptions raised by the computation are raised again here.
+    def value(self):
+        engine = self.engine
+        engine._lock.acquire()
+        try:
+            running = engine._running()
+            if running != None:
+                running._addSource(self)
+            if self._dirty:
+                self._recompute()
+            if self._error != None:
+                raise self._error
+            return self._value
+        finally:
+            engine._lock.release()
+
+    # Returns whether the value needs to be recomputed
+    def isDirty(self):
+        return self._dirty
+
+    # registers a listener that gets called after a data update changed the result
+    # The value is kept up to date as long as listeners are registered.
+    #
+    # signature: listener(computed, value)
+    def registerChangedListener(self, listener):
+        self.engine._lock.acquire()
+        try:
+            if len(self._listeners) == 0:
+                self._listeners.add(listener)
+                try:
+                    self._notifiedValue = self.value()
+                except Exception:
+                    self._notifiedValue = None
+            else:
+                self._listeners.add(listener)
+        finally:
+            self.engine._lock.release()
+
+    # unregisters a changed listener
+    def unregisterChangedListener(self, listener):
+        self.engine._lock.acquire()
+        try:
+            self._listeners.remove(listener)
+        except:
+            pass
+        self.engine._lock.release()
+
+    # Releases all dependencies, the value must not be used anymore
+    def close(self):
+        self.engine._lock.acquire()
+        try:
+            self._clearDependencies()
+            self._closed = True
+            self._listeners.clear()
+            self.engine._computedValues.discard(self)
+        finally:
+            self.engine._lock.release()
+
+    def __repr__(self):
+        return 'PipComputedValue(' + str(self.name) + ')'
+
+    def _recompute(self):
+        engine = self.engine
+        if self in engine._stack():
+            raise Exception('Cyclic dependency of computed value ' + str(self.name))
+        self._clearDependencies()
+        self._dirty = False
+        engine._stack().append(self)
+        try:
+            self._value = self._func(PipboyComputationContext(self))
+            self._error = None
+        except Exception as e:
+            self._value = None
+            self._error = e
+        finally:
+            engine._stack().pop()
+
+    def _addDependency(self, pipId):
+        if not pipId in self._pipIds:
+            self._pipIds.add(pipId)
+            self.engine._dependents.setdefault(pipId, set()).add(self)
+
+    def _addRootDependency(self):
+        self.engine._rootDependents.add(self)
+
+    def _addSource(self, source):
+        self._sources.add(source)
+        source._dependents.add(self)
+
+    def _clearDependencies(self):
+        engine = self.engine
+        for pipId in self._pipIds:
+            dependents = engine._dependents.get(pipId)
+            if dependents != None:
+                dependents.discard(self)
+                if len(dependents) == 0:
+                    del engine._dependents[pipId]
+        self._pipIds = set()
+        engine._rootDependents.discard(self)
+        for source in self._sources:
+            source._dependents.discard(self)
+        self._sources = set()
+
+    # Marks this value and the computed values reading it as dirty
+    def _invalidate(self, changed):
+        if self._dirty or self._closed:
+            return
+        self._dirty = True
+        if len(self._listeners) > 0:
+            changed.add(self)
+        for dependent in list(self._dependents):
+            dependent._invalidate(changed)
+
+
+
+# Derived values over the data tree of a data manager
+# A computed value is defined by a function reading the tree through the given
+# PipboyComputationContext. The values read are recorded, and the result is marked dirty
+# when one of exactly these values changes (no ancestor propagation). Results are recomputed
+# lazily on the next value() call. Values with changed listeners are recomputed once after
+# each data update, and listeners are only called when the result differs from the last one.
+# Computed values may read other computed values, they are tracked the same way.
+#
+# Example:
+#    engine = PipboyComputedValues(datamanager)
+#    hpPercent = engine.computed(lambda ctx: 100.0 * ctx.path('PlayerInfo/CurrHP').value() / ctx.path('PlayerInfo/MaxHP').value())
+#    hpPercent.registerChangedListener(lambda computed, value: print(value))
+#    dps = engine.computed(lambda ctx: weaponDps(ctx.wrap(weapon)), 'dps')
+class PipboyComputedValues:
+    def __init__(self, datamanager):
+        self.datamanager = datamanager
+        self._lock = threading.RLock()
+        self._local = threading.local()
+        # pipId -> set of computed values that read it
+        self._dependents = dict()
+        # Computed values that read the root object
+        self._rootDependents = set()
+        self._computedValues = set()
+        # Computed values with listeners that got dirty during the current data update
+        self._changed = set()
+        self._logger = logging.getLogger('pypipboy.computed')
+        self.datamanager.registerValueUpdatedListener(self._onValueUpdated)
+        self.datamanager.registerUpdateAppliedListener(self._onUpdateApplied)
+        self.datamanager.registerRootObjectListener(self._onRootObject)
+
+    # Defines a new computed value
+    #
+    # signature: func(context) -> result, context is a PipboyComputationContext
+    def computed(self, func, name = None):
+        c = PipboyComputedValue(self, func, name)
+        self._lock.acquire()
+        self._computedValues.add(c)
+        self._lock.release()
+        return c
+
+    # Stops tracking the data manager, all computed values are closed
+    def close(self):
+        self.datamanager.unregisterValueUpdatedListener(self._onValueUpdated)
+        self.datamanager.unregisterUpdateAppliedListener(self._onUpdateApplied)
+        self.datamanager.unregisterRootObjectListener(self._onRootObject)
+        self._lock.acquire()
+        for c in list(self._computedValues):
+            c.close()
+        self._lock.release()
+
+
+    ######## Internals Begin ##############
+
+    # Returns the stack of computations running on the current thread
+    def _stack(self):
+        stack = getattr(self._local, 'stack', None)
+        if stack == None:
+            stack = []
+            self._local.stack = stack
+        return stack
+
+    def _running(self):
+        stack = self._stack()
+        if len(stack) > 0:
+            return stack[-1]
+        return None
+
+    def _onValueUpdated(self, value, eventtype):
+        self._lock.acquire()
+        try:
+            dependents = self._dependents.get(value.pipId)
+            if dependents:
+                for c in list(dependents):
+                    c._invalidate(self._changed)
+        finally:
+            self._lock.release()
+
+    def _onRootObject(self, rootObject):
+        self._lock.acquire()
+        try:
+            for c in list(self._rootDependents):
+                c._invalidate(self._changed)
+        finally:
+            self._lock.release()
+
+    def _onUpdateApplied(self):
+        notifications = []
+        self._lock.acquire()
+        try:
+            changed = self._changed
+            self._changed = set()
+            for c in changed:
+                if c._closed or len(c._listeners) == 0:
+                    continue
+                try:
+                    value = c.value()
+                except Exception as e:
+                    self._logger.warning('Computed value ' + str(c.name) + ' failed: ' + str(e))
+                    continue
+                if value != c._notifiedValue:
+                    c._notifiedValue = value
+                    notifications.append((c, value, list(c._listeners)))
+        finally:
+            self._lock.release()
+        for c, value, listeners in notifications:
+            for listener in listeners:
+                listener(c, value)
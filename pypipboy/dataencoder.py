@@ -100,5 +100,8 @@ class DataUpdateEncoder(DataEncoder):
             retval += self._encodeUInt32(param[1])
             retval += self._encodeString(param[0])
         # Two bytes are number of remoced value ids
-        retval += self._encodeUInt16(0)
+        removed = value[1] if len(value) > 1 else []
+        retval += self._encodeUInt16(len(removed))
+        for id in removed:
+            retval += self._encodeUInt32(id)
         return retval
@@ -1,11 +1,19 @@
 # -*- coding: utf-8 -*-
 
+import os
+import re
+import sys
+import heapq
+import collections
 import logging
 import json
 import threading
+import asyncio
+import concurrent.futures
 from pypipboy.types import eMessageType, eValueType, eRequestType
 from pypipboy.dataparser import DataUpdateParser, LocalMapUpdateParser, DataUpdateRecord
 from pypipboy.network import NetworkChannel, NetworkMessage
+from pypipboy.rpc import RpcManager, RpcBatch
 from builtins import int
 
 
@@ -47,6 +55,8 @@ class PipboyValue(object):
         self._userCache = dict()
         self._valueUpdatedListeners = dict()
         self._listenerLock = threading.Lock()
+        # True when the children still need to be created (lazy data manager only)
+        self._lazyPending = False
     
     # registers a value updated event listener
     #    depth: to with depth should events from children be reported
@@ -116,9 +126,13 @@ class PipboyValue(object):
             e = self._userCache[k]
             if e.invalidateDepth <= depth:
                 e.dirtyFlag = True
+        profiler = self.datamanager.profiler
         for listener in self._valueUpdatedListeners:
             if self._valueUpdatedListeners[listener] < 0 or self._valueUpdatedListeners[listener] >= depth:
-                listener(self, value, pathObjs)
+                if profiler:
+                    profiler.call(profiler.VALUE_UPDATED, listener, (self, value, pathObjs), value)
+                else:
+                    listener(self, value, pathObjs)
         if self.pipParent:
             newPathObjs = list(pathObjs)
             newPathObjs.append(self)
@@ -153,12 +167,18 @@ class PipboyObjectValue(PipboyValue):
             i += 1
             
     def value(self):
+        if self._lazyPending:
+            self.datamanager._expandValue(self)
         return self._value.copy()
         
     def childCount(self):
+        if self._lazyPending:
+            self.datamanager._expandValue(self)
         return len(self._value)
     
     def child(self, index):
+        if self._lazyPending:
+            self.datamanager._expandValue(self)
         if type(index) == str:
             index = index.lower()
             if index in self._value:
@@ -174,6 +194,8 @@ class PipboyObjectValue(PipboyValue):
             return None
     
     def key(self, index):
+        if self._lazyPending:
+            self.datamanager._expandValue(self)
         if index >= 0 and index < len(self._value):
             return self._orderedList[index].pipParentKey
         else:
@@ -188,18 +210,26 @@ class PipboyArrayValue(PipboyValue):
         super(PipboyArrayValue, self).__init__(datamanager, pipId, ePipboyValueType.ARRAY, eValueType.ARRAY, list())
             
     def value(self):
+        if self._lazyPending:
+            self.datamanager._expandValue(self)
         return self._value.copy()
     
     def childCount(self):
+        if self._lazyPending:
+            self.datamanager._expandValue(self)
         return len(self._value)
     
     def child(self, index):
+        if self._lazyPending:
+            self.datamanager._expandValue(self)
         if index >= 0 and index < len(self._value):
             return self._value[index]
         else:
             return None
     
     def key(self, index):
+        if self._lazyPending:
+            self.datamanager._expandValue(self)
         if index >= 0 and index < len(self._value):
             return index
         else:
@@ -207,20 +237,189 @@ class PipboyArrayValue(PipboyValue):
 
 
 
+# Immutable copy of a value as seen by a snapshot
+# Unchanged subtrees are shared between snapshot versions (structural sharing),
+# therefore instances must never be modified after creation.
+class PipboySnapshotValue(object):
+    __slots__ = ('pipId', 'pipType', 'valueType', '_value', '_orderedList', '_keys')
+
+    def __init__(self, pipId, pipType, valueType, value, orderedList = (), keys = ()):
+        self.pipId = pipId
+        self.pipType = pipType
+        self.valueType = valueType
+        self._value = value
+        self._orderedList = orderedList
+        self._keys = keys
+
+    # Returns the value (a copy for objects and arrays)
+    def value(self):
+        if self.pipType == ePipboyValueType.OBJECT:
+            return dict(self._value)
+        elif self.pipType == ePipboyValueType.ARRAY:
+            return list(self._value)
+        else:
+            return self._value
+
+    # Returns the number of children
+    def childCount(self):
+        if self.pipType == ePipboyValueType.PRIMITIVE:
+            return 0
+        return len(self._value)
+
+    # Returns the child with given key/index
+    def child(self, index):
+        if self.pipType == ePipboyValueType.OBJECT:
+            if type(index) == str:
+                return self._value.get(index.lower())
+            elif type(index) == int and index >= 0 and index < len(self._orderedList):
+                return self._orderedList[index]
+        elif self.pipType == ePipboyValueType.ARRAY:
+            if type(index) == int and index >= 0 and index < len(self._value):
+                return self._value[index]
+        return None
+
+    # Returns the key for the item with the given index
+    def key(self, index):
+        if self.pipType == ePipboyValueType.OBJECT:
+            if index >= 0 and index < len(self._keys):
+                return self._keys[index]
+        elif self.pipType == ePipboyValueType.ARRAY:
+            if index >= 0 and index < len(self._value):
+                return index
+        return None
+
+    def __repr__(self):
+        return 'PipSnapshotValue(Id=' + str(self.pipId) + ')'
+
+
+
+# Returns the value at the given path relative to value (PipboyValue or PipboySnapshotValue) or None
+# When a list is given as trail, a tuple (parent, key, child) is appended for every step of the
+# path, child is None when the path ends there.
+def resolvePipPath(value, path, trail = None):
+    for key in path.strip('/').split('/'):
+        if not value:
+            return None
+        if key == '':
+            continue
+        if value.pipType == ePipboyValueType.ARRAY:
+            try:
+                key = int(key)
+            except ValueError:
+                return None
+        parent = value
+        value = value.child(key)
+        if trail != None:
+            trail.append((parent, key, value))
+    return value
+
+
+
+# A consistent, read-only version of the data tree
+# Snapshots can be kept and read from any thread without locking, they are
+# never modified by the data manager. They can also be pickled and sent to other processes.
+class PipboySnapshot(object):
+    def __init__(self, version, rootObject):
+        self.version = version
+        self.rootObject = rootObject
+
+    # Returns the value at the given path (e.g. 'PlayerInfo/CurrHP' or 'Inventory/43/0') or None
+    def getPipValueByPath(self, path):
+        return resolvePipPath(self.rootObject, path)
+
+    # Returns the records of the snapshot in the format of PipboyDataManager.exportData()
+    def exportData(self):
+        pipValues = []
+        if self.rootObject:
+            queue = collections.deque([self.rootObject])
+            while len(queue) > 0:
+                obj = queue.popleft()
+                if obj.pipType == ePipboyValueType.OBJECT:
+                    value = [[], []]
+                    for k, child in zip(obj._keys, obj._orderedList):
+                        value[0].append((k, child.pipId))
+                        queue.append(child)
+                    pipValues.append([obj.pipId, obj.valueType, value])
+                elif obj.pipType == ePipboyValueType.ARRAY:
+                    queue.extend(obj._value)
+                    pipValues.append((obj.pipId, obj.valueType, [child.pipId for child in obj._value]))
+                else:
+                    pipValues.append((obj.pipId, obj.valueType, obj._value))
+        return pipValues
+
+
+
+# Memory and shape statistics of a data tree (see PipboyDataManager.getTreeStats())
+# Byte counts are estimates based on sys.getsizeof() of the value objects and record entries.
+class PipboyTreeStats:
+    def __init__(self):
+        # eValueType -> number of nodes
+        self.nodeCounts = dict()
+        self.nodeCount = 0
+        # Nodes with a PipboyValue object (equals nodeCount for non-lazy data managers)
+        self.materializedCount = 0
+        self.reachableCount = 0
+        # Nodes that are no longer part of the tree but are still retained
+        self.unreachableIds = []
+        self.unreachableBytes = 0
+        self.estimatedBytes = 0
+        # path -> estimated bytes of the subtree, for all paths up to the requested depth
+        self.subtreeBytes = dict()
+        # Value updated listeners registered with values
+        self.valueListenerCount = 0
+        # Listeners registered with the data manager
+        self.dataManagerListenerCount = 0
+        self.userCacheCount = 0
+        # Lists of (path, child count) of the objects and arrays with the most children
+        self.largestObjects = []
+        self.largestArrays = []
+
+    def __repr__(self):
+        return ('PipboyTreeStats(nodes=' + str(self.nodeCount) + ', materialized=' + str(self.materializedCount)
+                + ', unreachable=' + str(len(self.unreachableIds)) + ', bytes=' + str(self.estimatedBytes)
+                + ', valueListeners=' + str(self.valueListenerCount) + ', userCaches=' + str(self.userCacheCount) + ')')
+
+
+
 class PipboyDataManager:
     
-    def __init__(self):
-        self.networkchannel = NetworkChannel()
+    # lazy: When True, received records are only stored in a compact table and PipboyValue
+    #       objects are created when they are accessed (see doc/PipboyDataManager.md)
+    # networkchannel: channel to use instead of a new NetworkChannel
+    # dataParser: parser to use for DATA_UPDATE messages instead of a new DataUpdateParser
+    def __init__(self, lazy = False, networkchannel = None, dataParser = None):
+        if networkchannel:
+            self.networkchannel = networkchannel
+        else:
+            self.networkchannel = NetworkChannel()
+        self.dataParser = dataParser
+        self.profiler = None
         self._connectionEstablished = False
         self._valueMap = None
         self.rootObject = None
         self._rootObjectListeners = set()
         self._valueUpdatedListeners = set()
         self._localMapListeners = set()
+        self._updateAppliedListeners = set()
+        self._dataUpdateMessageListeners = set()
         self.networkchannel.registerConnectionListener(self._onConnectionStateChange)
         self.networkchannel.registerMessageListener(self._onMessageReceived)
-        self._nextRpcReqId = 0
-        self._rpcCallbackMap = dict()
+        self.rpc = RpcManager(self.networkchannel)
+        self._snapshotsEnabled = False
+        self._snapshot = None
+        self._snapshotVersion = 0
+        self._snapshotNodes = dict()
+        self._snapshotDirty = set()
+        self._lazy = lazy
+        self._recordMap = dict()
+        self._parentMap = dict()
+        self._lazyLock = threading.RLock()
+        self._warmStartDir = None
+        self._warmStartKey = None
+        self._loadingWarmStart = False
+        self._stale = False
+        # Values of the stale tree while the live tree is being received
+        self._staleValueMap = None
         self._logger = logging.getLogger('pypipboy.datamanager')
         
     
@@ -233,6 +432,10 @@ class PipboyDataManager:
     # Connects to the given address
     # Returns True if connection was successfully established, otherwise False
     def connect(self, addr, port = NetworkChannel.PIPBOYAPP_PORT):
+        if self._warmStartDir:
+            self._warmStartKey = str(addr) + '_' + str(port)
+            if not self.rootObject:
+                self._loadWarmStart()
         return self.networkchannel.connect(addr, port)
         
     # Cancels an ongoing connection attempt
@@ -272,6 +475,36 @@ class PipboyDataManager:
         except:
             pass
     
+    # registers a listener that gets called after all records of a data update
+    # have been applied to the tree
+    #
+    # signature: listener()
+    def registerUpdateAppliedListener(self, listener):
+        self._updateAppliedListeners.add(listener)
+        
+    # unregisters an update applied listener
+    def unregisterUpdateAppliedListener(self, listener):
+        try:
+            self._updateAppliedListeners.remove(listener)
+        except:
+            pass
+    
+    # registers a listener that gets called with every DATA_UPDATE message received from the game,
+    # after it has been applied to the tree (and the snapshot has been published when enabled)
+    # Unlike message listeners of the network channel, these listeners never see an update 
+    # before the data manager.
+    #
+    # signature: listener(msg)
+    def registerDataUpdateMessageListener(self, listener):
+        self._dataUpdateMessageListeners.add(listener)
+        
+    # unregisters a data update message listener
+    def unregisterDataUpdateMessageListener(self, listener):
+        try:
+            self._dataUpdateMessageListeners.remove(listener)
+        except:
+            pass
+    
     # registers a local map listener
     #
     # signature: listener(lmap)
@@ -285,48 +518,187 @@ class PipboyDataManager:
         except:
             pass
     
+    # Installs a profiler (e.g. pypipboy.profiling.ListenerProfiler) that times all event 
+    # listener calls of this data manager, its values and its network channel (None to remove it)
+    def setProfiler(self, profiler):
+        self.profiler = profiler
+        self.networkchannel.profiler = profiler
+    
     # Returns the value with the given pipId
     def getPipValueById(self, pipId):
+        staleValueMap = self._staleValueMap
+        if staleValueMap != None:
+            # Ids refer to the visible tree till the live root object replaces it
+            return staleValueMap.get(pipId)
+        if self._lazy:
+            return self._materializeValue(pipId)
         try:
             return self._valueMap[pipId]
         except:
             return None
     
+    # Returns the value at the given path (e.g. 'PlayerInfo/CurrHP' or 'Inventory/43/0') or None
+    def getPipValueByPath(self, path):
+        return resolvePipPath(self.rootObject, path)
+    
+    # Enables persisting the data tree per host in the given directory
+    # On connect the last known tree of the host is loaded immediately (marked as stale, see isStale()),
+    # it is replaced by the live tree as soon as the initial data has been received.
+    # The tree is saved when the connection is closed or saveWarmStart() is called. It is taken
+    # from snapshots, so this also enables snapshots (see enableSnapshots()).
+    def enableWarmStart(self, cacheDir):
+        os.makedirs(cacheDir, exist_ok = True)
+        self._warmStartDir = cacheDir
+        self.enableSnapshots()
+    
+    # Saves the most recent snapshot of the data tree for the next warm start
+    # Returns True when the tree has been saved
+    def saveWarmStart(self):
+        path = self._warmStartPath()
+        snapshot = self._snapshot
+        if not path or self._stale or not snapshot:
+            return False
+        data = snapshot.exportData()
+        # importData() needs children before their parents
+        data.reverse()
+        tmppath = path + '.tmp'
+        with open(tmppath, 'w') as f:
+            json.dump(data, f)
+        os.replace(tmppath, path)
+        return True
+    
+    # Returns True while the data tree has been loaded from the warm start cache 
+    # and the live data has not yet been received
+    def isStale(self):
+        return self._stale
+    
+    # Enables the creation of snapshots (see snapshot())
+    # Unchanged subtrees are shared between versions, so after each data update
+    # only the changed values and their ancestors are copied.
+    def enableSnapshots(self):
+        if not self._snapshotsEnabled:
+            self._snapshotsEnabled = True
+            self._snapshotNodes = dict()
+            self._snapshotDirty = set()
+            self._publishSnapshot()
+    
+    # Disables the creation of snapshots and releases the snapshot data
+    def disableSnapshots(self):
+        self._snapshotsEnabled = False
+        self._snapshot = None
+        self._snapshotNodes = dict()
+        self._snapshotDirty = set()
+    
+    # Returns the most recent snapshot of the data tree (type PipboySnapshot), 
+    # or None when snapshots are disabled or no data has been received yet.
+    # The returned snapshot never changes and can be read from any thread.
+    def snapshot(self):
+        return self._snapshot
+    
+    # Returns a PipboyTreeStats describing node counts, memory use, listeners and the 
+    # largest objects/arrays of the tree. Costs are linear in the number of nodes, lazy
+    # data managers are inspected without creating values.
+    #    depth: subtreeBytes lists all paths up to this depth (1: the children of the root)
+    #    topN: number of entries in largestObjects and largestArrays
+    def getTreeStats(self, depth = 1, topN = 10):
+        stats = PipboyTreeStats()
+        self._lazyLock.acquire()
+        try:
+            valueMap = dict(self._valueMap) if self._valueMap != None else dict()
+            if self._lazy:
+                types = dict((pipId, entry[0]) for pipId, entry in list(self._recordMap.items()))
+            else:
+                types = dict((pipId, v.valueType) for pipId, v in valueMap.items())
+            stats.nodeCount = len(types)
+            stats.materializedCount = len(valueMap)
+            for t in types.values():
+                stats.nodeCounts[t] = stats.nodeCounts.get(t, 0) + 1
+            for v in valueMap.values():
+                stats.valueListenerCount += len(v._valueUpdatedListeners)
+                stats.userCacheCount += len(v._userCache)
+            stats.dataManagerListenerCount = (len(self._rootObjectListeners) + len(self._valueUpdatedListeners)
+                                              + len(self._localMapListeners) + len(self._updateAppliedListeners)
+                                              + len(self._dataUpdateMessageListeners))
+            # Depth first traversal from the root, subtree sizes are summed up in post-order
+            nodeBytes = dict()
+            largestObjects = []
+            largestArrays = []
+            visited = set()
+            if 0 in types:
+                stack = [(0, '', 0, False)]
+                subtreeTotals = [0]
+                while len(stack) > 0:
+                    pipId, path, level, done = stack.pop()
+                    if done:
+                        total = subtreeTotals.pop()
+                        subtreeTotals[-1] += total
+                        if level <= depth:
+                            stats.subtreeBytes[path] = total
+                        continue
+                    if pipId in visited:
+                        continue
+                    visited.add(pipId)
+                    size = self._estimateNodeBytes(pipId, valueMap.get(pipId))
+                    nodeBytes[pipId] = size
+                    children = self._treeNodeChildren(pipId, valueMap.get(pipId))
+                    if types[pipId] == eValueType.OBJECT:
+                        self._pushLargest(largestObjects, topN, len(children), path)
+                    elif types[pipId] == eValueType.ARRAY:
+                        self._pushLargest(largestArrays, topN, len(children), path)
+                    subtreeTotals.append(size)
+                    stack.append((pipId, path, level, True))
+                    for key, childId in children:
+                        if childId in types and not childId in visited:
+                            stack.append((childId, path + '/' + str(key) if path else str(key), level + 1, False))
+                stats.estimatedBytes = subtreeTotals[0]
+            stats.reachableCount = len(visited)
+            for pipId in types:
+                if not pipId in visited:
+                    stats.unreachableIds.append(pipId)
+                    stats.unreachableBytes += self._estimateNodeBytes(pipId, valueMap.get(pipId))
+            stats.estimatedBytes += stats.unreachableBytes
+            stats.largestObjects = [(p, c) for c, i, p in sorted(largestObjects, reverse = True)]
+            stats.largestArrays = [(p, c) for c, i, p in sorted(largestArrays, reverse = True)]
+        finally:
+            self._lazyLock.release()
+        return stats
+    
 
-    def rpcSendRequest(self, reqtype, args = list(), callback = None):
+    # Sends a request to the game
+    # Returns a concurrent.futures.Future receiving the result dict. Requests without 
+    # result fail with a TimeoutError after timeout seconds (see RpcManager).
+    def rpcSendRequest(self, reqtype, args = list(), callback = None, timeout = None):
+        if  self._connectionEstablished:
+            return self.rpc.sendRequest(reqtype, args, callback, timeout)
+        else:
+            return self._notConnectedFuture()
+    
+    # Like rpcSendRequest, but returns an asyncio awaitable bound to the running event loop
+    def rpcSendRequestAsync(self, reqtype, args = list(), timeout = None):
         if  self._connectionEstablished:
-            req = dict()
-            req['id'] = self._nextRpcReqId
-            self._nextRpcReqId += 1
-            req['type'] = reqtype
-            req['args'] = list()
-            if args:
-                for arg in args:
-                    req['args'].append(arg)
-            msg = json.dumps(req).encode('utf-8')
-            if callback:
-                self._rpcCallbackMap[req['id']] = callback
-            self.networkchannel.sendMessage(NetworkMessage(eMessageType.COMMAND, len(msg), msg))
+            return self.rpc.sendRequestAsync(reqtype, args, timeout)
+        else:
+            return asyncio.wrap_future(self.rpcSendRequest(reqtype, args))
     
     
     def rpcSetCustomMarker(self, x, y):
         thirdarg = True # Dunno what this is, the original source says: this.currentTab == 1 ? 1 : 0
-        self.rpcSendRequest(eRequestType.SetCustomMapMarker, [float(x), float(y), thirdarg])
+        return self.rpcSendRequest(eRequestType.SetCustomMapMarker, [float(x), float(y), thirdarg])
     
     def rpcRemoveCustomMarker(self):
-        self.rpcSendRequest(eRequestType.RemoveCustomMapMarker)
+        return self.rpcSendRequest(eRequestType.RemoveCustomMapMarker)
     
     # pipValue must be a value from the '/Map/World/Locations' array
     # Resp: {'allowed': true/false, 'success': true/false}
     def rpcFastTravel(self, pipValue, callback = None):
-        self.rpcSendRequest(eRequestType.FastTravel, [pipValue.pipId], callback)
+        return self.rpcSendRequest(eRequestType.FastTravel, [pipValue.pipId], callback)
         
     def rpcSendClearIdleRequest(self):
-        self.rpcSendRequest(eRequestType.ClearIdle)
+        return self.rpcSendRequest(eRequestType.ClearIdle)
     
     # pipValue must be an entry from the 'Radio' array
     def rpcToggleRadioStation(self, pipValue):
-        self.rpcSendRequest(eRequestType.ToggleRadioStation, [pipValue.pipId])
+        return self.rpcSendRequest(eRequestType.ToggleRadioStation, [pipValue.pipId])
     
     # pipValue must be an entry from the 'Quests' array
     def rpcToggleQuestActive(self, pipValue):
@@ -339,7 +711,7 @@ class PipboyDataManager:
         if not pipValue.child('type'):
             raise Exception('Missing type')
         qtype = pipValue.child('type').value()
-        self.rpcSendRequest(eRequestType.ToggleQuestActive, [formid, instance, qtype])
+        return self.rpcSendRequest(eRequestType.ToggleQuestActive, [formid, instance, qtype])
     
     # pipValue must be an entry from the '/Inventory/InvComponents' array
     def rpcToggleComponentFavorite(self, pipValue):
@@ -350,7 +722,7 @@ class PipboyDataManager:
         if not inventory or not inventory.child('Version'):
             raise Exception('Could not find inventory version')
         version = inventory.child('Version').value()
-        self.rpcSendRequest(eRequestType.ToggleComponentFavorite, [componentFormID, version])
+        return self.rpcSendRequest(eRequestType.ToggleComponentFavorite, [componentFormID, version])
     
     # pipValue must be an item from the 'Inventory' branch
     def rpcUseItem(self, pipValue):
@@ -364,14 +736,14 @@ class PipboyDataManager:
         if not inventory or not inventory.child('Version'):
             raise Exception('Could not find inventory version')
         version = inventory.child('Version').value()
-        self.rpcSendRequest(eRequestType.UseItem, [handleid, stackid, version])
+        return self.rpcSendRequest(eRequestType.UseItem, [handleid, stackid, version])
         
     def rpcUseStimpak(self):
         inventory = self.rootObject.child('Inventory')
         if not inventory:
             raise Exception('Could not find inventory object')
         if inventory.child('stimpakObjectIDIsValid').value():
-            self.rpcUseItem(self._valueMap[inventory.child('stimpakObjectID').value()])
+            return self.rpcUseItem(self.getPipValueById(inventory.child('stimpakObjectID').value()))
         else:
             raise Exception('stimpakObjectID is not valid')
         
@@ -381,7 +753,7 @@ class PipboyDataManager:
             raise Exception('Could not find inventory object')
         version = inventory.child('Version').value()
         if inventory.child('radawayObjectIDIsValid').value():
-            self.rpcUseItem(self._valueMap[inventory.child('radawayObjectID').value()])
+            return self.rpcUseItem(self.getPipValueById(inventory.child('radawayObjectID').value()))
         else:
             raise Exception('radawayObjectID is not valid')
         
@@ -400,10 +772,10 @@ class PipboyDataManager:
         if not inventory or not inventory.child('Version'):
             raise Exception('Could not find inventory version')
         version = inventory.child('Version').value()      
-        self.rpcSendRequest(eRequestType.DropItem, [handleid, count, version, stacklist])
+        return self.rpcSendRequest(eRequestType.DropItem, [handleid, count, version, stacklist])
         
     def rpcRequestLocalMapSnapshot(self):        
-        self.rpcSendRequest(eRequestType.RequestLocalMapSnapshot)
+        return self.rpcSendRequest(eRequestType.RequestLocalMapSnapshot)
     
     # pipValue must be an item from the 'Inventory' branch
     def rpcSetFavorite(self, pipValue, quickKeySlot):
@@ -419,14 +791,137 @@ class PipboyDataManager:
         if not inventory or not inventory.child('Version'):
             raise Exception('Could not find inventory version')
         version = inventory.child('Version').value()  
-        self.rpcSendRequest(eRequestType.SetFavorite, [handleid, stacklist, quickKeySlot, version])
+        return self.rpcSendRequest(eRequestType.SetFavorite, [handleid, stacklist, quickKeySlot, version])
         
     # resp: unknown
     def rpcSortInventory(self, index, callback = None):
-        self.rpcSendRequest(eRequestType.SortInventory, [index], callback)
+        return self.rpcSendRequest(eRequestType.SortInventory, [index], callback)
+    
+    # Drops several items
+    # items: list of (pipValue, count) tuples, pipValues must be items from the 'Inventory' branch
+    # Returns a Future receiving the list of result dicts (or exceptions), one per item
+    def rpcDropItems(self, items, window = 1):
+        if not self._connectionEstablished:
+            return self._notConnectedFuture()
+        versionFunc = self._inventoryVersionFunc()
+        commands = []
+        for pipValue, count in items:
+            handleid, stacklist = self._itemStackInfo(pipValue)
+            commands.append((eRequestType.DropItem, 
+                    lambda version, h=handleid, c=count, s=stacklist: [h, c, version, s]))
+        return RpcBatch(self.rpc, commands, versionFunc, window).start()
+    
+    # Uses the given item count times
+    # pipValue must be an item from the 'Inventory' branch
+    # Returns a Future receiving the list of result dicts (or exceptions)
+    def rpcUseItemMultiple(self, pipValue, count):
+        if not self._connectionEstablished:
+            return self._notConnectedFuture()
+        versionFunc = self._inventoryVersionFunc()
+        handleid, stacklist = self._itemStackInfo(pipValue)
+        command = (eRequestType.UseItem, lambda version: [handleid, stacklist[0], version])
+        return RpcBatch(self.rpc, [command] * count, versionFunc).start()
+    
+    # Sets the favorite key for several items
+    # items: list of (pipValue, quickKeySlot) tuples
+    # Returns a Future receiving the list of result dicts (or exceptions)
+    def rpcSetFavorites(self, items):
+        if not self._connectionEstablished:
+            return self._notConnectedFuture()
+        versionFunc = self._inventoryVersionFunc()
+        commands = []
+        for pipValue, quickKeySlot in items:
+            handleid, stacklist = self._itemStackInfo(pipValue)
+            commands.append((eRequestType.SetFavorite, 
+                    lambda version, h=handleid, s=stacklist, q=quickKeySlot: [h, s, q, version]))
+        return RpcBatch(self.rpc, commands, versionFunc).start()
+    
+    # Sets the inventory sort function and fetches the inventory items afterwards
+    # The game's response to SortInventory is unknown, so the future is resolved once sortedIDS 
+    # has changed. When it does not change within timeout seconds (e.g. because the inventory
+    # already was in this order), the future receives the current order.
+    # Returns a Future receiving the list of items in their new order
+    def rpcSortInventoryAndFetch(self, index, timeout = 5.0):
+        inventory = self.rootObject.child('Inventory') if self.rootObject else None
+        if not inventory:
+            raise Exception('Could not find inventory object')
+        retval = concurrent.futures.Future()
+        lock = threading.Lock()
+        finished = [False]
+        oldIds = self._sortedInventoryIds()
+        def _finish(exception = None):
+            lock.acquire()
+            done = finished[0]
+            finished[0] = True
+            lock.release()
+            if done:
+                return
+            self.unregisterUpdateAppliedListener(_onUpdateApplied)
+            timer.cancel()
+            if exception:
+                retval.set_exception(exception)
+            else:
+                items = []
+                for id in self._sortedInventoryIds():
+                    item = self.getPipValueById(id)
+                    if item:
+                        items.append(item)
+                retval.set_result(items)
+        def _onUpdateApplied():
+            if self._sortedInventoryIds() != oldIds:
+                _finish()
+        def _onSent(future):
+            exception = future.exception()
+            if exception and not isinstance(exception, concurrent.futures.TimeoutError):
+                _finish(exception)
+        timer = threading.Timer(timeout, _finish)
+        timer.daemon = True
+        self.registerUpdateAppliedListener(_onUpdateApplied)
+        timer.start()
+        self.rpcSortInventory(index).add_done_callback(_onSent)
+        return retval
+    
+    
+    # Returns the list of item pipIds in sortedIDS
+    def _sortedInventoryIds(self):
+        inventory = self.rootObject.child('Inventory') if self.rootObject else None
+        sortedIds = inventory.child('sortedIDS') if inventory else None
+        if sortedIds:
+            return [id.value() for id in sortedIds.value()]
+        return []
+    
+    # Returns a future failed with a ConnectionError
+    def _notConnectedFuture(self):
+        future = concurrent.futures.Future()
+        future.set_exception(ConnectionError('Not connected'))
+        return future
+    
+    # Returns a function returning the current inventory version
+    def _inventoryVersionFunc(self):
+        inventory = self.rootObject.child('Inventory') if self.rootObject else None
+        if not inventory or not inventory.child('Version'):
+            raise Exception('Could not find inventory version')
+        def _version():
+            # The Version value may get replaced, so look it up on every call
+            return inventory.child('Version').value()
+        return _version
+    
+    # Returns (HandleID, StackID list) of the given inventory item
+    def _itemStackInfo(self, pipValue):
+        if not pipValue.child('HandleID'):
+            raise Exception('Missing HandleID')
+        handleid = pipValue.child('HandleID').value()
+        if not pipValue.child('StackID') or pipValue.child('StackID').childCount() <= 0:
+            raise Exception('Missing StackID')
+        stacklist = list()
+        for i in pipValue.child('StackID').value():
+            stacklist.append(i.value())
+        return (handleid, stacklist)
     
     
     def exportData(self):
+        if self._lazy:
+            return self._exportRecords()
         if self.rootObject:
             pipValues = []
             queue = [self.rootObject]
@@ -455,9 +950,13 @@ class PipboyDataManager:
         # only import when no active connection
         if  not self._connectionEstablished:
             self._valueMap = dict()
+            self._recordMap = dict()
+            self._parentMap = dict()
             self.rootObject = None
+            self._snapshotNodes = dict()
             for record in data:
                 self._onRecordParsed(DataUpdateRecord(record[0], record[1], record[2]))
+            self._onDataUpdateApplied()
             return True
         else:
             return False
@@ -467,22 +966,40 @@ class PipboyDataManager:
         
     def _onConnectionStateChange(self, state, errstatus, errmsg):
         if state and not self._connectionEstablished:
+            if self._stale and self.rootObject:
+                # A stale tree stays visible (and can be looked up by id) till the live root
+                # object is known, the live tree is built in new tables
+                if self._staleValueMap == None:
+                    if self._lazy:
+                        self._materializeAll()
+                    self._staleValueMap = self._valueMap
+            else:
+                self.rootObject = None
             self._valueMap = dict()
-            self.rootObject = None
+            self._recordMap = dict()
+            self._parentMap = dict()
+            self._snapshotNodes = dict()
+            self._snapshotDirty = set()
             self._connectionEstablished = True
         elif not state and self._connectionEstablished:
             self._connectionEstablished = False
+            self.rpc.cancelAll()
+            if self._warmStartDir:
+                try:
+                    self.saveWarmStart()
+                except Exception as e:
+                    self._logger.warning('Could not save warm start data: %s', e)
     
     def _onMessageReceived(self, msg):
         if msg.msgType == eMessageType.DATA_UPDATE:
-            parser = DataUpdateParser();
+            parser = self.dataParser if self.dataParser else DataUpdateParser()
             parser.parse(msg.payload, self._onRecordParsed)
+            self._onDataUpdateApplied()
+            for listener in list(self._dataUpdateMessageListeners):
+                listener(msg)
         elif msg.msgType == eMessageType.COMMAND_RESULT:
             resp = json.loads(msg.payload.decode())
-            if resp['id'] in self._rpcCallbackMap:
-                self._rpcCallbackMap[resp['id']](resp)
-                del self._rpcCallbackMap[resp['id']]
-            else:
+            if not self.rpc.handleResult(resp):
                 self._logger.debug('Command Result: ' + str(resp))
         elif msg.msgType == eMessageType.LOCAL_MAP_UPDATE:
             parser = LocalMapUpdateParser()
@@ -490,6 +1007,11 @@ class PipboyDataManager:
             self._fireLocalMapUpdatedEvent(lmap)
         
     def _onRecordParsed(self, record):
+        if self._snapshotsEnabled:
+            self._snapshotDirty.add(record.id)
+        if self._lazy:
+            self._onLazyRecordParsed(record)
+            return
         obj = None
         recordExists = record.id in self._valueMap
         if recordExists:
@@ -557,9 +1079,374 @@ class PipboyDataManager:
                 
     
     
+    # Stores the record in the record table and applies it to already created values
+    # Records of values that have not been created are reported with their nearest created
+    # ancestor: as NEW for objects and arrays (the structure below it has changed), as UPDATED
+    # for primitive values.
+    def _onLazyRecordParsed(self, record):
+        ancestor = None
+        self._lazyLock.acquire()
+        try:
+            entry = self._recordMap.get(record.id)
+            if record.type == eValueType.OBJECT:
+                if entry and entry[0] == eValueType.OBJECT:
+                    value = entry[1]
+                else:
+                    value = dict()
+                for r in record.value[0]:
+                    if not r[1] in self._recordMap:
+                        raise RuntimeError('Tangling reference ' + str(r[1]))
+                    value[r[0].lower()] = (r[0], r[1])
+                    self._parentMap[r[1]] = record.id
+            elif record.type == eValueType.ARRAY:
+                for r in record.value:
+                    if not r in self._recordMap:
+                        raise RuntimeError('Tangling reference ' + str(r))
+                    self._parentMap[r] = record.id
+                value = list(record.value)
+            else:
+                value = record.value
+            self._recordMap[record.id] = (record.type, value)
+            obj = self._valueMap.get(record.id)
+            if obj:
+                if obj.pipType == ePipboyValueType.PRIMITIVE:
+                    obj._value = value
+                elif not obj._lazyPending:
+                    self._expandValue(obj)
+            elif record.id == 0 and not entry:
+                self.rootObject = self._materializeValue(0)
+                self._onRootObjectKnown()
+            elif entry:
+                # New values are reported with the record of their parent
+                ancestor = self._nearestMaterializedAncestor(record.id)
+        finally:
+            self._lazyLock.release()
+        if obj:
+            self._fireValueUpdatedEvent(obj, eValueUpdatedEventType.UPDATED)
+            obj._fireValueUpdatedEvent(obj)
+        elif ancestor:
+            if record.type == eValueType.OBJECT or record.type == eValueType.ARRAY:
+                self._fireValueUpdatedEvent(ancestor, eValueUpdatedEventType.NEW)
+            else:
+                self._fireValueUpdatedEvent(ancestor, eValueUpdatedEventType.UPDATED)
+            ancestor._fireValueUpdatedEvent(ancestor)
+    
+    # Returns the nearest ancestor of the given record that has a value object, or None
+    # Must be called with self._lazyLock acquired
+    def _nearestMaterializedAncestor(self, pipId):
+        visited = 0
+        pipId = self._parentMap.get(pipId)
+        while pipId != None and visited <= len(self._parentMap):
+            obj = self._valueMap.get(pipId)
+            if obj:
+                return obj
+            pipId = self._parentMap.get(pipId)
+            visited += 1
+        return None
+    
+    # Returns the value with the given id, creating it (and its ancestors) from the record table if needed
+    def _materializeValue(self, pipId):
+        self._lazyLock.acquire()
+        try:
+            obj = self._valueMap.get(pipId) if self._valueMap != None else None
+            if obj or not pipId in self._recordMap:
+                return obj
+            parentId = self._parentMap.get(pipId)
+            if parentId != None:
+                # Creating the parent's children also creates the requested value
+                parent = self._materializeValue(parentId)
+                if parent._lazyPending:
+                    self._expandValue(parent)
+                obj = self._valueMap.get(pipId)
+            if not obj:
+                obj = self._createLazyValue(pipId)
+            return obj
+        finally:
+            self._lazyLock.release()
+    
+    # Creates the value object for the given record, children are created on first access
+    def _createLazyValue(self, pipId):
+        recordType, recordValue = self._recordMap[pipId]
+        if recordType == eValueType.OBJECT:
+            obj = PipboyObjectValue(self, pipId)
+            obj._lazyPending = True
+        elif recordType == eValueType.ARRAY:
+            obj = PipboyArrayValue(self, pipId)
+            obj._lazyPending = True
+        else:
+            obj = PipboyPrimitiveValue(self, pipId, recordType, recordValue)
+        self._valueMap[pipId] = obj
+        return obj
+    
+    # Creates the children of the given object or array value from the record table
+    def _expandValue(self, obj):
+        self._lazyLock.acquire()
+        try:
+            recordValue = self._recordMap[obj.pipId][1]
+            if obj.pipType == ePipboyValueType.OBJECT:
+                children = dict()
+                for k in recordValue:
+                    key, childId = recordValue[k]
+                    child = self._valueMap.get(childId) or self._createLazyValue(childId)
+                    child.pipParent = obj
+                    child.pipParentKey = key
+                    children[k] = child
+                orderedList = list()
+                keylist = list(children.keys())
+                keylist.sort()
+                i = 0
+                for r in keylist:
+                    children[r].pipParentIndex = i
+                    orderedList.append(children[r])
+                    i += 1
+                obj._value = children
+                obj._orderedList = orderedList
+            else:
+                children = list()
+                i = 0
+                for childId in recordValue:
+                    child = self._valueMap.get(childId) or self._createLazyValue(childId)
+                    child.pipParent = obj
+                    child.pipParentKey = i
+                    child.pipParentIndex = i
+                    children.append(child)
+                    i += 1
+                obj._value = children
+            obj._lazyPending = False
+        finally:
+            self._lazyLock.release()
+    
+    # Creates the values of the whole tree, so it no longer depends on the record table
+    def _materializeAll(self):
+        queue = [self.rootObject]
+        while len(queue) > 0:
+            obj = queue.pop()
+            if obj.pipType == ePipboyValueType.OBJECT:
+                if obj._lazyPending:
+                    self._expandValue(obj)
+                queue.extend(obj._orderedList)
+            elif obj.pipType == ePipboyValueType.ARRAY:
+                if obj._lazyPending:
+                    self._expandValue(obj)
+                queue.extend(obj._value)
+    
+    # exportData() for lazy data managers, works directly on the record table
+    def _exportRecords(self):
+        pipValues = []
+        self._lazyLock.acquire()
+        try:
+            if 0 in self._recordMap:
+                queue = [0]
+                while len(queue) > 0:
+                    pipId = queue.pop(0)
+                    recordType, recordValue = self._recordMap[pipId]
+                    if recordType == eValueType.OBJECT:
+                        value = [[], []]
+                        for k in recordValue:
+                            value[0].append(recordValue[k])
+                            queue.append(recordValue[k][1])
+                        pipValues.append([pipId, recordType, value])
+                    elif recordType == eValueType.ARRAY:
+                        queue.extend(recordValue)
+                        pipValues.append((pipId, recordType, list(recordValue)))
+                    else:
+                        pipValues.append((pipId, recordType, recordValue))
+        finally:
+            self._lazyLock.release()
+        return pipValues
+    
+    def _warmStartPath(self):
+        if not self._warmStartDir or not self._warmStartKey:
+            return None
+        return os.path.join(self._warmStartDir, re.sub(r'[^A-Za-z0-9_.-]', '_', self._warmStartKey) + '.json')
+    
+    # Loads the cached tree of the current host
+    def _loadWarmStart(self):
+        path = self._warmStartPath()
+        if not path or not os.path.isfile(path):
+            return False
+        try:
+            with open(path) as f:
+                data = json.load(f)
+            self._loadingWarmStart = True
+            try:
+                return self.importData(data)
+            finally:
+                self._loadingWarmStart = False
+        except Exception as e:
+            self._logger.warning('Could not load warm start data: %s', e)
+            self._valueMap = dict()
+            self._recordMap = dict()
+            self._parentMap = dict()
+            self.rootObject = None
+            self._stale = False
+            self._staleValueMap = None
+            return False
+    
+    # Called after all records of a data update have been applied
+    def _onDataUpdateApplied(self):
+        if self._snapshotsEnabled:
+            self._publishSnapshot()
+        self._fireUpdateAppliedEvent()
+    
+    # Creates a new snapshot version by copying all changed values and their ancestors
+    def _publishSnapshot(self):
+        # The record table is also read by exportData() and getTreeStats() on other threads
+        self._lazyLock.acquire()
+        try:
+            dirty = set()
+            if self._lazy:
+                for pipId in self._snapshotDirty:
+                    while pipId != None and not pipId in dirty:
+                        dirty.add(pipId)
+                        pipId = self._parentMap.get(pipId)
+            else:
+                for pipId in self._snapshotDirty:
+                    value = self._valueMap.get(pipId)
+                    while value and not value.pipId in dirty:
+                        dirty.add(value.pipId)
+                        value = value.pipParent
+            self._snapshotDirty = set()
+            # While the live tree is received the last snapshot of the stale tree is kept
+            if self.rootObject and self._staleValueMap == None:
+                if self._lazy:
+                    root = self._freezeRecord(0, dirty)
+                else:
+                    root = self._freezeValue(self.rootObject, dirty)
+                self._snapshotVersion += 1
+                self._snapshot = PipboySnapshot(self._snapshotVersion, root)
+        finally:
+            self._lazyLock.release()
+    
+    # Returns the immutable copy of value, reusing the previous copy when value is not dirty
+    def _freezeValue(self, value, dirty):
+        frozen = self._snapshotNodes.get(value.pipId)
+        if frozen and not value.pipId in dirty:
+            return frozen
+        if value.pipType == ePipboyValueType.OBJECT:
+            children = dict()
+            orderedList = list()
+            keys = list()
+            for child in value._orderedList:
+                fchild = self._freezeValue(child, dirty)
+                children[child.pipParentKey.lower()] = fchild
+                orderedList.append(fchild)
+                keys.append(child.pipParentKey)
+            frozen = PipboySnapshotValue(value.pipId, value.pipType, value.valueType, children, tuple(orderedList), tuple(keys))
+        elif value.pipType == ePipboyValueType.ARRAY:
+            children = tuple([self._freezeValue(child, dirty) for child in value._value])
+            frozen = PipboySnapshotValue(value.pipId, value.pipType, value.valueType, children)
+        else:
+            frozen = PipboySnapshotValue(value.pipId, value.pipType, value.valueType, value._value)
+        self._snapshotNodes[value.pipId] = frozen
+        return frozen
+    
+    # _freezeValue() for lazy data managers, works directly on the record table
+    # Must be called with self._lazyLock acquired
+    def _freezeRecord(self, pipId, dirty):
+        frozen = self._snapshotNodes.get(pipId)
+        if frozen and not pipId in dirty:
+            return frozen
+        recordType, recordValue = self._recordMap[pipId]
+        if recordType == eValueType.OBJECT:
+            children = dict()
+            orderedList = list()
+            keys = list()
+            keylist = list(recordValue.keys())
+            keylist.sort()
+            for k in keylist:
+                key, childId = recordValue[k]
+                fchild = self._freezeRecord(childId, dirty)
+                children[k] = fchild
+                orderedList.append(fchild)
+                keys.append(key)
+            frozen = PipboySnapshotValue(pipId, ePipboyValueType.OBJECT, recordType, children, tuple(orderedList), tuple(keys))
+        elif recordType == eValueType.ARRAY:
+            children = tuple([self._freezeRecord(childId, dirty) for childId in recordValue])
+            frozen = PipboySnapshotValue(pipId, ePipboyValueType.ARRAY, recordType, children)
+        else:
+            frozen = PipboySnapshotValue(pipId, ePipboyValueType.PRIMITIVE, recordType, recordValue)
+        self._snapshotNodes[pipId] = frozen
+        return frozen
+    
+    # Returns the list of (key, child id) of a node, from the value object or the record table
+    def _treeNodeChildren(self, pipId, value):
+        if value and not value._lazyPending:
+            if value.pipType == ePipboyValueType.OBJECT:
+                return [(c.pipParentKey, c.pipId) for c in list(value._orderedList)]
+            elif value.pipType == ePipboyValueType.ARRAY:
+                return list(enumerate(c.pipId for c in list(value._value)))
+            return []
+        entry = self._recordMap.get(pipId)
+        if entry:
+            if entry[0] == eValueType.OBJECT:
+                return [entry[1][k] for k in sorted(entry[1].keys())]
+            elif entry[0] == eValueType.ARRAY:
+                return list(enumerate(entry[1]))
+        return []
+    
+    # Returns the estimated number of bytes used by a node (value object and record entry)
+    def _estimateNodeBytes(self, pipId, value):
+        size = 0
+        if value:
+            size += sys.getsizeof(value) + sys.getsizeof(value.__dict__) + sys.getsizeof(value._value)
+            if value.pipType == ePipboyValueType.OBJECT:
+                size += sys.getsizeof(value._orderedList)
+            size += sys.getsizeof(value._userCache) + sys.getsizeof(value._valueUpdatedListeners)
+        entry = self._recordMap.get(pipId) if self._lazy else None
+        if entry:
+            size += sys.getsizeof(entry) + sys.getsizeof(entry[1])
+            if entry[0] == eValueType.OBJECT:
+                for key, childId in entry[1].values():
+                    size += sys.getsizeof(key) + 64
+        return size
+    
+    # Keeps the n largest (childCount, path) entries in the heap
+    @staticmethod
+    def _pushLargest(heap, n, childCount, path):
+        entry = (childCount, -len(heap), path)
+        if len(heap) < n:
+            heapq.heappush(heap, entry)
+        elif n > 0 and childCount > heap[0][0]:
+            heapq.heapreplace(heap, entry)
+    
     def _onRootObjectKnown(self):
+        staleValueMap = self._staleValueMap
+        self._staleValueMap = None
+        # Frozen values of a replaced tree must not be reused
+        self._snapshotNodes = dict()
+        self._stale = self._loadingWarmStart
         self._fireRootObjectEvent(self.rootObject)
+        if staleValueMap:
+            self._reconcileStaleValues(staleValueMap)
         #self.printJSON()
+    
+    # Moves the listeners of stale values to the live values at the same paths and notifies them.
+    # Stale values with listeners whose path no longer exists are reported as DELETED.
+    def _reconcileStaleValues(self, staleValueMap):
+        moved = []
+        for staleValue in list(staleValueMap.values()):
+            staleValue._listenerLock.acquire()
+            listeners = staleValue._valueUpdatedListeners
+            staleValue._valueUpdatedListeners = dict()
+            staleValue._listenerLock.release()
+            if len(listeners) == 0:
+                continue
+            keys = []
+            value = staleValue
+            while value.pipParent:
+                keys.append(str(value.pipParentKey))
+                value = value.pipParent
+            keys.reverse()
+            liveValue = resolvePipPath(self.rootObject, '/'.join(keys)) if value.pipId == 0 else None
+            if not liveValue:
+                self._fireValueUpdatedEvent(staleValue, eValueUpdatedEventType.DELETED)
+                continue
+            for listener, depth in listeners.items():
+                liveValue.registerValueUpdatedListener(listener, depth)
+                moved.append((liveValue, listener))
+        for liveValue, listener in moved:
+            listener(liveValue, liveValue, [])
         
     
     def _fireRootObjectEvent(self, rootObject):
@@ -568,13 +1455,27 @@ class PipboyDataManager:
         
     
     def _fireValueUpdatedEvent(self, value, eventtype):
+        profiler = self.profiler
         for listener in self._valueUpdatedListeners:
-            listener(value, eventtype)
+            if profiler:
+                profiler.call(profiler.DATAMANAGER_VALUE_UPDATED, listener, (value, eventtype), value)
+            else:
+                listener(value, eventtype)
+        
+    
+    def _fireUpdateAppliedEvent(self):
+        # Listeners may unregister themselves
+        for listener in list(self._updateAppliedListeners):
+            listener()
         
     
     def _fireLocalMapUpdatedEvent(self, lmap):
+        profiler = self.profiler
         for listener in self._localMapListeners:
-            listener(lmap)
+            if profiler:
+                profiler.call(profiler.LOCAL_MAP_UPDATED, listener, (lmap,))
+            else:
+                listener(lmap)
 
 
         
\ No newline at end of file
@@ -84,6 +84,10 @@ class DataParser:
 
 
 class DataUpdateParser(DataParser):
+    # internTable: optional dict used to share identical object keys between parsers
+    def __init__(self, internTable = None):
+        self.internTable = internTable
+    
     def parse(self, data, callback):
         #print("\n Parsing data message:")
         self.offset = 0
@@ -147,6 +151,8 @@ class DataUpdateParser(DataParser):
             valueid = self._parseUInt32()
             # string as key
             key = self._parseString()
+            if self.internTable != None:
+                key = self.internTable.setdefault(key, key)
             added.append((key, valueid))
         # Two bytes are number of remoced value ids
         removed_count = self._parseUInt16()
@@ -0,0 +1,113 @@
+# -*- coding: utf-8 -*-
+
+import json
+import zlib
+
+
+# PyPipboy protocol extensions
+#
+# A PyPipboy relay lists its extension features in the CONNECTION_ACCEPTED message
+# (key 'pypipboy'). A PyPipboy client that wants to use some of them answers with a
+# HELLO message (json: {"features": [...], "options": {...}}). Features apply to everything
+# sent after the HELLO arrived. Clients that do not send a HELLO (e.g. the official app) only
+# get the plain game protocol.
+
+
+# Receive local map updates as LOCAL_MAP_DIFF messages
+# payload: local map header (as in LOCAL_MAP_UPDATE) + zlib(pixels XOR pixels of the previous frame)
+FEATURE_LOCAL_MAP_DIFF = 'localmapdiff'
+
+# Receive game protocol messages in COMPRESSED_BATCH messages (used between relays)
+# payload: zlib(concatenated encoded messages)
+FEATURE_COMPRESSED_BATCH = 'compressedbatch'
+
+# Receive only the given subtrees of the data tree (and their ancestors)
+# The paths are sent as HELLO option (OPTION_SUBSCRIBE) and can be changed later with a
+# SUBSCRIBE message (json: {"paths": [...]}, null paths: everything).
+# The initial data is sent before the HELLO arrives and contains the whole tree, a SUBSCRIBE
+# message resends the subscribed part.
+FEATURE_SUBSCRIBE = 'subscribe'
+
+# HELLO option: list of subscribed paths (e.g. ['PlayerInfo', 'Radio'])
+OPTION_SUBSCRIBE = 'subscribe'
+
+# HELLO option: maximal local map frames per second the client wants to receive
+OPTION_LOCAL_MAP_FPS = 'localMapFps'
+
+# Size of the LOCAL_MAP_UPDATE header (width, height, nw, ne, sw)
+LOCAL_MAP_HEADER_SIZE = 32
+
+LOCAL_MAP_DIFF_COMPRESSION = 1
+
+COMPRESSED_BATCH_COMPRESSION = 6
+
+# Maximal uncompressed size of a COMPRESSED_BATCH, bigger batches are rejected by the receiver
+COMPRESSED_BATCH_MAX_SIZE = 16 * 1024 * 1024
+
+
+
+# Returns the payload of a HELLO message
+def encodeHello(features, options = None):
+    return json.dumps({'features': sorted(features), 'options': options if options else dict()}).encode('utf-8')
+
+
+# Returns (set of features, options dict)
+def decodeHello(payload):
+    hello = json.loads(payload.decode('utf-8'))
+    return (set(hello.get('features', [])), hello.get('options', dict()))
+
+
+# Returns the payload of a LOCAL_MAP_DIFF message transforming basePayload into payload
+# (both LOCAL_MAP_UPDATE payloads) or None when the frames have different sizes
+def encodeLocalMapDiff(basePayload, payload):
+    if len(basePayload) != len(payload) or basePayload[:8] != payload[:8]:
+        return None
+    header = payload[:LOCAL_MAP_HEADER_SIZE]
+    diff = _xorBytes(basePayload[LOCAL_MAP_HEADER_SIZE:], payload[LOCAL_MAP_HEADER_SIZE:])
+    return bytes(header) + zlib.compress(diff, LOCAL_MAP_DIFF_COMPRESSION)
+
+
+# Returns the LOCAL_MAP_UPDATE payload encoded by encodeLocalMapDiff()
+def decodeLocalMapDiff(basePayload, diffPayload):
+    header = diffPayload[:LOCAL_MAP_HEADER_SIZE]
+    diff = _decompress(diffPayload[LOCAL_MAP_HEADER_SIZE:], len(basePayload) - LOCAL_MAP_HEADER_SIZE)
+    if len(diff) != len(basePayload) - LOCAL_MAP_HEADER_SIZE:
+        raise Exception('Local map diff does not match the previous frame')
+    return bytes(header) + _xorBytes(basePayload[LOCAL_MAP_HEADER_SIZE:], diff)
+
+
+# Returns the payload of a SUBSCRIBE message
+def encodeSubscribe(paths):
+    return json.dumps({'paths': list(paths) if paths != None else None}).encode('utf-8')
+
+
+# Returns the list of subscribed paths or None
+def decodeSubscribe(payload):
+    return json.loads(payload.decode('utf-8')).get('paths')
+
+
+# Returns the payload of a COMPRESSED_BATCH message containing the given encoded messages
+def encodeCompressedBatch(encodedMessages):
+    return zlib.compress(b''.join(encodedMessages), COMPRESSED_BATCH_COMPRESSION)
+
+
+# Returns the encoded messages of a COMPRESSED_BATCH payload (feed them to a MessageFramer)
+def decodeCompressedBatch(payload):
+    return _decompress(payload, COMPRESSED_BATCH_MAX_SIZE)
+
+
+# Decompresses data received from a peer, raises an exception when it would exceed maxSize bytes
+def _decompress(data, maxSize):
+    decompressor = zlib.decompressobj()
+    result = decompressor.decompress(data, maxSize + 1)
+    if len(result) > maxSize:
+        raise Exception('Decompressed data exceeds ' + str(maxSize) + ' bytes')
+    if not decompressor.eof:
+        raise Exception('Truncated compressed data')
+    return result
+
+
+def _xorBytes(a, b):
+    # big integers xor whole buffers at C speed
+    size = len(a)
+    return (int.from_bytes(a, 'little') ^ int.from_bytes(b, 'little')).to_bytes(size, 'little')
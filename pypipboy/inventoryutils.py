@@ -1,5 +1,13 @@
 # -*- coding: utf-8 -*-
 
+import threading
+from pypipboy.datamanager import ePipboyValueType
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
 # Retrieve all inventory items matching filterFunc
 def inventoryGetItems(inventory, filterFunc = None):
     retval = []
@@ -48,41 +56,107 @@ class eItemCardInfoDamageType:
     Radiation = 6
     Ammunition = 10 # (diverting from intended use, Bethesda?)
 
+# ItemCardInfo entries of an item, indexed by their keys
+# Stored in the user cache of the itemCardInfoList value (invalidateDepth 0), so it is dropped
+# whenever the list or one of its entries changes and only then. Lookups, values and derived
+# classifications are computed once per version of the list.
+class _ItemCardInfoCache:
+    CACHE_KEY = 'ici_cache'
+
+    def __init__(self, infos):
+        self.infos = infos
+        # matchKey -> dict value -> list of entries (None when objects or arrays are matched)
+        self._indexes = dict()
+        # (matchValue, matchKey, valueKey) -> value
+        self._values = dict()
+        # classification name -> result
+        self._classifications = dict()
+
+    # Returns the matching entries
+    def find(self, matchValue, matchKey):
+        if not matchKey in self._indexes:
+            index = dict()
+            if self.infos.pipType == ePipboyValueType.ARRAY:
+                for i in self.infos.value():
+                    v = i.child(matchKey)
+                    if v:
+                        if v.pipType != ePipboyValueType.PRIMITIVE:
+                            # Values of objects and arrays can't be dict keys
+                            index = None
+                            break
+                        index.setdefault(v.value(), []).append(i)
+            self._indexes[matchKey] = index
+        index = self._indexes[matchKey]
+        if index != None:
+            try:
+                return index.get(matchValue, ())
+            except TypeError:
+                # Unhashable values never equal primitive ones
+                return ()
+        retval = []
+        for i in self.infos.value():
+            v = i.child(matchKey)
+            if v and v.value() == matchValue:
+                retval.append(i)
+        return retval
+
+    # Returns the value of the first matching entry or None
+    def findValue(self, matchValue, matchKey, valueKey):
+        key = (matchValue, matchKey, valueKey)
+        try:
+            if key in self._values:
+                return self._values[key]
+        except TypeError:
+            # Unhashable match values are not memoized
+            key = None
+        value = None
+        infos = self.find(matchValue, matchKey)
+        if len(infos) > 0:
+            v = infos[0].child(valueKey)
+            if v:
+                value = v.value()
+        if key != None:
+            self._values[key] = value
+        return value
+
+    # Returns func(self), computed once
+    def classification(self, name, func):
+        if not name in self._classifications:
+            self._classifications[name] = func(self)
+        return self._classifications[name]
+
+# Returns the _ItemCardInfoCache of the item or None when it has no itemCardInfoList
+def _itemCardInfoCache(item):
+    infos = item.child('itemCardInfoList')
+    if not infos:
+        return None
+    cached = infos.getUserCache(_ItemCardInfoCache.CACHE_KEY)
+    if not cached or cached.dirtyFlag:
+        cached = infos.setUserCache(_ItemCardInfoCache.CACHE_KEY, _ItemCardInfoCache(infos), 0)
+    return cached.value
+
 # Returns all matching ItemCardInfo entries
 def itemFindItemCardInfos(item, matchValue, matchKey = 'text'):
-    retval = []
-    infos = item.child('itemCardInfoList')
-    for i in infos.value():
-        if i.child(matchKey).value() == matchValue:
-            retval.append(i)
-    return retval
+    cache = _itemCardInfoCache(item)
+    if not cache:
+        return []
+    return list(cache.find(matchValue, matchKey))
 
 # Returns the first matching ItemCardInfo entry
 def itemFindItemCardInfo(item, matchValue, matchKey = 'text'):
-    infos = item.child('itemCardInfoList')
-    for i in infos.value():
-        value = i.child(matchKey)
-        if value and value.value() == matchValue:
-            return i
+    cache = _itemCardInfoCache(item)
+    if cache:
+        infos = cache.find(matchValue, matchKey)
+        if len(infos) > 0:
+            return infos[0]
     return None
 
 # Returns the first matching ItemCardInfo value (values are cached)
 def itemFindItemCardInfoValue(item, matchValue, matchKey = 'text', valueKey = 'Value'):
-    cachekey = 'ici_' + str(matchValue) + str(matchKey) + str(valueKey)
-    cached = item.getUserCache(cachekey)
-    if not cached or cached.dirtyFlag:
-        vInfo = itemFindItemCardInfo(item, matchValue, matchKey)
-        if vInfo:
-            try:
-                value = vInfo.child(valueKey).value()
-                item.setUserCache(matchValue, cachekey, 10)
-            except:
-                value = None
-        else:
-            value = None
-    else:
-        value = cached.value
-    return value
+    cache = _itemCardInfoCache(item)
+    if not cache:
+        return None
+    return cache.findValue(matchValue, matchKey, valueKey)
 
 
 # item Filter Categories (filterFlag parameter)
@@ -122,27 +196,655 @@ def itemIsAKey(item):
 # A gun is a weapon with range > 0 and ammunition (damagetype = 10)
 def itemIsWeaponGun(item):
     if itemHasAnyFilterCategory(item, eItemFilterCategory.Weapon):
-        range = itemFindItemCardInfoValue(item, eItemCardInfoValueText.Range)
-        if (type(range) == float and range > 0.0 
-                and itemFindItemCardInfoValue(item, 10, 'damageType', 'damageType')):
-            return True
+        cache = _itemCardInfoCache(item)
+        if cache:
+            return cache.classification('gun', _isGunItemCard)
+    return False
+
+def _isGunItemCard(cache):
+    range = cache.findValue(eItemCardInfoValueText.Range, 'text', 'Value')
+    if (type(range) == float and range > 0.0 
+            and cache.findValue(10, 'damageType', 'damageType')):
+        return True
     return False
 
 # Returns whether the item is a melee weapon
 # A melee weapon is a weapon with has a speed value
 def itemIsWeaponMelee(item):
     if itemHasAnyFilterCategory(item, eItemFilterCategory.Weapon):
-        if itemFindItemCardInfoValue(item, eItemCardInfoValueText.Speed):
-            return True
+        cache = _itemCardInfoCache(item)
+        if cache:
+            return cache.classification('melee', _isMeleeItemCard)
+    return False
+
+def _isMeleeItemCard(cache):
+    if cache.findValue(eItemCardInfoValueText.Speed, 'text', 'Value'):
+        return True
     return False
 
 # Returns whether the item is a throwable weapon
 # A throwable weapon is a weapon with has RateOfFire == 0
 def itemIsWeaponThrowable(item):
     if itemHasAnyFilterCategory(item, eItemFilterCategory.Weapon):
-        rof = itemFindItemCardInfoValue(item, eItemCardInfoValueText.RateOfFire)
-        if type(rof) == float and rof == 0.0:
-            return True
+        cache = _itemCardInfoCache(item)
+        if cache:
+            return cache.classification('throwable', _isThrowableItemCard)
+    return False
+
+def _isThrowableItemCard(cache):
+    rof = cache.findValue(eItemCardInfoValueText.RateOfFire, 'text', 'Value')
+    if type(rof) == float and rof == 0.0:
+        return True
     return False
-    
 
+
+
+# Returns the single bits (categories) of a filterFlag value
+def _filterCategoryBits(flags):
+    retval = []
+    if type(flags) != int:
+        return retval
+    while flags > 0:
+        bit = flags & -flags
+        retval.append(bit)
+        flags ^= bit
+    return retval
+
+
+# Returns the value of the given child or default if the child does not exist
+def _itemChildValue(item, key, default):
+    child = item.child(key)
+    if child:
+        return child.value()
+    return default
+
+
+# Base class for inventory views that are maintained from value updated events
+# Subclasses get notified about added, changed and removed items. Notifications are
+# collected while the data manager applies updates and delivered on the next call to
+# _sync(), so bursts of updates to one item are processed only once.
+class _InventoryTracker:
+    def __init__(self, datamanager):
+        self.datamanager = datamanager
+        self.inventory = None
+        self._rootObject = None
+        self._itemIds = set()
+        self._dirtyItemIds = set()
+        self._membershipDirty = True
+        self._sortedIdsId = None
+        self._lock = threading.RLock()
+        self.datamanager.registerRootObjectListener(self._onRootObject)
+        if self.datamanager.rootObject:
+            self._onRootObject(self.datamanager.rootObject)
+
+    # Stops tracking the inventory
+    def close(self):
+        self.datamanager.unregisterRootObjectListener(self._onRootObject)
+        if self._rootObject:
+            self._rootObject.unregisterValueUpdatedListener(self._onRootObjectUpdated)
+        self._attachInventory(None)
+
+    # Overridden by subclasses
+    def _onItemAdded(self, item):
+        pass
+
+    # Overridden by subclasses
+    def _onItemChanged(self, item):
+        pass
+
+    # Overridden by subclasses
+    def _onItemRemoved(self, pipId):
+        pass
+
+    # Applies all pending changes
+    def _sync(self):
+        self._lock.acquire()
+        try:
+            if self._membershipDirty:
+                self._membershipDirty = False
+                self._syncMembership()
+            if len(self._dirtyItemIds) > 0:
+                dirty = self._dirtyItemIds
+                self._dirtyItemIds = set()
+                for pipId in dirty:
+                    if pipId in self._itemIds:
+                        item = self.datamanager.getPipValueById(pipId)
+                        if item:
+                            self._onItemChanged(item)
+        finally:
+            self._lock.release()
+
+    def _syncMembership(self):
+        currentIds = set()
+        self._sortedIdsId = None
+        if self.inventory:
+            sortedIds = self.inventory.child('sortedIDS')
+            if sortedIds:
+                self._sortedIdsId = sortedIds.pipId
+                for id in sortedIds.value():
+                    currentIds.add(id.value())
+        for pipId in self._itemIds - currentIds:
+            self._onItemRemoved(pipId)
+        added = currentIds - self._itemIds
+        self._itemIds = set()
+        for pipId in currentIds:
+            item = self.datamanager.getPipValueById(pipId)
+            if item and item.pipType == ePipboyValueType.OBJECT:
+                self._itemIds.add(pipId)
+                if pipId in added:
+                    self._onItemAdded(item)
+        # Items that were just added are up to date
+        self._dirtyItemIds -= added
+
+    def _onRootObject(self, rootObject):
+        self._lock.acquire()
+        try:
+            if self._rootObject:
+                self._rootObject.unregisterValueUpdatedListener(self._onRootObjectUpdated)
+            self._rootObject = rootObject
+            rootObject.registerValueUpdatedListener(self._onRootObjectUpdated, 0)
+            self._attachInventory(rootObject.child('Inventory'))
+        finally:
+            self._lock.release()
+
+    def _onRootObjectUpdated(self, caller, value, pathObjs):
+        inventory = self._rootObject.child('Inventory')
+        if inventory != self.inventory:
+            self._lock.acquire()
+            self._attachInventory(inventory)
+            self._lock.release()
+
+    def _attachInventory(self, inventory):
+        if self.inventory:
+            self.inventory.unregisterValueUpdatedListener(self._onInventoryUpdated)
+        self.inventory = inventory
+        if inventory:
+            inventory.registerValueUpdatedListener(self._onInventoryUpdated, -1)
+        self._membershipDirty = True
+
+    def _onInventoryUpdated(self, caller, value, pathObjs):
+        self._lock.acquire()
+        if len(pathObjs) == 0:
+            # Inventory itself has been changed, only relevant when sortedIDS has been replaced
+            sortedIds = self.inventory.child('sortedIDS')
+            if (sortedIds.pipId if sortedIds else None) != self._sortedIdsId:
+                self._membershipDirty = True
+        elif pathObjs[-1].pipParentKey == 'sortedIDS':
+            self._membershipDirty = True
+        elif len(pathObjs) >= 2:
+            item = pathObjs[-2]
+            if item.pipType == ePipboyValueType.OBJECT:
+                self._dirtyItemIds.add(item.pipId)
+        self._lock.release()
+
+
+
+# Consistent columnar copy of the inventory (see InventoryColumns.table())
+# Each column is a numpy array with one entry per item, items[i] is the item of row i.
+class InventoryTable:
+    def __init__(self, items, columns):
+        self.items = items
+        self.columns = columns
+
+    # Returns the number of rows
+    def __len__(self):
+        return len(self.items)
+
+    # Returns the column with the given name
+    def column(self, name):
+        return self.columns[name]
+
+    # Returns a boolean array marking the items that have any of the given filter categories
+    def categoryMask(self, categories):
+        return (self.columns['filterFlag'] & categories) != 0
+
+    # Returns the items matching mask (boolean array), optionally sorted by the given
+    # column name or array
+    def select(self, mask = None, sortBy = None, descending = False, limit = None):
+        rows = numpy.arange(len(self.items))
+        if mask is not None:
+            rows = rows[mask]
+        if sortBy is not None:
+            if type(sortBy) == str:
+                sortBy = self.columns[sortBy]
+            order = numpy.argsort(sortBy[rows], kind = 'stable')
+            if descending:
+                order = order[::-1]
+            rows = rows[order]
+        if limit != None:
+            rows = rows[:limit]
+        return [self.items[r] for r in rows]
+
+    # Sums the given column name or array per filter category
+    # Returns a dict category -> sum
+    def sumByCategory(self, values, categories = None):
+        if type(values) == str:
+            values = self.columns[values]
+        if categories == None:
+            categories = _allItemFilterCategories()
+        retval = dict()
+        for c in categories:
+            retval[c] = float(values[self.categoryMask(c)].sum())
+        return retval
+
+    # Counts the items per filter category
+    # Returns a dict category -> count
+    def countByCategory(self, categories = None):
+        if categories == None:
+            categories = _allItemFilterCategories()
+        retval = dict()
+        for c in categories:
+            retval[c] = int(numpy.count_nonzero(self.categoryMask(c)))
+        return retval
+
+
+# Returns a list of all eItemFilterCategory values
+def _allItemFilterCategories():
+    retval = []
+    for k, v in vars(eItemFilterCategory).items():
+        if not k.startswith('_'):
+            retval.append(v)
+    return retval
+
+
+# Columnar inventory view that is updated incrementally from value updated events
+# Only items that have changed since the last query are re-read.
+# Columns: pipId, HandleID, formID, filterFlag, count, weight, value, damage, rateOfFire
+# (weight, value, damage and rateOfFire come from the itemCardInfoList, damage is
+# the sum of all damage types).
+#
+# Example: best weapon by DPS
+#    table = columns.table()
+#    dps = table.column('damage') * table.column('rateOfFire')
+#    table.select(table.categoryMask(eItemFilterCategory.Weapon), dps, True, 1)
+class InventoryColumns(_InventoryTracker):
+
+    INT_COLUMNS = ('pipId', 'HandleID', 'formID', 'filterFlag', 'count')
+    FLOAT_COLUMNS = ('weight', 'value', 'damage', 'rateOfFire')
+
+    def __init__(self, datamanager, initialCapacity = 256):
+        if numpy == None:
+            raise Exception('InventoryColumns requires numpy')
+        self._size = 0
+        self._items = []
+        self._rowById = dict()
+        self._columns = dict()
+        for name in self.INT_COLUMNS:
+            self._columns[name] = numpy.zeros(initialCapacity, dtype = numpy.int64)
+        for name in self.FLOAT_COLUMNS:
+            self._columns[name] = numpy.zeros(initialCapacity, dtype = numpy.float64)
+        super().__init__(datamanager)
+
+    # Returns a consistent InventoryTable of the current inventory
+    def table(self):
+        self._lock.acquire()
+        try:
+            self._sync()
+            columns = dict()
+            for name in self._columns:
+                columns[name] = self._columns[name][:self._size].copy()
+            return InventoryTable(list(self._items), columns)
+        finally:
+            self._lock.release()
+
+    def _onItemAdded(self, item):
+        if self._size == len(self._columns['pipId']):
+            for name in self._columns:
+                self._columns[name] = numpy.resize(self._columns[name], max(1, 2 * self._size))
+        row = self._size
+        self._size += 1
+        self._items.append(item)
+        self._rowById[item.pipId] = row
+        self._writeRow(row, item)
+
+    def _onItemChanged(self, item):
+        row = self._rowById.get(item.pipId)
+        if row != None:
+            self._items[row] = item
+            self._writeRow(row, item)
+
+    def _onItemRemoved(self, pipId):
+        row = self._rowById.pop(pipId, None)
+        if row != None:
+            # Move the last row into the free slot
+            last = self._size - 1
+            if row != last:
+                for name in self._columns:
+                    self._columns[name][row] = self._columns[name][last]
+                self._items[row] = self._items[last]
+                self._rowById[self._items[row].pipId] = row
+            self._items.pop()
+            self._size -= 1
+
+    def _writeRow(self, row, item):
+        columns = self._columns
+        columns['pipId'][row] = item.pipId
+        columns['HandleID'][row] = _itemChildValue(item, 'HandleID', -1)
+        columns['formID'][row] = _itemChildValue(item, 'formID', -1)
+        columns['filterFlag'][row] = _itemChildValue(item, 'filterFlag', 0)
+        columns['count'][row] = _itemChildValue(item, 'count', 0)
+        weight = value = damage = rof = 0.0
+        infos = item.child('itemCardInfoList')
+        if infos:
+            for info in infos.value():
+                text = info.child('text')
+                v = info.child('Value')
+                if not text or not v:
+                    continue
+                text = text.value()
+                try:
+                    if text == eItemCardInfoValueText.Weight:
+                        weight = float(v.value())
+                    elif text == eItemCardInfoValueText.Value:
+                        value = float(v.value())
+                    elif text == eItemCardInfoValueText.Damage:
+                        damage += float(v.value())
+                    elif text == eItemCardInfoValueText.RateOfFire:
+                        rof = float(v.value())
+                except (TypeError, ValueError):
+                    pass
+        columns['weight'][row] = weight
+        columns['value'][row] = value
+        columns['damage'][row] = damage
+        columns['rateOfFire'][row] = rof
+
+
+# Inventory index that is updated incrementally from value updated events
+# Lookups by HandleID, formID, name (case insensitive) and filter category bits are O(1),
+# only items that have changed since the last query are re-indexed.
+#
+# Example: react to inventory changes without rescanning the inventory
+#    def onItemsChanged(added, changed, removed):
+#        for item in added: ...
+#    index = InventoryIndex(datamanager)
+#    index.registerItemsChangedListener(onItemsChanged)
+class InventoryIndex(_InventoryTracker):
+
+    def __init__(self, datamanager):
+        # pipId -> (item, HandleID, formID, lowercased name, filterFlag)
+        self._entries = dict()
+        self._byHandleId = dict()
+        self._byFormId = dict()
+        self._byName = dict()
+        # category bit -> dict pipId -> item
+        self._byCategory = dict()
+        self._listeners = set()
+        self._added = []
+        # an item that changes several times in one update is reported once
+        self._changed = set()
+        self._removed = []
+        super().__init__(datamanager)
+
+    # Stops tracking the inventory
+    def close(self):
+        self.datamanager.unregisterUpdateAppliedListener(self._onUpdateApplied)
+        super().close()
+
+    # Returns the item with the given HandleID or None
+    def getByHandleId(self, handleId):
+        self._lock.acquire()
+        try:
+            self._sync()
+            return self._byHandleId.get(handleId)
+        finally:
+            self._lock.release()
+
+    # Returns a list of the items with the given formID
+    def getByFormId(self, formId):
+        return self._lookup(self._byFormId, formId)
+
+    # Returns a list of the items with the given name (case insensitive)
+    def getByName(self, name):
+        return self._lookup(self._byName, name.lower())
+
+    # Returns a list of the items that have any of the given filter categories
+    def getByCategory(self, categories):
+        self._lock.acquire()
+        try:
+            self._sync()
+            if categories & (categories - 1) == 0:
+                return list(self._byCategory.get(categories, dict()).values())
+            retval = dict()
+            for bit in _filterCategoryBits(categories):
+                retval.update(self._byCategory.get(bit, dict()))
+            return list(retval.values())
+        finally:
+            self._lock.release()
+
+    # Returns the number of items that have the given filter category (a single bit)
+    def countCategory(self, category):
+        self._lock.acquire()
+        try:
+            self._sync()
+            return len(self._byCategory.get(category, ()))
+        finally:
+            self._lock.release()
+
+    # Returns whether the item (PipboyValue or pipId) has any of the given filter categories
+    def isInCategory(self, item, categories):
+        pipId = item if type(item) == int else item.pipId
+        self._lock.acquire()
+        try:
+            self._sync()
+            entry = self._entries.get(pipId)
+            return entry != None and (entry[4] & categories) != 0
+        finally:
+            self._lock.release()
+
+    # Returns a list of all indexed items
+    def items(self):
+        self._lock.acquire()
+        try:
+            self._sync()
+            return [e[0] for e in self._entries.values()]
+        finally:
+            self._lock.release()
+
+    # registers a listener that gets called after data updates that changed inventory items
+    #
+    # signature: listener(addedItems, changedItems, removedPipIds)
+    def registerItemsChangedListener(self, listener):
+        self._lock.acquire()
+        try:
+            # Items that are already known are not reported
+            self._sync()
+            self._listeners.add(listener)
+            self.datamanager.registerUpdateAppliedListener(self._onUpdateApplied)
+        finally:
+            self._lock.release()
+
+    # unregisters an items changed listener
+    def unregisterItemsChangedListener(self, listener):
+        self._lock.acquire()
+        try:
+            self._listeners.discard(listener)
+            if len(self._listeners) == 0:
+                self.datamanager.unregisterUpdateAppliedListener(self._onUpdateApplied)
+        finally:
+            self._lock.release()
+
+    def _lookup(self, index, key):
+        self._lock.acquire()
+        try:
+            self._sync()
+            return list(index.get(key, dict()).values())
+        finally:
+            self._lock.release()
+
+    def _onUpdateApplied(self):
+        self._lock.acquire()
+        try:
+            self._sync()
+            added, changed, removed = self._added, list(self._changed), self._removed
+            self._added = []
+            self._changed = set()
+            self._removed = []
+            listeners = list(self._listeners)
+        finally:
+            self._lock.release()
+        if len(added) > 0 or len(changed) > 0 or len(removed) > 0:
+            for listener in listeners:
+                listener(added, changed, removed)
+
+    def _onItemAdded(self, item):
+        self._addEntry(item)
+        if len(self._listeners) > 0:
+            self._added.append(item)
+
+    def _onItemChanged(self, item):
+        self._removeEntry(item.pipId)
+        self._addEntry(item)
+        if len(self._listeners) > 0:
+            self._changed.add(item)
+
+    def _onItemRemoved(self, pipId):
+        self._removeEntry(pipId)
+        if len(self._listeners) > 0:
+            self._removed.append(pipId)
+
+    def _addEntry(self, item):
+        pipId = item.pipId
+        handleId = _itemChildValue(item, 'HandleID', None)
+        formId = _itemChildValue(item, 'formID', None)
+        name = _itemChildValue(item, 'text', None)
+        if type(name) == str:
+            name = name.lower()
+        flags = _itemChildValue(item, 'filterFlag', 0)
+        self._entries[pipId] = (item, handleId, formId, name, flags)
+        if handleId != None:
+            self._byHandleId[handleId] = item
+        if formId != None:
+            self._byFormId.setdefault(formId, dict())[pipId] = item
+        if name != None:
+            self._byName.setdefault(name, dict())[pipId] = item
+        for bit in _filterCategoryBits(flags):
+            self._byCategory.setdefault(bit, dict())[pipId] = item
+
+    def _removeEntry(self, pipId):
+        entry = self._entries.pop(pipId, None)
+        if entry == None:
+            return
+        item, handleId, formId, name, flags = entry
+        if handleId != None and self._byHandleId.get(handleId) is item:
+            del self._byHandleId[handleId]
+        self._removeFrom(self._byFormId, formId, pipId)
+        self._removeFrom(self._byName, name, pipId)
+        for bit in _filterCategoryBits(flags):
+            self._removeFrom(self._byCategory, bit, pipId)
+
+    @staticmethod
+    def _removeFrom(index, key, pipId):
+        entries = index.get(key)
+        if entries != None:
+            entries.pop(pipId, None)
+            if len(entries) == 0:
+                del index[key]
+
+
+
+# Inventory totals that are updated incrementally from value updated events
+# Every item contributes weight * count and value * count to the totals and one to the
+# count of each of its filter categories. When an item changes, only its old contribution
+# is subtracted and its new one added (weight and value are read through the item card cache).
+class InventoryAggregates(_InventoryTracker):
+
+    def __init__(self, datamanager):
+        # pipId -> (weight * count, value * count, count, filterFlag)
+        self._contributions = dict()
+        self._totalWeight = 0.0
+        self._totalValue = 0.0
+        self._totalCount = 0
+        # category bit -> number of items
+        self._categoryCounts = dict()
+        super().__init__(datamanager)
+
+    # Returns the sum of weight * count over all items
+    def totalWeight(self):
+        self._lock.acquire()
+        try:
+            self._sync()
+            return self._totalWeight
+        finally:
+            self._lock.release()
+
+    # Returns the sum of value * count over all items
+    def totalValue(self):
+        self._lock.acquire()
+        try:
+            self._sync()
+            return self._totalValue
+        finally:
+            self._lock.release()
+
+    # Returns the sum of the counts of all items
+    def totalCount(self):
+        self._lock.acquire()
+        try:
+            self._sync()
+            return self._totalCount
+        finally:
+            self._lock.release()
+
+    # Returns the number of items with the given filter category (a single bit)
+    def categoryCount(self, category):
+        self._lock.acquire()
+        try:
+            self._sync()
+            return self._categoryCounts.get(category, 0)
+        finally:
+            self._lock.release()
+
+    # Returns a dict eItemFilterCategory value -> number of items
+    def categoryCounts(self):
+        self._lock.acquire()
+        try:
+            self._sync()
+            retval = dict()
+            for c in _allItemFilterCategories():
+                retval[c] = self._categoryCounts.get(c, 0)
+            return retval
+        finally:
+            self._lock.release()
+
+    def _onItemAdded(self, item):
+        self._addContribution(item)
+
+    def _onItemChanged(self, item):
+        self._removeContribution(item.pipId)
+        self._addContribution(item)
+
+    def _onItemRemoved(self, pipId):
+        self._removeContribution(pipId)
+        if len(self._contributions) == 0:
+            # Do not carry rounding errors over
+            self._totalWeight = 0.0
+            self._totalValue = 0.0
+
+    def _addContribution(self, item):
+        count = _itemChildValue(item, 'count', 0)
+        if type(count) != int:
+            count = 0
+        flags = _itemChildValue(item, 'filterFlag', 0)
+        weight = itemFindItemCardInfoValue(item, eItemCardInfoValueText.Weight)
+        value = itemFindItemCardInfoValue(item, eItemCardInfoValueText.Value)
+        weight = weight * count if type(weight) in (int, float) else 0.0
+        value = value * count if type(value) in (int, float) else 0.0
+        self._contributions[item.pipId] = (weight, value, count, flags)
+        self._totalWeight += weight
+        self._totalValue += value
+        self._totalCount += count
+        for bit in _filterCategoryBits(flags):
+            self._categoryCounts[bit] = self._categoryCounts.get(bit, 0) + 1
+
+    def _removeContribution(self, pipId):
+        contribution = self._contributions.pop(pipId, None)
+        if contribution == None:
+            return
+        weight, value, count, flags = contribution
+        self._totalWeight -= weight
+        self._totalValue -= value
+        self._totalCount -= count
+        for bit in _filterCategoryBits(flags):
+            self._categoryCounts[bit] -= 1
+            if self._categoryCounts[bit] == 0:
+                del self._categoryCounts[bit]
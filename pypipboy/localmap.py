@@ -0,0 +1,493 @@
+# -*- coding: utf-8 -*-
+
+import os
+import math
+import threading
+import logging
+import collections
+import concurrent.futures
+import re
+import hashlib
+import struct
+import zlib
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+
+
+# Returns the 8-bit grayscale pixels of a LocalMapUpdate as rows of width bytes
+# (the game may send rows with padding)
+def localMapPixels(lmap):
+    pixels = lmap.pixels
+    if lmap.height <= 0 or lmap.width <= 0:
+        return bytes()
+    stride = len(pixels) // lmap.height
+    if stride == lmap.width:
+        return bytes(pixels[:lmap.width * lmap.height])
+    return b''.join(bytes(pixels[y * stride:y * stride + lmap.width]) for y in range(lmap.height))
+
+
+# Scales 8-bit grayscale pixels (rows of width bytes) to the given size (nearest neighbour)
+def resamplePixels(pixels, width, height, newWidth, newHeight):
+    if width == newWidth and height == newHeight:
+        return pixels
+    if numpy != None:
+        src = numpy.frombuffer(pixels, dtype = numpy.uint8).reshape(height, width)
+        ys = (numpy.arange(newHeight) * height) // newHeight
+        xs = (numpy.arange(newWidth) * width) // newWidth
+        return src[ys[:, None], xs].tobytes()
+    xs = [(x * width) // newWidth for x in range(newWidth)]
+    rows = []
+    for y in range(newHeight):
+        offset = ((y * height) // newHeight) * width
+        row = pixels[offset:offset + width]
+        rows.append(bytes(row[x] for x in xs))
+    return b''.join(rows)
+
+
+# Returns the worldspace the player is currently in as seen by the data manager ('' when unknown)
+# Interior cells have their own coordinate systems, so they are separate worldspaces
+# (e.g. 'Commonwealth/Vault 111', CurrCell is empty in exteriors).
+def localMapWorldspace(datamanager):
+    worldspace = datamanager.getPipValueByPath('Map/CurrWorldspace')
+    cell = datamanager.getPipValueByPath('Map/CurrCell')
+    retval = str(worldspace.value()) if worldspace and worldspace.value() != None else ''
+    if cell and cell.value():
+        retval += '/' + str(cell.value())
+    return retval
+
+
+# Encodes 8-bit grayscale pixels (rows of width bytes) as PNG image
+def encodeGrayscalePng(pixels, width, height, compression = 6):
+    def chunk(chunkType, data):
+        return struct.pack('>I', len(data)) + chunkType + data + struct.pack('>I', zlib.crc32(chunkType + data) & 0xffffffff)
+    # Every row starts with its filter type (0: none)
+    raw = b''.join(b'\x00' + pixels[y * width:(y + 1) * width] for y in range(height))
+    return (b'\x89PNG\r\n\x1a\n'
+            + chunk(b'IHDR', struct.pack('>IIBBBBB', width, height, 8, 0, 0, 0, 0))
+            + chunk(b'IDAT', zlib.compress(raw, compression))
+            + chunk(b'IEND', b''))
+
+
+
+# Local map frame processed by a LocalMapPipeline
+class LocalMapImage:
+    def __init__(self, seq, width, height, nw, ne, sw, pixels, png, worldspace = ''):
+        # Number of the frame, increases with every received frame
+        self.seq = seq
+        self.width = width
+        self.height = height
+        # World space extents (as in LocalMapUpdate)
+        self.nw = nw
+        self.ne = ne
+        self.sw = sw
+        # 8-bit grayscale pixels, rows of width bytes
+        self.pixels = pixels
+        # PNG encoded image or None
+        self.png = png
+        # Worldspace of the frame (see localMapWorldspace())
+        self.worldspace = worldspace
+
+
+
+# Processes local map updates in a thread pool, so the data manager's dispatch thread
+# (and with it all data updates) is never blocked by image processing.
+# Frames are converted, scaled to size (width, height) and PNG encoded by the worker
+# threads. When all workers are busy only the latest frame is kept, older ones are dropped.
+# Results are cached by the hash of the frame's pixels, so unchanged frames are not processed
+# again. Listeners are called from the worker threads, one frame at a time and never with an
+# older frame than the last delivered one.
+class LocalMapPipeline:
+
+    DEFAULT_WORKERS = 2
+    DEFAULT_CACHE_SIZE = 16
+
+    # size: (width, height) of the produced images, None to keep the size of the frames
+    # encodePng: whether to produce PNG images
+    def __init__(self, datamanager, size = None, workers = DEFAULT_WORKERS, cacheSize = DEFAULT_CACHE_SIZE, encodePng = True):
+        self.datamanager = datamanager
+        self.size = size
+        self.workers = workers
+        self.cacheSize = cacheSize
+        self.encodePng = encodePng
+        self.processedCount = 0
+        self.droppedCount = 0
+        self.cacheHits = 0
+        self._executor = concurrent.futures.ThreadPoolExecutor(max_workers = workers)
+        self._lock = threading.Lock()
+        self._seq = 0
+        self._deliveredSeq = 0
+        self._deliveryPending = None
+        self._delivering = False
+        self._busy = 0
+        self._pending = None
+        self._cache = collections.OrderedDict()
+        self._listeners = set()
+        self._closed = False
+        self._logger = logging.getLogger('pypipboy.localmap')
+        self.datamanager.registerLocalMapListener(self._onLocalMapUpdate)
+
+    # registers a listener that gets called with every processed frame
+    # Listeners are called on the worker threads, one frame at a time in the order of the frames.
+    # While a listener is running, newer frames are still processed, but only the latest one is
+    # delivered next.
+    #
+    # signature: listener(image), image is a LocalMapImage
+    def registerImageListener(self, listener):
+        self._lock.acquire()
+        self._listeners.add(listener)
+        self._lock.release()
+
+    # unregisters an image listener
+    def unregisterImageListener(self, listener):
+        self._lock.acquire()
+        try:
+            self._listeners.remove(listener)
+        except:
+            pass
+        self._lock.release()
+
+    # Queues a LocalMapUpdate for processing (frames of the data manager are queued automatically)
+    # worldspace: worldspace of the frame, None to take it from the data manager
+    def submit(self, lmap, worldspace = None):
+        if worldspace == None:
+            worldspace = localMapWorldspace(self.datamanager)
+        self._lock.acquire()
+        try:
+            if self._closed:
+                return
+            self._seq += 1
+            frame = (self._seq, lmap, worldspace)
+            if self._busy < self.workers:
+                self._busy += 1
+                self._executor.submit(self._work, frame)
+            else:
+                if self._pending:
+                    self.droppedCount += 1
+                self._pending = frame
+        finally:
+            self._lock.release()
+
+    # Stops processing, waits for the running workers
+    def close(self):
+        self.datamanager.unregisterLocalMapListener(self._onLocalMapUpdate)
+        self._lock.acquire()
+        self._closed = True
+        self._pending = None
+        self._lock.release()
+        self._executor.shutdown(wait = True)
+
+
+    ######## Internals Begin ##############
+
+    def _onLocalMapUpdate(self, lmap):
+        self.submit(lmap)
+
+    def _work(self, frame):
+        while frame:
+            seq, lmap, worldspace = frame
+            try:
+                if seq > self._deliveredSeq:
+                    image = self._process(seq, lmap, worldspace)
+                    self._deliver(image)
+            except Exception as e:
+                self._logger.warning('Could not process local map frame: ' + str(e))
+            self._lock.acquire()
+            frame = self._pending
+            self._pending = None
+            if not frame:
+                self._busy -= 1
+            self._lock.release()
+
+    def _process(self, seq, lmap, worldspace):
+        size = self.size if self.size else (lmap.width, lmap.height)
+        key = (hashlib.sha1(lmap.pixels).digest(), lmap.width, lmap.height, size, self.encodePng)
+        self._lock.acquire()
+        cached = self._cache.get(key)
+        if cached:
+            self._cache.move_to_end(key)
+            self.cacheHits += 1
+        self._lock.release()
+        if not cached:
+            pixels = resamplePixels(localMapPixels(lmap), lmap.width, lmap.height, size[0], size[1])
+            png = encodeGrayscalePng(pixels, size[0], size[1]) if self.encodePng else None
+            cached = (pixels, png)
+            self._lock.acquire()
+            self.processedCount += 1
+            self._cache[key] = cached
+            while len(self._cache) > self.cacheSize:
+                self._cache.popitem(last = False)
+            self._lock.release()
+        return LocalMapImage(seq, size[0], size[1], lmap.nw, lmap.ne, lmap.sw, cached[0], cached[1], worldspace)
+
+    # Images are handed over to one delivering worker at a time, which calls the listeners in
+    # order of the frames. Images that are overtaken while waiting are dropped.
+    def _deliver(self, image):
+        self._lock.acquire()
+        try:
+            if image.seq <= self._deliveredSeq:
+                # A newer frame has been queued by another worker
+                self.droppedCount += 1
+                return
+            self._deliveredSeq = image.seq
+            if self._deliveryPending:
+                self.droppedCount += 1
+            self._deliveryPending = image
+            if self._delivering:
+                return
+            self._delivering = True
+            while self._deliveryPending:
+                image = self._deliveryPending
+                self._deliveryPending = None
+                listeners = list(self._listeners)
+                self._lock.release()
+                try:
+                    for listener in listeners:
+                        try:
+                            listener(image)
+                        except Exception as e:
+                            self._logger.warning('Local map image listener failed: ' + str(e))
+                finally:
+                    self._lock.acquire()
+            self._delivering = False
+        finally:
+            self._lock.release()
+
+
+
+# World space mosaic of all local map frames that have been seen
+# Frames are placed into square tiles of TILE_SIZE pixels by their nw, ne and sw extents,
+# newer frames overwrite older ones. Any region that has already been seen can be read
+# back with getRegion(), without requesting new snapshots from the game.
+# Every worldspace (see localMapWorldspace()) has its own tiles, regions are read from the
+# worldspace of the latest frame unless another one is given.
+# At most maxTiles tiles are kept in memory (least recently used ones are evicted once a
+# frame has been placed). With a cacheDir, evicted tiles are written to disk and loaded again 
+# when needed, so the mosaic also survives sessions (call flush() or close() to save all tiles).
+# Frames are usually taken from a LocalMapPipeline, so they are processed by its workers.
+#
+# usage:  pipeline = LocalMapPipeline(datamanager, encodePng = False)
+#         mosaic = LocalMapMosaic(pipeline, cacheDir = 'mapcache')
+#         image = mosaic.getRegion(x0, y0, x1, y1, 512, 512)
+class LocalMapMosaic:
+
+    TILE_SIZE = 256
+    DEFAULT_UNITS_PER_PIXEL = 8.0
+    DEFAULT_MAX_TILES = 256
+
+    class _Tile:
+        def __init__(self, pixels, mask):
+            self.pixels = pixels
+            # Pixels that have been seen
+            self.mask = mask
+            self.dirty = False
+
+    # pipeline: LocalMapPipeline the frames are taken from (None: frames are added with addFrame())
+    # unitsPerPixel: world units per mosaic pixel
+    def __init__(self, pipeline = None, unitsPerPixel = DEFAULT_UNITS_PER_PIXEL, maxTiles = DEFAULT_MAX_TILES, cacheDir = None):
+        if numpy == None:
+            raise Exception('LocalMapMosaic requires numpy')
+        self.pipeline = pipeline
+        self.unitsPerPixel = float(unitsPerPixel)
+        self.maxTiles = maxTiles
+        self.cacheDir = None
+        self.frameCount = 0
+        # Worldspace of the latest frame
+        self.worldspace = ''
+        self._tiles = collections.OrderedDict()
+        self._lock = threading.RLock()
+        self._logger = logging.getLogger('pypipboy.localmap')
+        if cacheDir:
+            self.cacheDir = os.path.join(cacheDir, '%g_%i' % (self.unitsPerPixel, self.TILE_SIZE))
+            os.makedirs(self.cacheDir, exist_ok = True)
+        if pipeline:
+            pipeline.registerImageListener(self.addFrame)
+
+    # Places a frame (LocalMapImage or LocalMapUpdate) into the mosaic
+    # worldspace: worldspace of the frame, None for the worldspace of a LocalMapImage 
+    #             (LocalMapUpdates are placed into the worldspace of the latest frame)
+    def addFrame(self, frame, worldspace = None):
+        if isinstance(frame, LocalMapImage):
+            pixels = frame.pixels
+            if worldspace == None:
+                worldspace = frame.worldspace
+        else:
+            pixels = localMapPixels(frame)
+        if frame.width <= 0 or frame.height <= 0 or len(pixels) < frame.width * frame.height:
+            return
+        src = numpy.frombuffer(pixels, dtype = numpy.uint8, count = frame.width * frame.height).reshape(frame.height, frame.width)
+        nw = numpy.array(frame.nw, dtype = numpy.float64)
+        east = numpy.array(frame.ne, dtype = numpy.float64) - nw
+        south = numpy.array(frame.sw, dtype = numpy.float64) - nw
+        matrix = numpy.array([[east[0], south[0]], [east[1], south[1]]])
+        if abs(numpy.linalg.det(matrix)) < 1e-9:
+            return
+        inverse = numpy.linalg.inv(matrix)
+        corners = [nw, nw + east, nw + south, nw + east + south]
+        x0, y0 = self._worldToMosaic(min(c[0] for c in corners), max(c[1] for c in corners))
+        x1, y1 = self._worldToMosaic(max(c[0] for c in corners), min(c[1] for c in corners))
+        x0, y0 = int(math.floor(x0)), int(math.floor(y0))
+        x1, y1 = int(math.ceil(x1)), int(math.ceil(y1))
+        size = self.TILE_SIZE
+        self._lock.acquire()
+        try:
+            if worldspace == None:
+                worldspace = self.worldspace
+            self.worldspace = worldspace
+            for ty in range(y0 // size, (y1 - 1) // size + 1):
+                for tx in range(x0 // size, (x1 - 1) // size + 1):
+                    # Mosaic pixels of this tile covered by the frame's bounding box
+                    ax0, ay0 = max(x0, tx * size), max(y0, ty * size)
+                    ax1, ay1 = min(x1, (tx + 1) * size), min(y1, (ty + 1) * size)
+                    mx, my = numpy.meshgrid(numpy.arange(ax0, ax1) + 0.5, numpy.arange(ay0, ay1) + 0.5)
+                    wx = mx * self.unitsPerPixel - nw[0]
+                    wy = -my * self.unitsPerPixel - nw[1]
+                    u = inverse[0, 0] * wx + inverse[0, 1] * wy
+                    v = inverse[1, 0] * wx + inverse[1, 1] * wy
+                    valid = (u >= 0.0) & (u < 1.0) & (v >= 0.0) & (v < 1.0)
+                    if not valid.any():
+                        continue
+                    px = numpy.minimum((u[valid] * frame.width).astype(numpy.int64), frame.width - 1)
+                    py = numpy.minimum((v[valid] * frame.height).astype(numpy.int64), frame.height - 1)
+                    tile = self._getTile((worldspace, tx, ty), True)
+                    pixelView = tile.pixels[ay0 - ty * size:ay1 - ty * size, ax0 - tx * size:ax1 - tx * size]
+                    maskView = tile.mask[ay0 - ty * size:ay1 - ty * size, ax0 - tx * size:ax1 - tx * size]
+                    pixelView[valid] = src[py, px]
+                    maskView[valid] = True
+                    tile.dirty = True
+            self.frameCount += 1
+            # Tiles of this frame are only evicted after all of them have been written
+            self._evictTiles()
+        finally:
+            self._lock.release()
+
+    # Returns the given world space region (x0 < x1: west to east, y0 > y1: north to south) 
+    # scaled to width x height as LocalMapImage, pixels that have not been seen are 0
+    # worldspace: None for the worldspace of the latest frame
+    def getRegion(self, x0, y0, x1, y1, width, height, worldspace = None):
+        if worldspace == None:
+            worldspace = self.worldspace
+        pixels, mask = self._sampleRegion(worldspace, x0, y0, x1, y1, width, height)
+        return LocalMapImage(0, width, height, (x0, y0), (x1, y0), (x0, y1), pixels.tobytes(), None, worldspace)
+
+    # Returns the fraction (0.0 - 1.0) of the given world space region that has been seen
+    # worldspace: None for the worldspace of the latest frame
+    def coverage(self, x0, y0, x1, y1, worldspace = None):
+        if worldspace == None:
+            worldspace = self.worldspace
+        width = max(1, int(round(abs(x1 - x0) / self.unitsPerPixel)))
+        height = max(1, int(round(abs(y0 - y1) / self.unitsPerPixel)))
+        pixels, mask = self._sampleRegion(worldspace, x0, y0, x1, y1, width, height)
+        return float(numpy.count_nonzero(mask)) / mask.size
+
+    # Returns the number of tiles in memory
+    def tileCount(self):
+        return len(self._tiles)
+
+    # Writes all changed tiles to the cache directory
+    def flush(self):
+        self._lock.acquire()
+        try:
+            for key, tile in self._tiles.items():
+                if tile.dirty:
+                    self._saveTile(key, tile)
+        finally:
+            self._lock.release()
+
+    # Stops taking frames from the pipeline and saves the tiles
+    def close(self):
+        if self.pipeline:
+            self.pipeline.unregisterImageListener(self.addFrame)
+        self.flush()
+
+
+    ######## Internals Begin ##############
+
+    # Mosaic pixel coordinates grow to the east and to the south
+    def _worldToMosaic(self, x, y):
+        return (x / self.unitsPerPixel, -y / self.unitsPerPixel)
+
+    def _sampleRegion(self, worldspace, x0, y0, x1, y1, width, height):
+        pixels = numpy.zeros((height, width), dtype = numpy.uint8)
+        mask = numpy.zeros((height, width), dtype = bool)
+        mx0, my0 = self._worldToMosaic(x0, y0)
+        mx1, my1 = self._worldToMosaic(x1, y1)
+        mx = numpy.floor(mx0 + (numpy.arange(width) + 0.5) * (mx1 - mx0) / width).astype(numpy.int64)
+        my = numpy.floor(my0 + (numpy.arange(height) + 0.5) * (my1 - my0) / height).astype(numpy.int64)
+        size = self.TILE_SIZE
+        self._lock.acquire()
+        try:
+            for ty in numpy.unique(my // size):
+                rows = numpy.nonzero(my // size == ty)[0]
+                for tx in numpy.unique(mx // size):
+                    tile = self._getTile((worldspace, int(tx), int(ty)), False)
+                    if not tile:
+                        continue
+                    cols = numpy.nonzero(mx // size == tx)[0]
+                    ry = (my[rows] - ty * size)[:, None]
+                    rx = (mx[cols] - tx * size)[None, :]
+                    pixels[rows[:, None], cols[None, :]] = tile.pixels[ry, rx]
+                    mask[rows[:, None], cols[None, :]] = tile.mask[ry, rx]
+            self._evictTiles()
+        finally:
+            self._lock.release()
+        return (pixels, mask)
+
+    # Returns the tile with the given key (worldspace, x, y), loading it from the cache directory if necessary
+    # Must be called with self._lock acquired
+    def _getTile(self, key, create):
+        tile = self._tiles.get(key)
+        if tile:
+            self._tiles.move_to_end(key)
+            return tile
+        tile = self._loadTile(key)
+        if not tile:
+            if not create:
+                return None
+            tile = self._Tile(numpy.zeros((self.TILE_SIZE, self.TILE_SIZE), dtype = numpy.uint8),
+                              numpy.zeros((self.TILE_SIZE, self.TILE_SIZE), dtype = bool))
+        self._tiles[key] = tile
+        return tile
+
+    # Evicts the least recently used tiles above maxTiles
+    # Must be called with self._lock acquired
+    def _evictTiles(self):
+        while len(self._tiles) > self.maxTiles:
+            oldKey, oldTile = self._tiles.popitem(last = False)
+            if oldTile.dirty:
+                self._saveTile(oldKey, oldTile)
+
+    # Tiles are stored in one directory per worldspace
+    def _tilePath(self, key):
+        worldspace = re.sub(r'[^A-Za-z0-9_.-]', '_', key[0]) if key[0] else '_'
+        return os.path.join(self.cacheDir, worldspace, '%i_%i.npz' % key[1:])
+
+    def _loadTile(self, key):
+        if not self.cacheDir:
+            return None
+        path = self._tilePath(key)
+        if not os.path.isfile(path):
+            return None
+        try:
+            with numpy.load(path) as data:
+                return self._Tile(data['pixels'].copy(), data['mask'].copy())
+        except Exception as e:
+            self._logger.warning('Could not load local map tile %s: %s', path, e)
+            return None
+
+    def _saveTile(self, key, tile):
+        if not self.cacheDir:
+            return
+        path = self._tilePath(key)
+        tmppath = path + '.tmp'
+        try:
+            os.makedirs(os.path.dirname(path), exist_ok = True)
+            with open(tmppath, 'wb') as f:
+                numpy.savez_compressed(f, pixels = tile.pixels, mask = tile.mask)
+            os.replace(tmppath, path)
+            tile.dirty = False
+        except Exception as e:
+            self._logger.warning('Could not save local map tile %s: %s', path, e)
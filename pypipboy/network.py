@@ -8,7 +8,8 @@ import logging
 import queue
 import struct
 import traceback, sys
-from pypipboy.types import eMessageType
+from pypipboy.types import eMessageType, ePyPipboyMessageType
+from pypipboy import extensions
 
 
 
@@ -21,6 +22,59 @@ class NetworkMessage:
 
 
 
+# Returns the wire representation (header + payload) of the given message
+def encodeMessage(msg):
+    data = struct.pack("<IB", msg.payloadSize, msg.msgType)
+    if msg.payload and len(msg.payload) > 0:
+        data = data + msg.payload
+    return data
+
+
+
+# Splits a received byte stream into messages
+class MessageFramer:
+    
+    HEADER_SIZE = 5
+    # The biggest messages of the game (initial data of big save games) have a few MiB
+    DEFAULT_MAX_PAYLOAD_SIZE = 64 * 1024 * 1024
+    
+    # maxPayloadSize: messages with bigger payloads are refused (see feed())
+    def __init__(self, maxPayloadSize = DEFAULT_MAX_PAYLOAD_SIZE):
+        self.maxPayloadSize = maxPayloadSize
+        self._buffer = bytearray()
+    
+    # Adds received data and returns the list of completed messages
+    # Raises an exception when a message exceeds maxPayloadSize, the connection should 
+    # then be closed (the buffer never holds more than one message of that size)
+    def feed(self, data):
+        self._buffer += data
+        retval = []
+        offset = 0
+        size = len(self._buffer)
+        while size - offset >= self.HEADER_SIZE:
+            payload_size, msg_type = struct.unpack_from("<IB", self._buffer, offset)
+            if payload_size > self.maxPayloadSize:
+                if len(retval) > 0:
+                    # The completed messages are returned first, the next call raises
+                    break
+                self._buffer = bytearray()
+                raise Exception('Message payload of ' + str(payload_size) + ' bytes exceeds the limit of ' + str(self.maxPayloadSize) + ' bytes')
+            end = offset + self.HEADER_SIZE + payload_size
+            if end > size:
+                break
+            payload = bytes(self._buffer[offset + self.HEADER_SIZE:end])
+            retval.append(NetworkMessage(msg_type, payload_size, payload))
+            offset = end
+        if offset > 0:
+            del self._buffer[:offset]
+        return retval
+    
+    # Returns the number of buffered bytes not yet belonging to a complete message
+    def pendingBytes(self):
+        return len(self._buffer)
+
+
+
 # Implements the network client
 class NetworkChannel:
 
@@ -33,9 +87,15 @@ class NetworkChannel:
     
     KEEP_ALIVE_TIMER = 2
     
+    RECEIVE_SIZE = 65536
+    
     # Constructor
     def __init__(self):
+        # Connections sending bigger messages are closed (see MessageFramer)
+        self.maxPayloadSize = MessageFramer.DEFAULT_MAX_PAYLOAD_SIZE
         self._data_socket = None
+        self._framer = None
+        self._receivedMessages = []
         self.isConnected = False
         self._receiveThread = None
         self._receiveThreadFlag = False
@@ -46,9 +106,17 @@ class NetworkChannel:
         self._messageQueue = None
         self._connectionListeners = set()
         self._messageListeners = set()
+        self._sendLock = threading.Lock()
+        self.profiler = None
         self._aboutToConnect = False
         self.hostLang = None
         self.hostVersion = None
+        # PyPipboy extension features (see pypipboy.extensions)
+        self.requestedFeatures = set()
+        self.helloOptions = dict()
+        self.hostFeatures = set()
+        self.enabledFeatures = set()
+        self._lastLocalMapPayload = None
         self._logger = logging.getLogger('pypipboy.network.channel')
         
     # Returns a list of dicts representing the discovered hosts 
@@ -93,30 +161,23 @@ class NetworkChannel:
                 self._data_socket = data_socket
                 data_socket.settimeout(15)
                 data_socket.connect((addr, port)) 
-                # Reveice host message header, should be 5 bytes
-                expected = 5
-                msg_header = bytes()
+                # Reveice the host's answer, messages received with it are kept for the receive thread
+                framer = MessageFramer(self.maxPayloadSize)
+                messages = []
                 try:
-                    while expected > 0:
-                        tmp = data_socket.recv(expected)
+                    while len(messages) == 0:
+                        tmp = data_socket.recv(self.RECEIVE_SIZE)
                         if len(tmp) == 0:
                             raise Exception('Host terminated connection.')
-                        expected -= len(tmp)
-                        msg_header = msg_header + tmp
+                        messages = framer.feed(tmp)
                 except Exception as e:
                     self._doLostConnection(-1, str(e) + ' (' + str(type(e)) + ')')
                 self._aboutToConnect = False
-                if len(msg_header) == 5:
-                    # Parse header
-                    payload_size = struct.unpack("<I",msg_header[0:4])[0]
-                    msg_type = struct.unpack("<B",bytes([msg_header[4]]))[0]
-                    # Reveice payload
-                    payload = bytes()
-                    expected = payload_size
-                    while expected > 0:
-                        tmp = data_socket.recv(expected)
-                        expected -= len(tmp)
-                        payload = payload + tmp
+                if len(messages) > 0:
+                    msg_type = messages[0].msgType
+                    payload = messages[0].payload
+                    self._framer = framer
+                    self._receivedMessages = messages[1:]
                     # Check success
                     if msg_type == eMessageType.CONNECTION_ACCEPTED:
                         resp = json.loads(payload.decode("utf-8"))
@@ -127,6 +188,7 @@ class NetworkChannel:
                         self.hostPort = port
                         self.hostLang = resp['lang']
                         self.hostVersion = resp['version']
+                        self._negotiateFeatures(resp, data_socket)
                         return self._doEstablishedConnection(data_socket)
                     elif msg_type == eMessageType.CONNECTION_REFUSED:
                         data_socket.close()
@@ -161,14 +223,22 @@ class NetworkChannel:
     # sends an message over the network
     def sendMessage(self, msg, socket = None):
         if socket or self.isConnected:
-            data = struct.pack("<I", msg.payloadSize) + struct.pack("<B", msg.msgType)
-            if msg.payload and len(msg.payload) > 0:
-                data = data + msg.payload
+            data = encodeMessage(msg)
             if socket:
-                socket.send(data)
+                socket.sendall(data)
             else:
                 self._logger.debug('Sending message: %s', data)
-                self._data_socket.send(data)
+                # Requests may be sent from several threads at once
+                with self._sendLock:
+                    self._data_socket.sendall(data)
+
+    # Changes the subscribed subtrees on a PyPipboy relay (None: everything)
+    # Requires the FEATURE_SUBSCRIBE extension, the relay then resends the subscribed data.
+    def subscribe(self, paths):
+        if not extensions.FEATURE_SUBSCRIBE in self.enabledFeatures:
+            raise Exception('Subscriptions are not enabled for this connection')
+        payload = extensions.encodeSubscribe(paths)
+        self.sendMessage(NetworkMessage(ePyPipboyMessageType.SUBSCRIBE, len(payload), payload))
 
     # Registers a connection event listener
     def registerConnectionListener(self, listener):
@@ -192,6 +262,43 @@ class NetworkChannel:
         except:
             pass
     
+    # Internal function sending a HELLO when the host supports requested extension features
+    def _negotiateFeatures(self, resp, socket):
+        self.hostFeatures = set(resp.get('pypipboy', []))
+        self.enabledFeatures = self.hostFeatures & set(self.requestedFeatures)
+        self._lastLocalMapPayload = None
+        if len(self.enabledFeatures) > 0:
+            payload = extensions.encodeHello(self.enabledFeatures, self.helloOptions)
+            self.sendMessage(NetworkMessage(ePyPipboyMessageType.HELLO, len(payload), payload), socket)
+            self._logger.info('Enabled extension features: %s.', ', '.join(sorted(self.enabledFeatures)))
+    
+    # Internal function queueing a received message, extension messages are translated
+    # into the corresponding game protocol messages
+    def _queueMessage(self, msg):
+        if msg.msgType == ePyPipboyMessageType.COMPRESSED_BATCH:
+            try:
+                messages = MessageFramer().feed(extensions.decodeCompressedBatch(msg.payload))
+            except Exception as e:
+                self._logger.warning('Dropped bogus compressed batch: %s', e)
+                return
+            for m in messages:
+                if m.msgType != eMessageType.KEEP_ALIVE:
+                    self._queueMessage(m)
+            return
+        if msg.msgType == ePyPipboyMessageType.LOCAL_MAP_DIFF:
+            if self._lastLocalMapPayload == None:
+                self._logger.warning('Dropped local map diff without previous frame.')
+                return
+            try:
+                payload = extensions.decodeLocalMapDiff(self._lastLocalMapPayload, msg.payload)
+            except Exception as e:
+                self._logger.warning('Dropped bogus local map diff: %s', e)
+                return
+            msg = NetworkMessage(eMessageType.LOCAL_MAP_UPDATE, len(payload), payload)
+        if msg.msgType == eMessageType.LOCAL_MAP_UPDATE and extensions.FEATURE_LOCAL_MAP_DIFF in self.enabledFeatures:
+            self._lastLocalMapPayload = msg.payload
+        self._messageQueue.put(msg)
+    
     # Internal function executed after a application level connection has been established
     def _doEstablishedConnection(self, socket):
         self._fireConnectionEvent(True, 0, '')
@@ -215,7 +322,8 @@ class NetworkChannel:
             self._data_socket.close()
             self._data_socket = None
         self._dispatchThreadFlag = False
-        self._messageQueue.put(None)
+        if self._messageQueue:
+            self._messageQueue.put(None)
         self._fireConnectionEvent(False, errstatus, errmsg)
         return True
         
@@ -228,9 +336,13 @@ class NetworkChannel:
     
     # Internal function emitting message events to listeners    
     def _fireMessageEvent(self, msg):
+        profiler = self.profiler
         for listener in self._messageListeners:
             if listener[0] == None or listener[0] == msg.msgType:
-                listener[1](msg)
+                if profiler:
+                    profiler.call(profiler.MESSAGE, listener[1], (msg,))
+                else:
+                    listener[1](msg)
         
     # Internal thread function for receiving messages
     def _receiveMessageLoop(self):
@@ -239,59 +351,48 @@ class NetworkChannel:
             self._receiveThreadRunning = True
             lastKeepAliveTime = time.time()
             self._data_socket.settimeout(60)
+            framer = self._framer
+            messages = self._receivedMessages
+            self._receivedMessages = []
             while self._receiveThreadFlag:
-                # First receive message header, should be 5 bytes
-                expected = 5
-                msg_header = bytes()
-                try:
-                    while expected > 0:
-                        tmp = self._data_socket.recv(expected)
-                        if len(tmp) == 0:
-                            raise Exception('Host terminated connection.')
-                        expected -= len(tmp)
-                        msg_header = msg_header + tmp
-                except Exception as e:
-                    if self._receiveThreadFlag:
-                        self._doLostConnection(-2, str(e) + ' (' + str(type(e)) + ')')
-                    break
-                # Parse header
-                payload_size = struct.unpack("<I",msg_header[0:4])[0]
-                msg_type = struct.unpack("<B",bytes([msg_header[4]]))[0]
-                # Receive payload
-                expected = payload_size
-                payload = bytes()
-                try:
-                    while expected > 0:
-                        tmp = self._data_socket.recv(expected)
-                        if len(tmp) == 0:
+                if len(messages) == 0:
+                    try:
+                        data = self._data_socket.recv(self.RECEIVE_SIZE)
+                        if len(data) == 0:
                             raise Exception('Host terminated connection.')
-                        expected -= len(tmp)
-                        payload = payload + tmp
-                except Exception as e:
-                    if self._receiveThreadFlag:
-                        self._doLostConnection(-3, str(e) + ' (' + str(type(e)) + ')')
-                    break
-                self._logger.debug("Received message with type %i and size %i.", msg_type, payload_size)
-                if msg_type == eMessageType.KEEP_ALIVE:
-                    # Keep Alive works as follows:
-                    # The Server does not like it when I send a keep alive too early
-                    # Both server and client regularly send keep alives messages, when no other messages are send.
-                    # This means that the server may not send a keep alive message for a long time when enough other
-                    # messages are send. 
-                    # The server cuts the connection when no keep alive was received for some time.
-                    # Thus I use following keep alive strategy here.
-                    # When I receive a keep alive from the server, I send one back.
-                    # I keep a timer that runs out after some time, and is reset whenever I send a keep alive.
-                    # "hen a non keep-alive package has been received and the timer has run out, I send a keep alive
-                    self.sendMessage(NetworkMessage(eMessageType.KEEP_ALIVE))
-                    lastKeepAliveTime = time.time()
-                else:
-                    # Put message into message queue
-                    self._messageQueue.put(NetworkMessage(msg_type, payload_size, payload))
-                    # Check keep alive timer
-                    if lastKeepAliveTime + self.KEEP_ALIVE_TIMER < time.time():
+                    except Exception as e:
+                        if self._receiveThreadFlag:
+                            self._doLostConnection(-2, str(e) + ' (' + str(type(e)) + ')')
+                        break
+                    try:
+                        messages = framer.feed(data)
+                    except Exception as e:
+                        if self._receiveThreadFlag:
+                            self._doLostConnection(-3, str(e) + ' (' + str(type(e)) + ')')
+                        break
+                for msg in messages:
+                    self._logger.debug("Received message with type %i and size %i.", msg.msgType, msg.payloadSize)
+                    if msg.msgType == eMessageType.KEEP_ALIVE:
+                        # Keep Alive works as follows:
+                        # The Server does not like it when I send a keep alive too early
+                        # Both server and client regularly send keep alives messages, when no other messages are send.
+                        # This means that the server may not send a keep alive message for a long time when enough other
+                        # messages are send. 
+                        # The server cuts the connection when no keep alive was received for some time.
+                        # Thus I use following keep alive strategy here.
+                        # When I receive a keep alive from the server, I send one back.
+                        # I keep a timer that runs out after some time, and is reset whenever I send a keep alive.
+                        # "hen a non keep-alive package has been received and the timer has run out, I send a keep alive
                         self.sendMessage(NetworkMessage(eMessageType.KEEP_ALIVE))
                         lastKeepAliveTime = time.time()
+                    else:
+                        # Put message into message queue
+                        self._queueMessage(msg)
+                        # Check keep alive timer
+                        if lastKeepAliveTime + self.KEEP_ALIVE_TIMER < time.time():
+                            self.sendMessage(NetworkMessage(eMessageType.KEEP_ALIVE))
+                            lastKeepAliveTime = time.time()
+                messages = []
             self._logger.debug("Shutting down receive thread.")
             self._receiveThreadRunning = False
         except:
@@ -301,6 +402,10 @@ class NetworkChannel:
                     
         
     
+    # Returns whether the current thread dispatches received messages (waiting for results there would dead-lock)
+    def _isDispatchThread(self):
+        return threading.current_thread() == self._dispatchThread
+    
     # Internal thread function for dispatching received message events
     def _dispatchMessageLoop(self):
         try:
@@ -0,0 +1,153 @@
+# -*- coding: utf-8 -*-
+
+import threading
+import logging
+import multiprocessing
+from multiprocessing import shared_memory
+from pypipboy.dataparser import DataUpdateParser, DataUpdateRecord
+
+
+
+# Entry point of the parser worker process
+# Receives (shared memory name, payload size) tuples, parses the payload and sends
+# back the list of (id, type, value) tuples.
+def _parserWorkerMain(conn):
+    shm = None
+    parser = DataUpdateParser()
+    try:
+        while True:
+            request = conn.recv()
+            if request == None:
+                break
+            name, size = request
+            if not shm or shm.name != name:
+                if shm:
+                    shm.close()
+                shm = shared_memory.SharedMemory(name = name)
+            records = []
+            try:
+                parser.parse(bytes(shm.buf[:size]), lambda r: records.append((r.id, r.type, r.value)))
+                conn.send((True, records))
+            except Exception as e:
+                conn.send((False, repr(e)))
+    except (EOFError, KeyboardInterrupt):
+        pass
+    finally:
+        if shm:
+            shm.close()
+
+
+
+# Drop-in replacement for DataUpdateParser that parses big payloads in a worker process
+# Payloads are passed through shared memory, the worker sends back the parsed records
+# which are then handed to the callback on the calling thread (tree application stays in
+# this process, as the PipboyValue objects live here). Payloads smaller than minOffloadSize
+# are parsed directly, as the round trip would cost more than it saves. When the worker
+# does not answer within timeout seconds, it is terminated and the payload is parsed locally.
+#
+# usage: PipboyDataManager(dataParser = ProcessDataUpdateParser())
+class ProcessDataUpdateParser:
+
+    MIN_OFFLOAD_SIZE = 64 * 1024
+    INITIAL_BUFFER_SIZE = 1024 * 1024
+    RESULT_TIMEOUT = 10.0
+
+    def __init__(self, minOffloadSize = MIN_OFFLOAD_SIZE, timeout = RESULT_TIMEOUT):
+        self.minOffloadSize = minOffloadSize
+        self.timeout = timeout
+        self._localParser = DataUpdateParser()
+        self._lock = threading.Lock()
+        self._process = None
+        self._conn = None
+        self._shm = None
+        self._logger = logging.getLogger('pypipboy.parseroffload')
+
+    def parse(self, data, callback):
+        if len(data) < self.minOffloadSize:
+            self._localParser.parse(data, callback)
+            return
+        self._lock.acquire()
+        try:
+            records = self._parseRemote(data)
+        finally:
+            self._lock.release()
+        if records == None:
+            self._localParser.parse(data, callback)
+        else:
+            for r in records:
+                callback(DataUpdateRecord(r[0], r[1], r[2]))
+
+    # Stops the worker process and releases the shared memory
+    def close(self):
+        self._lock.acquire()
+        try:
+            if self._process:
+                try:
+                    self._conn.send(None)
+                except OSError:
+                    pass
+                self._process.join(5)
+                self._conn.close()
+                self._process = None
+                self._conn = None
+            if self._shm:
+                self._shm.close()
+                self._shm.unlink()
+                self._shm = None
+        finally:
+            self._lock.release()
+
+
+    ######## Internals Begin ##############
+
+    # Must be called with self._lock acquired
+    # Returns the parsed records or None when the worker is not usable
+    def _parseRemote(self, data):
+        try:
+            if not self._process or not self._process.is_alive():
+                self._startWorker()
+            if not self._shm or self._shm.size < len(data):
+                self._resizeBuffer(len(data))
+            self._shm.buf[:len(data)] = data
+            self._conn.send((self._shm.name, len(data)))
+            if not self._conn.poll(self.timeout):
+                raise TimeoutError('No answer within ' + str(self.timeout) + ' seconds')
+            success, result = self._conn.recv()
+        except (OSError, EOFError) as e:
+            self._logger.warning('Parser worker failed, parsing locally: %s', e)
+            self._stopWorker()
+            return None
+        if not success:
+            raise RuntimeError('Parser worker: ' + result)
+        return result
+
+    def _startWorker(self):
+        context = multiprocessing.get_context('spawn')
+        self._conn, workerConn = context.Pipe()
+        self._process = context.Process(target = _parserWorkerMain, args = (workerConn,), daemon = True)
+        self._process.start()
+        workerConn.close()
+
+    # Drops a broken worker, it is restarted on the next offloaded payload
+    def _stopWorker(self):
+        if self._conn:
+            self._conn.close()
+            self._conn = None
+        if self._process:
+            if self._process.is_alive():
+                self._process.terminate()
+                self._process.join(1)
+            if self._process.is_alive():
+                # A stopped process ignores SIGTERM
+                self._process.kill()
+            self._process.join()
+            self._process = None
+
+    def _resizeBuffer(self, size):
+        if self._shm:
+            self._shm.close()
+            self._shm.unlink()
+        newSize = self.INITIAL_BUFFER_SIZE
+        while newSize < size:
+            newSize *= 2
+        self._shm = shared_memory.SharedMemory(create = True, size = newSize)
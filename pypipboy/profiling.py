@@ -0,0 +1,139 @@
+# -*- coding: utf-8 -*-
+
+import time
+import threading
+import itertools
+
+
+
+# Timing statistics for one listener or path
+class ProfilerStats:
+    def __init__(self, name):
+        self.name = name
+        self.calls = 0
+        self.totalTime = 0.0
+        self.maxTime = 0.0
+
+    # Returns the mean time per call in seconds
+    def meanTime(self):
+        if self.calls > 0:
+            return self.totalTime / self.calls
+        return 0.0
+
+    def _add(self, duration):
+        self.calls += 1
+        self.totalTime += duration
+        if duration > self.maxTime:
+            self.maxTime = duration
+
+    def __repr__(self):
+        return ('ProfilerStats(' + self.name + ', calls=' + str(self.calls) + ', total='
+                + str(self.totalTime) + ', max=' + str(self.maxTime) + ')')
+
+
+
+# Returns a readable name for the given listener
+def _listenerName(listener):
+    func = getattr(listener, '__func__', listener)
+    name = getattr(func, '__qualname__', None)
+    if not name:
+        return repr(listener)
+    module = getattr(func, '__module__', None)
+    if module:
+        name = module + '.' + name
+    return name
+
+
+
+# Measures the time spent in event listeners
+# Install it with PipboyDataManager.setProfiler(). Every event listener call of the data
+# manager, its values and its network channel is then routed through call(). Only every
+# n-th call (n = 1 / sampleRate) is timed, all other calls are passed through directly.
+# The time of a value updated event is also attributed to the path of the changed value.
+class ListenerProfiler:
+
+    # Stage names
+    VALUE_UPDATED = 'PipboyValue._fireValueUpdatedEvent'
+    DATAMANAGER_VALUE_UPDATED = 'PipboyDataManager._fireValueUpdatedEvent'
+    LOCAL_MAP_UPDATED = 'PipboyDataManager._fireLocalMapUpdatedEvent'
+    MESSAGE = 'NetworkChannel._fireMessageEvent'
+
+    def __init__(self, sampleRate = 1.0):
+        self._interval = max(1, int(round(1.0 / sampleRate))) if sampleRate > 0 else 0
+        # next() of itertools.count is atomic, listeners are called from several threads
+        self._counter = itertools.count(1)
+        self._listenerStats = dict()
+        self._pathStats = dict()
+        self._lock = threading.Lock()
+
+    # Calls listener(*args), timing it when the call is sampled
+    #    stage: name of the emitting function
+    #    value: changed PipboyValue (or None)
+    def call(self, stage, listener, args, value = None):
+        if self._interval == 0 or next(self._counter) % self._interval != 0:
+            return listener(*args)
+        start = time.perf_counter()
+        try:
+            return listener(*args)
+        finally:
+            duration = time.perf_counter() - start
+            self._record(stage, listener, value, duration)
+
+    # Returns the n listeners with the highest total time (or 'max' or 'mean' time)
+    # as list of ProfilerStats (named 'stage: listener')
+    def topListeners(self, n = 10, key = 'total'):
+        return self._top(self._listenerStats, n, key)
+
+    # Returns the n value paths with the highest total listener time as list of ProfilerStats
+    def hottestPaths(self, n = 10, key = 'total'):
+        return self._top(self._pathStats, n, key)
+
+    # Returns a printable report of the slowest listeners and hottest paths
+    def report(self, n = 10):
+        lines = ['Slowest listeners (sampled):']
+        for s in self.topListeners(n):
+            lines.append('  %10.6fs total  %10.6fs max  %8i calls  %s' % (s.totalTime, s.maxTime, s.calls, s.name))
+        lines.append('Hottest paths (sampled):')
+        for s in self.hottestPaths(n):
+            lines.append('  %10.6fs total  %10.6fs max  %8i calls  %s' % (s.totalTime, s.maxTime, s.calls, s.name))
+        return '\n'.join(lines)
+
+    # Clears all statistics
+    def reset(self):
+        self._lock.acquire()
+        self._listenerStats = dict()
+        self._pathStats = dict()
+        self._lock.release()
+
+
+    ######## Internals Begin ##############
+
+    def _record(self, stage, listener, value, duration):
+        name = stage + ': ' + _listenerName(listener)
+        path = value.pathStr() if value != None else None
+        self._lock.acquire()
+        stats = self._listenerStats.get(name)
+        if not stats:
+            stats = ProfilerStats(name)
+            self._listenerStats[name] = stats
+        stats._add(duration)
+        if path != None:
+            stats = self._pathStats.get(path)
+            if not stats:
+                stats = ProfilerStats(path)
+                self._pathStats[path] = stats
+            stats._add(duration)
+        self._lock.release()
+
+    def _top(self, statsMap, n, key):
+        self._lock.acquire()
+        stats = list(statsMap.values())
+        self._lock.release()
+        if key == 'max':
+            sortKey = lambda s: s.maxTime
+        elif key == 'mean':
+            sortKey = lambda s: s.meanTime()
+        else:
+            sortKey = lambda s: s.totalTime
+        stats.sort(key = sortKey, reverse = True)
+        return stats[:n]
@@ -0,0 +1,238 @@
+# -*- coding: utf-8 -*-
+
+import json
+import time
+import threading
+import collections
+import logging
+import traceback, sys
+from pypipboy.types import eMessageType, eRequestType
+from pypipboy.network import NetworkMessage
+
+
+
+# Forwards the commands of relay clients to the game
+# All commands are sent from one thread, so writes to the game are never interleaved.
+# Every client has a token bucket (rate commands per second, bursts up to burst commands),
+# commands above the rate are queued (at most MAX_QUEUED per client, further commands are
+# dropped) and clients are served round-robin. Request ids are replaced by ids of the data
+# manager's RpcManager, so results are only sent to the client that sent the command (with
+# its original id). Identical pending commands of DEDUPLICATED_REQUESTS types are sent only
+# once, their result is sent to every client that asked.
+class RelayCommandScheduler:
+
+    DEFAULT_RATE = 10.0
+    DEFAULT_BURST = 20
+    MAX_QUEUED = 32
+    RESULT_TIMEOUT = 30.0
+
+    # Request types without side effects that are worth to be sent only once
+    DEDUPLICATED_REQUESTS = set([eRequestType.RequestLocalMapSnapshot, eRequestType.CheckFastTravel, eRequestType.ClearIdle])
+
+    class _Command:
+        def __init__(self, msg, request, key):
+            self.msg = msg
+            # Parsed command (dict) or None for other messages
+            self.request = request
+            # Key for deduplication or None
+            self.key = key
+            # list of (endpoint, original request id)
+            self.requesters = []
+            self.deadline = None
+
+    class _Client:
+        def __init__(self, tokens):
+            self.tokens = tokens
+            self.lastRefill = time.time()
+            self.queue = collections.deque()
+
+    def __init__(self, datamanager, rate = DEFAULT_RATE, burst = DEFAULT_BURST):
+        self.datamanager = datamanager
+        self.rate = rate
+        self.burst = burst
+        self.droppedCount = 0
+        self.deduplicatedCount = 0
+        self._clients = dict()
+        # Clients in round-robin order
+        self._order = collections.deque()
+        # Pending commands by deduplication key
+        self._byKey = dict()
+        # Sent commands by upstream request id
+        self._inFlight = dict()
+        self._cond = threading.Condition()
+        self._thread = None
+        self._running = False
+        self._logger = logging.getLogger('pypipboy.relaycommands')
+
+    # Queues a message of a relay client for the game
+    def submit(self, endpoint, msg):
+        request = None
+        key = None
+        if msg.msgType == eMessageType.COMMAND:
+            try:
+                request = json.loads(msg.payload.decode('utf-8'))
+                if request.get('type') in self.DEDUPLICATED_REQUESTS:
+                    key = (request.get('type'), json.dumps(request.get('args'), sort_keys = True))
+            except Exception as e:
+                self._logger.warning('Relaying unparsable command of ' + str(endpoint.client_address) + ': ' + str(e))
+                request = None
+        self._cond.acquire()
+        try:
+            if key != None and key in self._byKey:
+                self._byKey[key].requesters.append((endpoint, request.get('id')))
+                self.deduplicatedCount += 1
+                return
+            client = self._clients.get(endpoint)
+            if not client:
+                client = self._Client(self.burst)
+                self._clients[endpoint] = client
+                self._order.append(endpoint)
+            if len(client.queue) >= self.MAX_QUEUED:
+                self.droppedCount += 1
+                self._logger.warning('Dropped command of ' + str(endpoint.client_address) + ', too many queued commands.')
+                return
+            command = self._Command(msg, request, key)
+            if request != None:
+                command.requesters.append((endpoint, request.get('id')))
+            if key != None:
+                self._byKey[key] = command
+            client.queue.append(command)
+            if not self._thread:
+                self._running = True
+                self._thread = threading.Thread(target = self._sendLoop, daemon = True)
+                self._thread.start()
+            self._cond.notify()
+        finally:
+            self._cond.release()
+
+    # Handles a COMMAND_RESULT of the game
+    # Returns True when the result belonged to a relayed command (it has then been sent to the requesters)
+    def handleResult(self, resp):
+        self._cond.acquire()
+        command = self._inFlight.pop(resp.get('id'), None)
+        if command and command.key != None:
+            self._byKey.pop(command.key, None)
+        self._cond.release()
+        if not command:
+            return False
+        for endpoint, requestId in command.requesters:
+            resp['id'] = requestId
+            payload = json.dumps(resp).encode('utf-8')
+            endpoint.sendMessage(NetworkMessage(eMessageType.COMMAND_RESULT, len(payload), payload))
+        return True
+
+    # Drops the queued commands of a closed endpoint
+    def removeEndpoint(self, endpoint):
+        self._cond.acquire()
+        client = self._clients.pop(endpoint, None)
+        if client:
+            self._order.remove(endpoint)
+            for command in client.queue:
+                command.requesters = [r for r in command.requesters if r[0] != endpoint]
+                if command.key != None and len(command.requesters) == 0:
+                    self._byKey.pop(command.key, None)
+            # Deduplicated commands of other clients may wait in this queue
+            for command in client.queue:
+                if len(command.requesters) > 0:
+                    self._requeue(command)
+        for command in list(self._byKey.values()) + list(self._inFlight.values()):
+            command.requesters = [r for r in command.requesters if r[0] != endpoint]
+        self._cond.release()
+
+    # Stops the sending thread, queued commands are dropped
+    def stop(self):
+        self._cond.acquire()
+        self._running = False
+        thread = self._thread
+        self._thread = None
+        self._clients.clear()
+        self._order.clear()
+        self._byKey.clear()
+        self._inFlight.clear()
+        self._cond.notify_all()
+        self._cond.release()
+        if thread:
+            thread.join()
+
+
+    ######## Internals Begin ##############
+
+    # Must be called with self._cond acquired
+    def _requeue(self, command):
+        endpoint = command.requesters[0][0]
+        client = self._clients.get(endpoint)
+        if client:
+            client.queue.appendleft(command)
+        elif command.key != None:
+            self._byKey.pop(command.key, None)
+
+    # Must be called with self._cond acquired
+    # Returns (next command or None, seconds till a token becomes available or None)
+    def _nextCommand(self, now):
+        wait = None
+        for i in range(len(self._order)):
+            endpoint = self._order[0]
+            self._order.rotate(-1)
+            client = self._clients[endpoint]
+            client.tokens = min(self.burst, client.tokens + (now - client.lastRefill) * self.rate)
+            client.lastRefill = now
+            if len(client.queue) == 0:
+                continue
+            if client.tokens >= 1.0:
+                client.tokens -= 1.0
+                return (client.queue.popleft(), None)
+            clientWait = (1.0 - client.tokens) / self.rate if self.rate > 0 else 1.0
+            if wait == None or clientWait < wait:
+                wait = clientWait
+        return (None, wait)
+
+    # Must be called with self._cond acquired
+    # Forgets sent commands whose result did not arrive in time
+    def _expire(self, now):
+        wait = None
+        for upstreamId, command in list(self._inFlight.items()):
+            if command.deadline <= now:
+                del self._inFlight[upstreamId]
+                if command.key != None:
+                    self._byKey.pop(command.key, None)
+            elif wait == None or command.deadline - now < wait:
+                wait = command.deadline - now
+        return wait
+
+    def _sendLoop(self):
+        try:
+            while True:
+                self._cond.acquire()
+                command = None
+                while self._running:
+                    now = time.time()
+                    expireWait = self._expire(now)
+                    command, wait = self._nextCommand(now)
+                    if command:
+                        break
+                    if wait == None or (expireWait != None and expireWait < wait):
+                        wait = expireWait
+                    self._cond.wait(wait)
+                if not self._running:
+                    self._cond.release()
+                    break
+                msg = command.msg
+                if command.request != None:
+                    # Rewrite the request id, the result is routed back by it
+                    upstreamId = self.datamanager.rpc.allocateRequestId()
+                    request = dict(command.request)
+                    request['id'] = upstreamId
+                    payload = json.dumps(request).encode('utf-8')
+                    msg = NetworkMessage(eMessageType.COMMAND, len(payload), payload)
+                    command.deadline = time.time() + self.RESULT_TIMEOUT
+                    self._inFlight[upstreamId] = command
+                self._cond.release()
+                self._logger.debug("Relaying client message with type %i and size %i.", msg.msgType, msg.payloadSize)
+                try:
+                    self.datamanager.networkchannel.sendMessage(msg)
+                except Exception as e:
+                    self._logger.warning('Could not relay client message: ' + str(e))
+        except:
+            traceback.print_exc(file=sys.stdout)
+            time.sleep(1) # Just to make sure that the error is correctly written into the log file
+            raise
@@ -0,0 +1,118 @@
+# -*- coding: utf-8 -*-
+
+from pypipboy.types import eValueType
+from pypipboy.dataparser import DataUpdateRecord
+
+
+
+# Returns the filter key for a list of subscribed paths ('PlayerInfo', 'Radio', ...)
+# Paths are case insensitive, the key is a sorted tuple of key tuples (None: no filter)
+def subscriptionKey(paths):
+    if paths == None:
+        return None
+    retval = set()
+    for path in paths:
+        keys = tuple(k.lower() for k in str(path).strip('/').split('/') if k != '')
+        if len(keys) == 0:
+            # The root object has been subscribed
+            return None
+        retval.add(keys)
+    return tuple(sorted(retval))
+
+
+
+# Structure of the data tree (parent and child ids) as seen by a relay
+# It is built from DATA_UPDATE records, independently of the data manager, and is used to
+# reduce records to subscribed subtrees. The ancestors of a subscribed subtree are kept
+# consistent: their records only list children that lead to subscribed subtrees, so a client
+# never gets a reference to a value it does not receive. Subscribed paths can only go through
+# objects, a path leading through an array subscribes the whole array.
+class RelayTree:
+    def __init__(self):
+        # id -> parent id
+        self._parents = dict()
+        # object id -> dict lowercased key -> child id
+        self._children = dict()
+
+    # Updates the structure from a list of DataUpdateRecords
+    def applyRecords(self, records):
+        for r in records:
+            if r.type == eValueType.OBJECT:
+                children = self._children.get(r.id)
+                if children == None:
+                    children = dict()
+                    self._children[r.id] = children
+                for key, childId in r.value[0]:
+                    children[key.lower()] = childId
+                    self._parents[childId] = r.id
+                for childId in r.value[1]:
+                    for key, i in list(children.items()):
+                        if i == childId:
+                            del children[key]
+            else:
+                self._children.pop(r.id, None)
+                if r.type == eValueType.ARRAY:
+                    for childId in r.value:
+                        self._parents[childId] = r.id
+
+    # Returns the records belonging to the subscribed subtrees (see subscriptionKey())
+    def filterRecords(self, records, key):
+        if key == None:
+            return list(records)
+        roots, ancestors = self._resolve(key)
+        retval = []
+        memo = dict()
+        for r in records:
+            if self._inSubtree(r.id, roots, memo):
+                retval.append(r)
+            elif r.id in ancestors and r.type == eValueType.OBJECT:
+                added = [a for a in r.value[0] if a[1] in ancestors or a[1] in roots]
+                if len(added) > 0 or len(r.value[1]) > 0:
+                    retval.append(DataUpdateRecord(r.id, r.type, (added, r.value[1])))
+        return retval
+
+
+    ######## Internals Begin ##############
+
+    # Returns (subtree root ids, ids of their ancestors)
+    def _resolve(self, key):
+        roots = set()
+        ancestors = set()
+        if not 0 in self._children:
+            return (roots, ancestors)
+        for path in key:
+            nodeId = 0
+            chain = []
+            for k in path:
+                children = self._children.get(nodeId)
+                if children == None:
+                    # Arrays and primitive values are subscribed as a whole
+                    break
+                chain.append(nodeId)
+                nodeId = children.get(k)
+                if nodeId == None:
+                    break
+            if nodeId != None:
+                roots.add(nodeId)
+                ancestors.update(chain)
+        return (roots, ancestors)
+
+    def _inSubtree(self, pipId, roots, memo):
+        visited = []
+        retval = False
+        while pipId != None:
+            if pipId in roots:
+                retval = True
+                break
+            known = memo.get(pipId)
+            if known != None:
+                retval = known
+                break
+            visited.append(pipId)
+            if len(visited) > len(self._parents):
+                # Reused ids may form a cycle
+                break
+            pipId = self._parents.get(pipId)
+        for i in visited:
+            memo[i] = retval
+        return retval
@@ -4,12 +4,61 @@ import socket
 import socketserver
 import threading
 import logging
-import struct
 import time
+import math
 import traceback, sys
-from .network import NetworkMessage
+import selectors
+import collections
+import itertools
+import json
+from .network import NetworkMessage, MessageFramer, encodeMessage
 from .dataencoder import DataUpdateEncoder
-from .types import eMessageType
+from .dataparser import DataUpdateParser, DataUpdateRecord
+from .relayfilter import RelayTree, subscriptionKey
+from .relaycommands import RelayCommandScheduler
+from .types import eMessageType, ePyPipboyMessageType
+from . import extensions
+
+
+# Hashed timer wheel with a fixed tick
+# Scheduling and expiring an item is O(1), delays are rounded up to the next tick and
+# must be shorter than slots * tick.
+class _TimerWheel:
+    def __init__(self, tick, slots):
+        self.tick = tick
+        self._slots = [[] for i in range(slots)]
+        self._current = 0
+        self._nextTickTime = time.time() + tick
+    
+    def schedule(self, item, delay):
+        ticks = min(len(self._slots) - 1, max(1, int(math.ceil(delay / self.tick))))
+        self._slots[(self._current + ticks) % len(self._slots)].append(item)
+    
+    # Returns the seconds till the next tick
+    def timeUntilNextTick(self):
+        return max(0.0, self._nextTickTime - time.time())
+    
+    # Advances the wheel to the current time and returns the expired items
+    def advance(self):
+        expired = []
+        now = time.time()
+        while self._nextTickTime <= now:
+            self._current = (self._current + 1) % len(self._slots)
+            expired.extend(self._slots[self._current])
+            self._slots[self._current] = []
+            self._nextTickTime += self.tick
+        return expired
+
+
+
+# Returns the records as encoded DATA_UPDATE message (or None)
+def _encodeRecords(records):
+    if len(records) > 0:
+        encoder = DataUpdateEncoder()
+        msgtext = encoder.encode(records)
+        return encodeMessage(NetworkMessage(eMessageType.DATA_UPDATE, len(msgtext), msgtext))
+    return None
+
 
 
 class RelayController:
@@ -48,94 +97,621 @@ class RelayController:
             self.keepAliveThread.join()
             super().shutdown()
             
-    class _RelayRequestHandler(socketserver.BaseRequestHandler):
+    # Bounded send queue of a relay endpoint, shared by both relay backends
+    class _RelayEndpoint:
+        # Queue entry requesting the export of the whole data tree
+        _RESYNC = object()
+        
+        def _initSendQueue(self, controller):
+            self.controller = controller
+            self.datamanager = controller.datamanager
+            self._sendQueue = collections.deque()
+            self._queuedBytes = 0
+            self._queueCond = threading.Condition()
+            self._closed = False
+            self.resyncCount = 0
+            # Negotiated extension features and HELLO options
+            self.features = set()
+            self.options = dict()
+            # Subscribed subtrees (see relayfilter.subscriptionKey(), None: everything)
+            self.subscription = None
+            self._localMapPending = False
+            self._lastLocalMapTime = 0.0
+            self._lastLocalMapFrame = None
+            
+        def sendKeepAlive(self):
+            self.sendData(RelayController._KEEP_ALIVE_DATA)
+        
+        def sendMessage(self, msg):
+            self.sendData(encodeMessage(msg))
+        
+        # Queues already encoded message data, never blocks
+        # When the queue is full the slow client policy of the controller is applied
+        def sendData(self, data):
+            self._queueCond.acquire()
+            try:
+                if self._closed:
+                    return
+                if len(self._sendQueue) > 0 and (len(self._sendQueue) >= self.controller.maxQueueMessages
+                        or self._queuedBytes + len(data) > self.controller.maxQueueBytes):
+                    self._onQueueOverflow()
+                else:
+                    self._sendQueue.append(data)
+                    self._queuedBytes += len(data)
+                    self._onDataQueued()
+            finally:
+                self._queueCond.release()
+        
+        # Returns the number of queued bytes
+        def queuedBytes(self):
+            return self._queuedBytes
+        
+        # Must be called with self._queueCond acquired
+        def _onQueueOverflow(self):
+            if self.controller.slowClientPolicy == RelayController.SLOW_CLIENT_DISCONNECT:
+                self.controller._logger.warning('Relay endpoint ' + str(self.client_address) + ' is too slow, disconnecting.')
+                self._closeLocked()
+            else:
+                # The queued updates are replaced by the current state of the data tree
+                self.controller._logger.info('Relay endpoint ' + str(self.client_address) + ' is too slow, resyncing.')
+                self._sendQueue.clear()
+                self._queuedBytes = 0
+                self._sendQueue.append(self._RESYNC)
+                self.resyncCount += 1
+                self._onDataQueued()
+        
+        # Must be called with self._queueCond acquired
+        # Returns the next queued entry (encoded message data or _RESYNC)
+        def _popData(self):
+            data = self._sendQueue.popleft()
+            if data is not self._RESYNC:
+                self._queuedBytes -= len(data)
+            return data
+        
+        def _close(self):
+            self._queueCond.acquire()
+            self._closeLocked()
+            self._queueCond.release()
+        
+        # Must be called with self._queueCond acquired
+        # Returns (entries, batch, wait)
+        #    entries: list of queued entries to send next (encoded data or _RESYNC)
+        #    batch: whether the entries should be sent as COMPRESSED_BATCH
+        #    wait: seconds till a held back local map frame becomes due or None
+        def _takeNext(self, now):
+            data, wait = self._takeLocalMapData(now)
+            if data != None:
+                return ([data], False, wait)
+            if len(self._sendQueue) == 0:
+                return ([], False, wait)
+            if not extensions.FEATURE_COMPRESSED_BATCH in self.features:
+                return ([self._popData()], False, wait)
+            # Everything queued is sent as one batch, the slower the link the bigger the batches
+            entries = []
+            size = 0
+            while len(self._sendQueue) > 0 and size < RelayController.MAX_BATCH_SIZE:
+                entry = self._popData()
+                entries.append(entry)
+                if entry is not self._RESYNC:
+                    size += len(entry)
+            return (entries, True, wait)
+        
+        # Returns the data to write for entries returned by _takeNext() or None
+        def _encodeEntries(self, entries, batch):
+            parts = []
+            for entry in entries:
+                if entry is self._RESYNC:
+                    entry = self.controller._initialData(self.subscription)
+                if entry:
+                    parts.append(entry)
+            if len(parts) == 0:
+                return None
+            if not batch:
+                return b''.join(parts)
+            # Receivers reject batches above COMPRESSED_BATCH_MAX_SIZE, bigger messages are sent as they are
+            data = []
+            chunk = []
+            size = 0
+            for part in parts:
+                if len(chunk) > 0 and size + len(part) > extensions.COMPRESSED_BATCH_MAX_SIZE:
+                    data.append(self._encodeBatch(chunk))
+                    chunk = []
+                    size = 0
+                if len(part) > extensions.COMPRESSED_BATCH_MAX_SIZE:
+                    data.append(part)
+                else:
+                    chunk.append(part)
+                    size += len(part)
+            if len(chunk) > 0:
+                data.append(self._encodeBatch(chunk))
+            return b''.join(data)
+        
+        def _encodeBatch(self, parts):
+            payload = extensions.encodeCompressedBatch(parts)
+            return encodeMessage(NetworkMessage(ePyPipboyMessageType.COMPRESSED_BATCH, len(payload), payload))
+        
+        # Handles a message received from the client
+        def _onClientMessage(self, msg):
+            if msg.msgType == eMessageType.KEEP_ALIVE:
+                pass
+            elif msg.msgType == ePyPipboyMessageType.HELLO:
+                try:
+                    features, options = extensions.decodeHello(msg.payload)
+                except Exception as e:
+                    self.controller._logger.warning('Received bogus HELLO from ' + str(self.client_address) + ': ' + str(e))
+                    return
+                self.features = features & self.controller.extensionFeatures()
+                self.options = options
+                self.controller._logger.info('Relay endpoint ' + str(self.client_address) + ' enabled features: ' + ', '.join(sorted(self.features)))
+                if extensions.FEATURE_SUBSCRIBE in self.features:
+                    self.subscription = subscriptionKey(options.get(extensions.OPTION_SUBSCRIBE))
+            elif msg.msgType == ePyPipboyMessageType.SUBSCRIBE:
+                if extensions.FEATURE_SUBSCRIBE in self.features:
+                    try:
+                        subscription = subscriptionKey(extensions.decodeSubscribe(msg.payload))
+                    except Exception as e:
+                        self.controller._logger.warning('Received bogus SUBSCRIBE from ' + str(self.client_address) + ': ' + str(e))
+                        return
+                    self._resubscribe(subscription)
+            elif msg.msgType in RelayController._EXTENSION_MESSAGE_TYPES:
+                self.controller._logger.debug("Ignoring client extension message with type %i.", msg.msgType)
+            else:
+                # Send everything else to the game
+                self.controller.commandScheduler.submit(self, msg)
+        
+        # Changes the subscription and resends the data tree
+        def _resubscribe(self, subscription):
+            self._queueCond.acquire()
+            try:
+                if self._closed:
+                    return
+                self.subscription = subscription
+                self._sendQueue.clear()
+                self._queuedBytes = 0
+                self._sendQueue.append(self._RESYNC)
+                self._onDataQueued()
+            finally:
+                self._queueCond.release()
+        
+        # Called when a new local map frame is available
+        def _onLocalMapFrame(self):
+            self._queueCond.acquire()
+            if not self._closed:
+                self._localMapPending = True
+                self._onDataQueued()
+            self._queueCond.release()
+        
+        # Must be called with self._queueCond acquired
+        # Returns (encoded local map frame or None, seconds till the pending frame may be sent or None)
+        # Only the latest frame is sent, frames replaced before they were due are dropped.
+        def _takeLocalMapData(self, now):
+            if not self._localMapPending:
+                return (None, None)
+            fps = self.controller._localMapMaxFps
+            try:
+                requestedFps = float(self.options.get(extensions.OPTION_LOCAL_MAP_FPS, 0))
+            except (TypeError, ValueError):
+                requestedFps = 0
+            if requestedFps > 0:
+                fps = min(fps, requestedFps)
+            if fps <= 0:
+                self._localMapPending = False
+                return (None, None)
+            wait = self._lastLocalMapTime + 1.0 / fps - now
+            if wait > 0:
+                return (None, wait)
+            self._localMapPending = False
+            frame = self.controller._localMapFrame
+            if frame == None:
+                return (None, None)
+            self._lastLocalMapTime = now
+            baseFrame = None
+            if extensions.FEATURE_LOCAL_MAP_DIFF in self.features:
+                baseFrame = self._lastLocalMapFrame
+            self._lastLocalMapFrame = frame
+            return (self.controller._encodeLocalMapFrame(frame, baseFrame), None)
+        
+        def _encodeConnectionAccept(self):
+            if self.datamanager.networkchannel.hostLang:
+                lang = self.datamanager.networkchannel.hostLang
+            else:
+                lang = 'xx'
+            if self.datamanager.networkchannel.hostVersion:
+                version = self.datamanager.networkchannel.hostVersion
+            else:
+                version = '1.1.30.0' # Everything other than a version number crashes the official app
+            # Extension features are offered to PyPipboy clients, other apps ignore them
+            msgtext = ('{"lang":"' + str(lang) + '","version":"' + str(version) + '","pypipboy":' 
+                       + json.dumps(sorted(self.controller.extensionFeatures())) + '}').encode()
+            return encodeMessage(NetworkMessage(eMessageType.CONNECTION_ACCEPTED, len(msgtext), msgtext))
+        
+            
+    # Relay endpoint of the threaded backend (one receiving and one writer thread per endpoint)
+    class _RelayRequestHandler(socketserver.BaseRequestHandler, _RelayEndpoint):
+        RECEIVE_SIZE = 65536
+        
         def handle(self):
-            self.controller = self.server.controller
-            self.datamanager = self.controller.datamanager
+            self._initSendQueue(self.server.controller)
+            self.request.sendall(self._encodeConnectionAccept())
+            # The initial data is exported by the writer thread after the handler has been added,
+            # so no update received in between gets lost
+            self._sendQueue.append(self._RESYNC)
             self.controller.handlers.append(self)
+            self._writerThread = threading.Thread(target=self._writeLoop, daemon=True)
+            self._writerThread.start()
             self.controller._logger.info('Added relay endpoint ' + str(self.client_address))
-            self._sendConnectionAccept()
-            self._sendInitialData()
             self._shutdownHandler = False
             
+            framer = MessageFramer(self.controller.MAX_CLIENT_PAYLOAD_SIZE)
             while not self._shutdownHandler:
-                # First receive message header, should be 5 bytes
-                expected = 5
-                msg_header = bytes()
                 try:
-                    while expected > 0:
-                        tmp = self.request.recv(expected)
-                        if len(tmp) == 0:
-                            raise Exception('Host terminated connection.')
-                        expected -= len(tmp)
-                        msg_header = msg_header + tmp
+                    data = self.request.recv(self.RECEIVE_SIZE)
+                    if len(data) == 0:
+                        raise Exception('Host terminated connection.')
+                    messages = framer.feed(data)
                 except Exception as e:
-                    print('Exception caught: ' + str(e))
+                    self.controller._logger.debug('Receiving from relay endpoint ' + str(self.client_address) + ' failed: ' + str(e))
                     break
-                # Parse header
-                payload_size = struct.unpack("<I",msg_header[0:4])[0]
-                msg_type = struct.unpack("<B",bytes([msg_header[4]]))[0]
-                # Receive payload
-                expected = payload_size
-                payload = bytes()
-                try:
-                    while expected > 0:
-                        tmp = self.request.recv(expected)
-                        if len(tmp) == 0:
-                            raise Exception('Host terminated connection.')
-                        expected -= len(tmp)
-                        payload = payload + tmp
-                except Exception as e:
-                    print('Exception caught: ' + str(e))
-                    break
-                # Send everything that is not a keep-alive message to the game
-                if not msg_type == eMessageType.KEEP_ALIVE:
-                    self.controller._logger.debug("Relaying client message with type %i and size %i.", msg_type, payload_size)
-                    self.datamanager.networkchannel.sendMessage(NetworkMessage(msg_type, payload_size, payload))
+                for msg in messages:
+                    self._onClientMessage(msg)
             try:
                 self.controller.handlers.remove(self)
             except:
                 pass
+            self.controller.commandScheduler.removeEndpoint(self)
+            self._close()
+            self._writerThread.join()
             self.controller._logger.info('Removed relay endpoint ' + str(self.client_address))
+        
+        # Must be called with self._queueCond acquired
+        def _onDataQueued(self):
+            self._queueCond.notify()
+        
+        # Must be called with self._queueCond acquired
+        def _closeLocked(self):
+            if not self._closed:
+                self._closed = True
+                self._sendQueue.clear()
+                self._queuedBytes = 0
+                self._queueCond.notify()
+                # Wakes up the receiving loop and a blocked writer
+                try:
+                    self.request.shutdown(socket.SHUT_RDWR)
+                except OSError:
+                    pass
+        
+        def _writeLoop(self):
+            try:
+                while True:
+                    self._queueCond.acquire()
+                    entries = []
+                    while not self._closed:
+                        entries, batch, wait = self._takeNext(time.time())
+                        if len(entries) > 0:
+                            break
+                        self._queueCond.wait(wait)
+                    if self._closed:
+                        self._queueCond.release()
+                        break
+                    self._queueCond.release()
+                    data = self._encodeEntries(entries, batch)
+                    if data:
+                        self.request.sendall(data)
+            except Exception as e:
+                self.controller._logger.info('Could not send to relay endpoint ' + str(self.client_address) + ': ' + str(e))
+                self._close()
             
-        def _sendConnectionAccept(self):
-            if self.datamanager.networkchannel.hostLang:
-                lang = self.datamanager.networkchannel.hostLang
-            else:
-                lang = 'xx'
-            if self.datamanager.networkchannel.hostVersion:
-                version = self.datamanager.networkchannel.hostVersion
-            else:
-                version = '1.1.30.0' # Everything other than a version number crashes the official app
-            msgtext = ('{"lang":"' + str(lang) + '","version":"' + str(version) + '"}').encode()
-            msg = NetworkMessage(eMessageType.CONNECTION_ACCEPTED, len(msgtext), msgtext)
-            self.datamanager.networkchannel.sendMessage(msg, self.request)
-            
-        def sendKeepAlive(self):
-            self.datamanager.networkchannel.sendMessage(NetworkMessage(eMessageType.KEEP_ALIVE), self.request)
+    # Relay endpoint of the selector backend
+    class _SelectorRelayEndpoint(_RelayEndpoint):
+        def __init__(self, server, sock, client_address):
+            self._initSendQueue(server.controller)
+            self.server = server
+            self.request = sock
+            self.client_address = client_address
+            self._framer = MessageFramer(server.controller.MAX_CLIENT_PAYLOAD_SIZE)
+            # Data currently being written (memoryview) and the written offset
+            self._current = None
+            self._offset = 0
+            self._writeRequested = False
+            self._flushTimer = False
+            self._lastSendTime = time.time()
         
-        def sendMessage(self, msg):
-            self.datamanager.networkchannel.sendMessage(msg, self.request)
-        
-        def _sendInitialData(self):
-            data = self.datamanager.exportData()
-            if len(data) > 0:
-                data.reverse()
-                encoder = DataUpdateEncoder()
-                msgtext = encoder.encode(data)
-                self.datamanager.networkchannel.sendMessage(NetworkMessage(eMessageType.DATA_UPDATE, len(msgtext), msgtext), self.request)
+        # Must be called with self._queueCond acquired
+        def _onDataQueued(self):
+            if not self._writeRequested:
+                self._writeRequested = True
+                self.server._addRequest(('write', self))
+        
+        # Must be called with self._queueCond acquired
+        def _closeLocked(self):
+            if not self._closed:
+                self._closed = True
+                self._sendQueue.clear()
+                self._queuedBytes = 0
+                self.server._addRequest(('close', self))
+        
+        # Writes as much queued data as the socket accepts, must be called from the loop thread
+        # Returns False when the endpoint has been closed
+        def _flush(self):
+            while True:
+                if not self._current:
+                    self._queueCond.acquire()
+                    self._writeRequested = False
+                    if self._closed:
+                        self._queueCond.release()
+                        return False
+                    entries, batch, wait = self._takeNext(time.time())
+                    self._queueCond.release()
+                    if wait != None:
+                        self.server._scheduleFlushTimer(self, wait)
+                    if len(entries) == 0:
+                        return True
+                    data = self._encodeEntries(entries, batch)
+                    if not data:
+                        continue
+                    self._current = memoryview(data)
+                    self._offset = 0
+                try:
+                    sent = self.request.send(self._current[self._offset:])
+                except (BlockingIOError, InterruptedError):
+                    return True
+                except OSError as e:
+                    self.controller._logger.info('Could not send to relay endpoint ' + str(self.client_address) + ': ' + str(e))
+                    return False
+                self._lastSendTime = time.time()
+                self._offset += sent
+                if self._offset < len(self._current):
+                    return True
+                self._current = None
+        
+        # Returns whether data is waiting to be written
+        def _hasPendingData(self):
+            return self._current != None or len(self._sendQueue) > 0
+    
+    # Relay server serving all endpoints from one selector based event loop thread
+    # Keep-alives are only sent to idle endpoints, they and delayed local map frames 
+    # are scheduled with a timer wheel.
+    class _SelectorRelayServer:
+        RECEIVE_SIZE = 65536
+        KEEP_ALIVE_INTERVAL = 1.0
+        TIMER_TICK = 1.0 / 32
+        
+        def __init__(self, controller, addr):
+            self.controller = controller
+            self._logger = controller._logger
+            self._listenSocket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+            self._listenSocket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+            self._listenSocket.bind(addr)
+            self._listenSocket.listen(128)
+            self._listenSocket.setblocking(False)
+            self.server_address = self._listenSocket.getsockname()
+            self._selector = selectors.DefaultSelector()
+            self._selector.register(self._listenSocket, selectors.EVENT_READ, self._listenSocket)
+            self._wakeupReader, self._wakeupWriter = socket.socketpair()
+            self._wakeupReader.setblocking(False)
+            self._wakeupWriter.setblocking(False)
+            self._selector.register(self._wakeupReader, selectors.EVENT_READ, None)
+            self._requests = collections.deque()
+            self._requestLock = threading.Lock()
+            self._endpoints = set()
+            self._timers = _TimerWheel(self.TIMER_TICK, int(2 * self.KEEP_ALIVE_INTERVAL / self.TIMER_TICK) + 1)
+            self._loopFlag = True
+            self._stoppedEvent = threading.Event()
+        
+        def serve_forever(self):
+            try:
+                while self._loopFlag:
+                    for key, mask in self._selector.select(self._timers.timeUntilNextTick()):
+                        if key.data == None:
+                            try:
+                                while self._wakeupReader.recv(4096):
+                                    pass
+                            except BlockingIOError:
+                                pass
+                        elif key.data is self._listenSocket:
+                            self._accept()
+                        else:
+                            self._onSocketEvent(key.data, mask)
+                    self._processRequests()
+                    for timer, endpoint in self._timers.advance():
+                        if endpoint in self._endpoints:
+                            timer(endpoint)
+                for endpoint in list(self._endpoints):
+                    self._closeEndpoint(endpoint)
+                self._selector.close()
+                self._listenSocket.close()
+                self._wakeupReader.close()
+                self._wakeupWriter.close()
+            except:
+                traceback.print_exc(file=sys.stdout)
+                time.sleep(1) # Just to make sure that the error is correctly written into the log file
+                raise
+            finally:
+                self._stoppedEvent.set()
+        
+        def shutdown(self):
+            self._loopFlag = False
+            self._wakeup()
+            self._stoppedEvent.wait()
+        
+        def _wakeup(self):
+            try:
+                self._wakeupWriter.send(b'\x00')
+            except OSError:
+                pass
+        
+        # Requests are coalesced, the loop is only woken up for the first one
+        def _addRequest(self, request):
+            self._requestLock.acquire()
+            wakeup = len(self._requests) == 0
+            self._requests.append(request)
+            self._requestLock.release()
+            if wakeup:
+                self._wakeup()
+        
+        def _processRequests(self):
+            self._requestLock.acquire()
+            requests = self._requests
+            self._requests = collections.deque()
+            self._requestLock.release()
+            for request, endpoint in requests:
+                if not endpoint in self._endpoints:
+                    continue
+                if request == 'close':
+                    self._closeEndpoint(endpoint)
+                elif request == 'write':
+                    self._flush(endpoint)
+        
+        def _accept(self):
+            while True:
+                try:
+                    sock, client_address = self._listenSocket.accept()
+                except (BlockingIOError, InterruptedError):
+                    return
+                except OSError as e:
+                    self._logger.warning('Could not accept relay connection: ' + str(e))
+                    return
+                sock.setblocking(False)
+                endpoint = RelayController._SelectorRelayEndpoint(self, sock, client_address)
+                endpoint._sendQueue.append(endpoint._encodeConnectionAccept())
+                # The initial data is exported when it is written, after the endpoint has been added
+                endpoint._sendQueue.append(endpoint._RESYNC)
+                self._endpoints.add(endpoint)
+                self.controller.handlers.append(endpoint)
+                self._selector.register(sock, selectors.EVENT_READ, endpoint)
+                self._timers.schedule((self._onKeepAliveTimer, endpoint), self.KEEP_ALIVE_INTERVAL)
+                self._logger.info('Added relay endpoint ' + str(client_address))
+                self._flush(endpoint)
+        
+        def _closeEndpoint(self, endpoint):
+            if not endpoint in self._endpoints:
+                return
+            self._endpoints.remove(endpoint)
+            try:
+                self.controller.handlers.remove(endpoint)
+            except ValueError:
+                pass
+            self.controller.commandScheduler.removeEndpoint(endpoint)
+            endpoint._close()
+            try:
+                self._selector.unregister(endpoint.request)
+            except (KeyError, ValueError):
+                pass
+            endpoint.request.close()
+            self._logger.info('Removed relay endpoint ' + str(endpoint.client_address))
+        
+        def _onSocketEvent(self, endpoint, mask):
+            if mask & selectors.EVENT_READ:
+                try:
+                    data = endpoint.request.recv(self.RECEIVE_SIZE)
+                except (BlockingIOError, InterruptedError):
+                    data = None
+                except OSError:
+                    data = bytes()
+                if data != None:
+                    if len(data) == 0:
+                        self._closeEndpoint(endpoint)
+                        return
+                    try:
+                        messages = endpoint._framer.feed(data)
+                    except Exception as e:
+                        self._logger.info('Closing relay endpoint ' + str(endpoint.client_address) + ': ' + str(e))
+                        self._closeEndpoint(endpoint)
+                        return
+                    for msg in messages:
+                        endpoint._onClientMessage(msg)
+            if mask & selectors.EVENT_WRITE:
+                self._flush(endpoint)
+        
+        def _flush(self, endpoint):
+            if not endpoint._flush():
+                self._closeEndpoint(endpoint)
+                return
+            events = selectors.EVENT_READ
+            if endpoint._hasPendingData():
+                events |= selectors.EVENT_WRITE
+            key = self._selector.get_key(endpoint.request)
+            if key.events != events:
+                self._selector.modify(endpoint.request, events, endpoint)
+        
+        def _onKeepAliveTimer(self, endpoint):
+            idle = time.time() - endpoint._lastSendTime
+            if idle >= self.KEEP_ALIVE_INTERVAL:
+                endpoint.sendKeepAlive()
+                idle = 0.0
+            self._timers.schedule((self._onKeepAliveTimer, endpoint), self.KEEP_ALIVE_INTERVAL - idle)
+        
+        # Flushes the endpoint again when a held back local map frame is due
+        def _scheduleFlushTimer(self, endpoint, delay):
+            if not endpoint._flushTimer:
+                endpoint._flushTimer = True
+                self._timers.schedule((self._onFlushTimer, endpoint), delay)
+        
+        def _onFlushTimer(self, endpoint):
+            endpoint._flushTimer = False
+            self._flush(endpoint)
             
             
     
-    def __init__(self, datamanager):
+    # Policies for clients that do not keep up with the updates
+    SLOW_CLIENT_RESYNC = 'resync' # Drop the queued updates and send the whole data tree
+    SLOW_CLIENT_DISCONNECT = 'disconnect'
+    
+    # Relay service backends
+    BACKEND_THREADED = 'thread'
+    BACKEND_SELECTOR = 'selector'
+    
+    # Maximal uncompressed size of a COMPRESSED_BATCH
+    MAX_BATCH_SIZE = 4 * 1024 * 1024
+    
+    # Endpoints only send commands and small extension messages, 
+    # endpoints sending bigger messages are disconnected
+    MAX_CLIENT_PAYLOAD_SIZE = 1024 * 1024
+    
+    DEFAULT_MAX_QUEUE_MESSAGES = 256
+    DEFAULT_MAX_QUEUE_BYTES = 8 * 1024 * 1024
+    
+    _KEEP_ALIVE_DATA = encodeMessage(NetworkMessage(eMessageType.KEEP_ALIVE))
+    
+    _EXTENSION_MESSAGE_TYPES = set(v for k, v in vars(ePyPipboyMessageType).items() if not k.startswith('_'))
+    
+    # Local map frame received from the game
+    class _LocalMapFrame:
+        def __init__(self, seq, payload, data):
+            self.seq = seq
+            self.payload = payload
+            self.data = data
+    
+    # maxQueueMessages, maxQueueBytes: size of the send queue of each relay endpoint
+    # slowClientPolicy: what to do when a send queue is full (SLOW_CLIENT_RESYNC or SLOW_CLIENT_DISCONNECT)
+    def __init__(self, datamanager, maxQueueMessages = DEFAULT_MAX_QUEUE_MESSAGES,
+                 maxQueueBytes = DEFAULT_MAX_QUEUE_BYTES, slowClientPolicy = SLOW_CLIENT_RESYNC):
         self.datamanager = datamanager
+        self.maxQueueMessages = maxQueueMessages
+        self.maxQueueBytes = maxQueueBytes
+        self.slowClientPolicy = slowClientPolicy
         self.autodiscoverThread = None
         self.autodiscoverServer = None
         self.relayServer = None
         self.relayThread = None
         self.handlers = []
+        self._localMapMaxFps = 0
+        self._localMapFrame = None
+        # Frame numbers are never reused, endpoints may still hold frames from before a reset
+        self._localMapSeq = itertools.count()
+        self._localMapDiffs = dict()
+        self._localMapLock = threading.Lock()
+        # Tree structure for subscriptions, only maintained while there are subscribed endpoints
+        self._tree = None
+        self._treeLock = threading.Lock()
+        self._dataTreeCache = dict()
+        # Forwards the commands of the endpoints, see RelayCommandScheduler for rate and burst
+        self.commandScheduler = RelayCommandScheduler(datamanager)
         self._logger = logging.getLogger('pypipboy.relayserver')
-        self.datamanager.networkchannel.registerMessageListener(self._onMessageReceived)
+        self.datamanager.networkchannel.registerMessageListener(self._onChannelMessage)
+        # Data updates are relayed once the data manager has applied them, so an endpoint that
+        # missed an update gets a snapshot that already contains it
+        self.datamanager.registerDataUpdateMessageListener(self._onMessageReceived)
     
     def startAutodiscoverService(self, addr = '', port = 28000):
         if not self.autodiscoverThread:
@@ -151,9 +727,18 @@ class RelayController:
             self.autodiscoverServer = None
             self.autodiscoverThread = None
             
-    def startRelayService(self, addr = '', port = 27000):
+    # backend: BACKEND_THREADED (one thread per endpoint) or BACKEND_SELECTOR (one thread for all endpoints)
+    # Enables the snapshots of the data manager (see PipboyDataManager.enableSnapshots())
+    def startRelayService(self, addr = '', port = 27000, backend = BACKEND_THREADED):
         if not self.relayThread:
-            self.relayServer = self._RelayServer(self, (addr, port), self._RelayRequestHandler)
+            # Initial data is exported from snapshots, they are consistent and can be read from any thread
+            self.datamanager.enableSnapshots()
+            if backend == self.BACKEND_SELECTOR:
+                self.relayServer = self._SelectorRelayServer(self, (addr, port))
+            elif backend == self.BACKEND_THREADED:
+                self.relayServer = self._RelayServer(self, (addr, port), self._RelayRequestHandler)
+            else:
+                raise Exception('Unknown relay backend ' + str(backend))
             self.relayThread = threading.Thread(target=self.relayServer.serve_forever)
             self.relayThread.start()
     
@@ -164,11 +749,152 @@ class RelayController:
             self.relayServer = None
             self.relayThread = None
             self.handlers.clear()
+            self.commandScheduler.stop()
+    
+    # Enables relaying of local map updates, every endpoint gets at most maxFps frames per second
+    # When an endpoint is not ready for the next frame, only the latest frame is kept. PyPipboy
+    # clients may ask for a lower frame rate and for LOCAL_MAP_DIFF messages (see pypipboy.extensions).
+    def enableLocalMapRelay(self, maxFps = 5):
+        self._localMapMaxFps = maxFps
+    
+    def disableLocalMapRelay(self):
+        self._localMapMaxFps = 0
+        self._localMapLock.acquire()
+        self._localMapFrame = None
+        self._localMapDiffs = dict()
+        self._localMapLock.release()
+    
+    # Returns the set of extension features offered to PyPipboy clients
+    def extensionFeatures(self):
+        return set([extensions.FEATURE_LOCAL_MAP_DIFF, extensions.FEATURE_COMPRESSED_BATCH, extensions.FEATURE_SUBSCRIBE])
+    
+    # Lets the data manager use the compressed inter-relay transport when it connects to
+    # another PyPipboy relay, must be called before connecting (end clients of this relay
+    # still get the plain game protocol)
+    def enableRelayChaining(self):
+        self.datamanager.networkchannel.requestedFeatures.add(extensions.FEATURE_COMPRESSED_BATCH)
+        self.datamanager.networkchannel.requestedFeatures.add(extensions.FEATURE_LOCAL_MAP_DIFF)
+    
+    def _onChannelMessage(self, msg):
+        if msg.msgType != eMessageType.DATA_UPDATE:
+            self._onMessageReceived(msg)
     
     def _onMessageReceived(self, msg):
-        if msg.msgType != eMessageType.KEEP_ALIVE and msg.msgType != eMessageType.LOCAL_MAP_UPDATE:
-            for h in self.handlers:
-                h.sendMessage(msg)
+        if msg.msgType == eMessageType.LOCAL_MAP_UPDATE:
+            if self._localMapMaxFps > 0:
+                self._onLocalMapUpdate(msg)
+        elif msg.msgType == eMessageType.COMMAND_RESULT:
+            # Results only go to the endpoint that sent the command
+            try:
+                resp = json.loads(msg.payload.decode('utf-8'))
+            except Exception as e:
+                self._logger.warning('Received bogus COMMAND_RESULT: ' + str(e))
+                return
+            if not self.commandScheduler.handleResult(resp):
+                self._logger.debug('Received COMMAND_RESULT for a request of this relay or an expired request: ' + str(resp.get('id')))
+        elif msg.msgType != eMessageType.KEEP_ALIVE:
+            # Encoded once and shared by all send queues
+            data = encodeMessage(msg)
+            subscriptions = dict()
+            for h in list(self.handlers):
+                if h.subscription != None and msg.msgType == eMessageType.DATA_UPDATE:
+                    subscriptions.setdefault(h.subscription, []).append(h)
+                else:
+                    h.sendData(data)
+            if len(subscriptions) > 0:
+                self._onSubscribedDataUpdate(msg, subscriptions)
+            elif self._tree != None and msg.msgType == eMessageType.DATA_UPDATE:
+                # Nobody is subscribed anymore, the structure is rebuilt when needed
+                self._treeLock.acquire()
+                self._tree = None
+                self._treeLock.release()
+    
+    # Sends the subscribed part of the update to the endpoints, 
+    # re-encoded once per subscription
+    def _onSubscribedDataUpdate(self, msg, subscriptions):
+        records = []
+        DataUpdateParser().parse(msg.payload, records.append)
+        messages = []
+        self._treeLock.acquire()
+        try:
+            tree = self._getTree()
+            tree.applyRecords(records)
+            for subscription, handlers in subscriptions.items():
+                filtered = tree.filterRecords(records, subscription)
+                data = _encodeRecords([(r.id, r.type, r.value) for r in filtered])
+                if data:
+                    messages.append((data, handlers))
+        finally:
+            self._treeLock.release()
+        for data, handlers in messages:
+            for h in handlers:
+                h.sendData(data)
+    
+    # Must be called with self._treeLock acquired
+    def _getTree(self):
+        if self._tree == None:
+            self._tree = RelayTree()
+            snapshot = self.datamanager.snapshot()
+            if snapshot:
+                self._tree.applyRecords([DataUpdateRecord(r[0], r[1], r[2]) for r in snapshot.exportData()])
+        return self._tree
+    
+    # Returns the encoded data tree (reduced to the subscribed subtrees), shared by all 
+    # endpoints with the same subscription that resync while the snapshot stays current
+    def _initialData(self, subscription = None):
+        # Never exported from the live tree, the dispatch thread may be changing it
+        snapshot = self.datamanager.snapshot()
+        if not snapshot:
+            return None
+        self._treeLock.acquire()
+        cached = self._dataTreeCache.get(subscription)
+        self._treeLock.release()
+        if cached and cached[0] == snapshot.version:
+            return cached[1]
+        records = snapshot.exportData()
+        records.reverse()
+        if subscription != None:
+            # Filtered with a structure of this snapshot only, the shared tree may already
+            # contain newer updates and must never go back to an older state
+            records = [DataUpdateRecord(r[0], r[1], r[2]) for r in records]
+            tree = RelayTree()
+            tree.applyRecords(records)
+            records = [(r.id, r.type, r.value) for r in tree.filterRecords(records, subscription)]
+        data = _encodeRecords(records)
+        self._treeLock.acquire()
+        # Only entries of the current snapshot are kept
+        self._dataTreeCache = dict((k, v) for k, v in self._dataTreeCache.items() if v[0] == snapshot.version)
+        self._dataTreeCache[subscription] = (snapshot.version, data)
+        self._treeLock.release()
+        return data
+    
+    def _onLocalMapUpdate(self, msg):
+        self._localMapLock.acquire()
+        self._localMapFrame = self._LocalMapFrame(next(self._localMapSeq), msg.payload, encodeMessage(msg))
+        self._localMapDiffs = dict()
+        self._localMapLock.release()
+        for h in list(self.handlers):
+            h._onLocalMapFrame()
+    
+    # Returns the encoded frame, as diff to baseFrame when possible
+    # Diffs to the latest frame are cached, endpoints that received the same frames share them.
+    def _encodeLocalMapFrame(self, frame, baseFrame):
+        if baseFrame == None or baseFrame.seq >= frame.seq:
+            return frame.data
+        self._localMapLock.acquire()
+        try:
+            data = self._localMapDiffs.get(baseFrame.seq) if frame is self._localMapFrame else None
+            if data == None:
+                payload = extensions.encodeLocalMapDiff(baseFrame.payload, frame.payload)
+                if payload == None or len(payload) >= len(frame.payload):
+                    data = frame.data
+                else:
+                    data = encodeMessage(NetworkMessage(ePyPipboyMessageType.LOCAL_MAP_DIFF, len(payload), payload))
+                if frame is self._localMapFrame:
+                    self._localMapDiffs[baseFrame.seq] = data
+            return data
+        finally:
+            self._localMapLock.release()
     
     
     def join(self):
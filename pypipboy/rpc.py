@@ -0,0 +1,367 @@
+# -*- coding: utf-8 -*-
+
+import json
+import time
+import heapq
+import collections
+import threading
+import logging
+import asyncio
+import concurrent.futures
+from pypipboy.types import eMessageType, eRequestType
+from pypipboy.network import NetworkMessage
+
+
+
+# Round-trip statistics for one request type
+class RpcRequestStats:
+    def __init__(self, reqtype):
+        self.reqtype = reqtype
+        self.sent = 0
+        self.completed = 0
+        self.timeouts = 0
+        self.totalLatency = 0.0
+        self.minLatency = None
+        self.maxLatency = None
+        self.lastLatency = None
+
+    # Returns the mean round-trip time in seconds or None
+    def meanLatency(self):
+        if self.completed > 0:
+            return self.totalLatency / self.completed
+        return None
+
+    def _addLatency(self, latency):
+        self.completed += 1
+        self.totalLatency += latency
+        self.lastLatency = latency
+        if self.minLatency == None or latency < self.minLatency:
+            self.minLatency = latency
+        if self.maxLatency == None or latency > self.maxLatency:
+            self.maxLatency = latency
+
+    def __repr__(self):
+        return ('RpcRequestStats(type=' + _requestTypeName(self.reqtype) + ', sent=' + str(self.sent)
+                + ', completed=' + str(self.completed) + ', timeouts=' + str(self.timeouts)
+                + ', mean=' + str(self.meanLatency()) + ')')
+
+
+
+# Returns the eRequestType name for the given request type
+def _requestTypeName(reqtype):
+    for k, v in vars(eRequestType).items():
+        if v == reqtype and not k.startswith('_'):
+            return k
+    return str(reqtype)
+
+
+
+# Sends RPC requests over a network channel and routes results back to the caller
+# Every request returns a concurrent.futures.Future that receives the result dict.
+# Requests without result are failed with a TimeoutError after their timeout expired,
+# so no entries are kept forever. At most maxInFlight requests can be pending at once.
+class RpcManager:
+
+    DEFAULT_TIMEOUT = 30.0
+    DEFAULT_MAX_IN_FLIGHT = 64
+
+    class _PendingRequest:
+        def __init__(self, reqId, reqtype, future, callback, sendTime, deadline):
+            self.reqId = reqId
+            self.reqtype = reqtype
+            self.future = future
+            self.callback = callback
+            self.sendTime = sendTime
+            self.deadline = deadline
+
+    def __init__(self, networkchannel, timeout = DEFAULT_TIMEOUT, maxInFlight = DEFAULT_MAX_IN_FLIGHT):
+        self.networkchannel = networkchannel
+        self.timeout = timeout
+        self.maxInFlight = maxInFlight
+        # When False, expire() has to be called regularly by the owner
+        self.autoExpire = True
+        self._nextReqId = 0
+        self._pending = dict()
+        self._deadlines = []
+        self._stats = dict()
+        self._cond = threading.Condition()
+        self._expiryThread = None
+        self._logger = logging.getLogger('pypipboy.rpc')
+
+    # Returns a new unique request id
+    def allocateRequestId(self):
+        self._cond.acquire()
+        reqId = self._nextReqId
+        self._nextReqId += 1
+        self._cond.release()
+        return reqId
+
+    # Sends a request and returns a concurrent.futures.Future for the result
+    #    callback: optional function called with the result dict (signature: callback(resp))
+    #    timeout: seconds till the request is failed with a TimeoutError
+    #    block: whether to wait for a free slot when maxInFlight requests are pending
+    def sendRequest(self, reqtype, args = list(), callback = None, timeout = None, block = True):
+        future = concurrent.futures.Future()
+        if timeout == None:
+            timeout = self.timeout
+        self._cond.acquire()
+        try:
+            # Results are dispatched by the dispatch thread, waiting on it would dead-lock
+            if block and not self.networkchannel._isDispatchThread():
+                self._cond.wait_for(lambda: len(self._pending) < self.maxInFlight, timeout)
+            if len(self._pending) >= self.maxInFlight:
+                future.set_exception(Exception('Too many RPC requests in flight'))
+                return future
+            reqId = self._nextReqId
+            self._nextReqId += 1
+            now = time.time()
+            pending = self._PendingRequest(reqId, reqtype, future, callback, now, now + timeout)
+            self._pending[reqId] = pending
+            heapq.heappush(self._deadlines, (pending.deadline, reqId))
+            self._getStats(reqtype).sent += 1
+            self._startExpiryThread()
+            self._cond.notify_all()
+        finally:
+            self._cond.release()
+        req = dict()
+        req['id'] = reqId
+        req['type'] = reqtype
+        req['args'] = list()
+        if args:
+            for arg in args:
+                req['args'].append(arg)
+        msg = json.dumps(req).encode('utf-8')
+        try:
+            self.networkchannel.sendMessage(NetworkMessage(eMessageType.COMMAND, len(msg), msg))
+        except Exception as e:
+            self._fail(reqId, e)
+        return future
+
+    # Like sendRequest, but returns an asyncio future bound to the running event loop
+    def sendRequestAsync(self, reqtype, args = list(), timeout = None):
+        return asyncio.wrap_future(self.sendRequest(reqtype, args, None, timeout, False))
+
+    # Handles a received COMMAND_RESULT
+    # Returns True when the result belonged to a pending request
+    def handleResult(self, resp):
+        self._cond.acquire()
+        try:
+            pending = self._pending.pop(resp.get('id'), None)
+            if pending:
+                self._getStats(pending.reqtype)._addLatency(time.time() - pending.sendTime)
+                self._cond.notify_all()
+        finally:
+            self._cond.release()
+        if not pending:
+            return False
+        if pending.callback:
+            pending.callback(resp)
+        if not pending.future.done():
+            pending.future.set_result(resp)
+        return True
+
+    # Fails all pending requests (e.g. because the connection has been lost)
+    def cancelAll(self, reason = 'Connection lost'):
+        self._cond.acquire()
+        pending = list(self._pending.values())
+        self._pending.clear()
+        self._deadlines = []
+        self._cond.notify_all()
+        self._cond.release()
+        for p in pending:
+            if not p.future.done():
+                p.future.set_exception(ConnectionError(reason))
+
+    # Fails all requests whose timeout expired
+    def expire(self):
+        now = time.time()
+        expired = []
+        self._cond.acquire()
+        while len(self._deadlines) > 0 and self._deadlines[0][0] <= now:
+            deadline, reqId = heapq.heappop(self._deadlines)
+            pending = self._pending.pop(reqId, None)
+            if pending:
+                self._getStats(pending.reqtype).timeouts += 1
+                expired.append(pending)
+        if len(expired) > 0:
+            self._cond.notify_all()
+        self._cond.release()
+        for p in expired:
+            self._logger.debug('RPC request %i timed out.', p.reqId)
+            if not p.future.done():
+                p.future.set_exception(concurrent.futures.TimeoutError('RPC request ' + str(p.reqId) + ' timed out'))
+
+    # Returns the number of pending requests
+    def inFlightCount(self):
+        return len(self._pending)
+
+    # Returns a dict eRequestType -> RpcRequestStats
+    def stats(self):
+        self._cond.acquire()
+        retval = dict(self._stats)
+        self._cond.release()
+        return retval
+
+
+    ######## Internals Begin ##############
+
+    def _getStats(self, reqtype):
+        stats = self._stats.get(reqtype)
+        if not stats:
+            stats = RpcRequestStats(reqtype)
+            self._stats[reqtype] = stats
+        return stats
+
+    def _fail(self, reqId, exception):
+        self._cond.acquire()
+        pending = self._pending.pop(reqId, None)
+        self._cond.notify_all()
+        self._cond.release()
+        if pending and not pending.future.done():
+            pending.future.set_exception(exception)
+
+    # Must be called with self._cond acquired
+    def _startExpiryThread(self):
+        if self.autoExpire and not self._expiryThread:
+            self._expiryThread = threading.Thread(target = self._expiryLoop, daemon = True)
+            self._expiryThread.start()
+
+    def _expiryLoop(self):
+        while True:
+            self._cond.acquire()
+            # Drop heap entries of already completed requests
+            while len(self._deadlines) > 0 and not self._deadlines[0][1] in self._pending:
+                heapq.heappop(self._deadlines)
+            if len(self._deadlines) > 0:
+                self._cond.wait(max(0.0, self._deadlines[0][0] - time.time()))
+            else:
+                self._cond.wait()
+            self._cond.release()
+            self.expire()
+
+
+
+# Sends a sequence of requests whose arguments depend on a changing version value
+# (e.g. the inventory 'Version'). Up to window requests are in flight at once, the
+# arguments of each request are built right before it is sent, so it uses the most
+# recent version. Requests that failed (result 'success' is false) while the version
+# changed in between are retried with the new version.
+class RpcBatch:
+    def __init__(self, rpcmanager, commands, versionFunc = None, window = 1, retries = 1, timeout = None):
+        # commands: list of (reqtype, argsFunc), argsFunc(version) returns the request args
+        self.rpcmanager = rpcmanager
+        self.commands = commands
+        self.versionFunc = versionFunc
+        self.window = max(1, window)
+        self.retries = retries
+        self.timeout = timeout
+        self.future = concurrent.futures.Future()
+        self._results = [None] * len(commands)
+        self._nextIndex = 0
+        self._inFlight = 0
+        self._remaining = len(commands)
+        # (index, retries) of requests to be sent again
+        self._retries = collections.deque()
+        self._draining = False
+        self._lock = threading.Lock()
+
+    # Starts sending and returns a Future receiving the list of results
+    # (one result dict or exception per command, in command order)
+    def start(self):
+        if self._remaining == 0:
+            self.future.set_result([])
+        else:
+            self._drain()
+        return self.future
+
+    def _currentVersion(self):
+        if self.versionFunc:
+            return self.versionFunc()
+        return None
+
+    # Sends requests until the window is full
+    # Futures may complete immediately (e.g. when sending failed) and call back into the batch,
+    # so this is a loop instead of a recursion: nested calls return at once and the loop picks up
+    # the freed slots.
+    def _drain(self):
+        self._lock.acquire()
+        if self._draining:
+            self._lock.release()
+            return
+        self._draining = True
+        try:
+            while True:
+                if len(self._retries) > 0:
+                    index, retries = self._retries.popleft()
+                elif self._inFlight < self.window and self._nextIndex < len(self.commands):
+                    index = self._nextIndex
+                    retries = self.retries
+                    self._nextIndex += 1
+                    self._inFlight += 1
+                else:
+                    break
+                self._lock.release()
+                try:
+                    try:
+                        self._send(index, retries)
+                    except Exception as e:
+                        self._onDone(index, e)
+                except Exception as e:
+                    self._fail(e)
+                    self._lock.acquire()
+                    break
+                self._lock.acquire()
+        finally:
+            self._draining = False
+            self._lock.release()
+
+    def _send(self, index, retries):
+        reqtype, argsFunc = self.commands[index]
+        version = self._currentVersion()
+        args = argsFunc(version)
+        future = self.rpcmanager.sendRequest(reqtype, args, None, self.timeout)
+        future.add_done_callback(lambda f: self._onResult(index, f, version, retries))
+
+    def _onResult(self, index, future, version, retries):
+        try:
+            exception = future.exception()
+            if exception:
+                self._onDone(index, exception)
+                return
+            resp = future.result()
+            if resp.get('success', True) == False and retries > 0:
+                try:
+                    stale = self._currentVersion() != version
+                except Exception:
+                    stale = False
+                if stale:
+                    self._lock.acquire()
+                    self._retries.append((index, retries - 1))
+                    self._lock.release()
+                    self._drain()
+                    return
+            self._onDone(index, resp)
+        except Exception as e:
+            self._fail(e)
+
+    def _onDone(self, index, result):
+        self._lock.acquire()
+        self._results[index] = result
+        self._inFlight -= 1
+        self._remaining -= 1
+        finished = self._remaining == 0
+        self._lock.release()
+        if finished:
+            if not self.future.done():
+                self.future.set_result(self._results)
+        else:
+            self._drain()
+
+    def _fail(self, exception):
+        # Nothing else is sent once the batch failed
+        self._lock.acquire()
+        self._nextIndex = len(self.commands)
+        self._retries.clear()
+        self._lock.release()
+        if not self.future.done():
+            self.future.set_exception(exception)
@@ -0,0 +1,433 @@
+# -*- coding: utf-8 -*-
+
+import socket
+import selectors
+import threading
+import collections
+import json
+import time
+import logging
+import traceback, sys
+import concurrent.futures
+from pypipboy.types import eMessageType
+from pypipboy.network import NetworkChannel, NetworkMessage, MessageFramer, encodeMessage
+from pypipboy.dataparser import DataUpdateParser
+from pypipboy.datamanager import PipboyDataManager
+
+
+
+# DataUpdateParser shared by several data managers
+# Every thread gets its own parser instance, all of them share one key intern table.
+class SharedDataUpdateParser:
+    def __init__(self):
+        self.internTable = dict()
+        self._local = threading.local()
+
+    def parse(self, data, callback):
+        parser = getattr(self._local, 'parser', None)
+        if not parser:
+            parser = DataUpdateParser(self.internTable)
+            self._local.parser = parser
+        parser.parse(data, callback)
+
+
+
+# Network channel of a session, driven by the PipboySessionManager event loop
+class _SessionChannel(NetworkChannel):
+    def __init__(self, session):
+        super().__init__()
+        self._session = session
+        self._closedEvent = threading.Event()
+
+    # Reconnects the session, the connection is established asynchronously
+    # Returns True when the connection attempt has been started
+    def connect(self, addr, port = NetworkChannel.PIPBOYAPP_PORT):
+        if self.isConnected:
+            return False
+        self._session.addr = addr
+        self._session.port = port
+        self._session.manager._requestConnect(self._session)
+        return True
+
+    def cancelConnectionAttempt(self):
+        if not self.isConnected:
+            self._session.manager._requestClose(self._session)
+
+    def disconnect(self):
+        if self.isConnected:
+            self._session.manager._requestClose(self._session)
+
+    def sendMessage(self, msg, socket = None):
+        if socket:
+            super().sendMessage(msg, socket)
+        elif self.isConnected:
+            self._session.manager._queueData(self._session, encodeMessage(msg))
+
+    def join(self):
+        self._closedEvent.wait()
+
+    def _isDispatchThread(self):
+        return self._session.manager._isDispatchThread()
+
+
+
+# One connection managed by a PipboySessionManager
+class PipboySession:
+
+    CONNECTING = 0
+    HANDSHAKE = 1
+    CONNECTED = 2
+    CLOSED = 3
+
+    def __init__(self, manager, addr, port, lazy):
+        self.manager = manager
+        self.addr = addr
+        self.port = port
+        self.state = self.CLOSED
+        self.networkchannel = _SessionChannel(self)
+        self.datamanager = PipboyDataManager(lazy, self.networkchannel, manager.dataParser)
+        # RPC timeouts are checked by the manager loop instead of an extra thread per session
+        self.datamanager.rpc.autoExpire = False
+        self._socket = None
+        self._framer = None
+        self._outbuffer = bytearray()
+        self._outLock = threading.Lock()
+        self._inbox = collections.deque()
+        self._dispatching = False
+        self._readPaused = False
+        self._lastReceiveTime = 0
+        self._lastKeepAliveTime = 0
+
+    def __repr__(self):
+        return 'PipboySession(' + str(self.addr) + ':' + str(self.port) + ')'
+
+
+
+# Drives many Pip-Boy connections from one selector based event loop
+# Messages are dispatched either on the loop thread or, when workers > 0, on a small
+# thread pool (at most one batch per session at a time, so messages stay ordered).
+# Every round each session with pending messages may dispatch at most
+# maxMessagesPerTurn messages, so a busy session cannot starve the others.
+class PipboySessionManager:
+
+    RECEIVE_SIZE = 65536
+    RECEIVE_TIMEOUT = 60
+    MAX_INBOX = 256
+
+    def __init__(self, workers = 0, lazy = False, maxMessagesPerTurn = 8):
+        self.lazy = lazy
+        self.maxMessagesPerTurn = maxMessagesPerTurn
+        self.dataParser = SharedDataUpdateParser()
+        self._sessions = []
+        self._selector = selectors.DefaultSelector()
+        self._wakeupReader, self._wakeupWriter = socket.socketpair()
+        self._wakeupReader.setblocking(False)
+        # The loop wakes itself up as well, it must never block on a full socket buffer
+        self._wakeupWriter.setblocking(False)
+        self._selector.register(self._wakeupReader, selectors.EVENT_READ, None)
+        self._requests = collections.deque()
+        self._requestLock = threading.Lock()
+        self._executor = concurrent.futures.ThreadPoolExecutor(workers) if workers > 0 else None
+        self._loopThread = None
+        self._loopFlag = False
+        # Marks the loop and worker threads while they dispatch messages
+        self._dispatchLocal = threading.local()
+        self._logger = logging.getLogger('pypipboy.sessionmanager')
+
+    # Creates a new session and starts connecting it
+    # Returns the PipboySession, its datamanager can be used like any other PipboyDataManager
+    def addSession(self, addr, port = NetworkChannel.PIPBOYAPP_PORT):
+        session = PipboySession(self, addr, port, self.lazy)
+        self._sessions.append(session)
+        self._requestConnect(session)
+        return session
+
+    # Closes the given session and removes it from the manager
+    def removeSession(self, session):
+        self._requestClose(session)
+        try:
+            self._sessions.remove(session)
+        except:
+            pass
+
+    # Returns a list of all sessions
+    def sessions(self):
+        return list(self._sessions)
+
+    # Starts the event loop thread
+    def start(self):
+        if not self._loopThread:
+            self._loopFlag = True
+            self._loopThread = threading.Thread(target = self._runLoop)
+            self._loopThread.start()
+
+    # Closes all sessions and stops the event loop thread
+    def stop(self):
+        for session in list(self._sessions):
+            self._requestClose(session)
+        self._loopFlag = False
+        self._wakeup()
+        self.join()
+        if self._executor:
+            self._executor.shutdown()
+
+    def join(self):
+        if self._loopThread:
+            self._loopThread.join()
+
+
+    ######## Internals Begin ##############
+
+    # Returns whether the current thread is the loop thread or a worker dispatching messages
+    def _isDispatchThread(self):
+        return threading.current_thread() == self._loopThread or getattr(self._dispatchLocal, 'dispatching', False)
+
+    def _wakeup(self):
+        try:
+            self._wakeupWriter.send(b'\x00')
+        except (BlockingIOError, OSError):
+            pass
+
+    def _addRequest(self, request):
+        self._requestLock.acquire()
+        self._requests.append(request)
+        self._requestLock.release()
+        self._wakeup()
+
+    def _requestConnect(self, session):
+        self._addRequest(('connect', session))
+
+    def _requestClose(self, session):
+        self._addRequest(('close', session))
+
+    def _queueData(self, session, data):
+        session._outLock.acquire()
+        session._outbuffer += data
+        session._outLock.release()
+        self._addRequest(('write', session))
+
+    def _runLoop(self):
+        try:
+            self._logger.debug('Starting session manager loop.')
+            while self._loopFlag:
+                busy = self._dispatchRound()
+                for key, mask in self._selector.select(0 if busy else 1.0):
+                    if key.data == None:
+                        try:
+                            while self._wakeupReader.recv(4096):
+                                pass
+                        except BlockingIOError:
+                            pass
+                    else:
+                        self._onSocketEvent(key.data, mask)
+                self._processRequests()
+                self._checkTimeouts()
+            for session in list(self._sessions):
+                self._closeSession(session)
+            self._logger.debug('Shutting down session manager loop.')
+        except:
+            traceback.print_exc(file=sys.stdout)
+            time.sleep(1) # Just to make sure that the error is correctly written into the log file
+            raise
+
+    def _processRequests(self):
+        self._requestLock.acquire()
+        requests = self._requests
+        self._requests = collections.deque()
+        self._requestLock.release()
+        for request, session in requests:
+            if request == 'connect':
+                self._connectSession(session)
+            elif request == 'close':
+                self._closeSession(session)
+            elif request == 'write' and session.state == PipboySession.CONNECTED:
+                self._updateInterest(session)
+
+    def _connectSession(self, session):
+        if session.state != PipboySession.CLOSED:
+            return
+        sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        sock.setblocking(False)
+        session._socket = sock
+        session._framer = MessageFramer(session.networkchannel.maxPayloadSize)
+        session._outbuffer = bytearray()
+        session._inbox.clear()
+        session._readPaused = False
+        session.networkchannel._closedEvent.clear()
+        session.state = PipboySession.CONNECTING
+        session._lastReceiveTime = time.time()
+        try:
+            sock.connect_ex((session.addr, session.port))
+        except OSError as e:
+            self._logger.info('Could not connect to %s: %s', session, e)
+            session.state = PipboySession.CLOSED
+            sock.close()
+            session.networkchannel._closedEvent.set()
+            return
+        self._selector.register(sock, selectors.EVENT_WRITE, session)
+
+    def _closeSession(self, session, errstatus = 0, errmsg = None):
+        if session.state == PipboySession.CLOSED:
+            return
+        wasConnected = session.state == PipboySession.CONNECTED
+        session.state = PipboySession.CLOSED
+        try:
+            self._selector.unregister(session._socket)
+        except (KeyError, ValueError):
+            pass
+        session._socket.close()
+        session._socket = None
+        if wasConnected:
+            session.networkchannel.isConnected = False
+            session.networkchannel._fireConnectionEvent(False, errstatus, errmsg)
+        session.networkchannel._closedEvent.set()
+
+    def _onSocketEvent(self, session, mask):
+        if session.state == PipboySession.CONNECTING:
+            err = session._socket.getsockopt(socket.SOL_SOCKET, socket.SO_ERROR)
+            if err != 0:
+                self._logger.info('Could not connect to %s: error %i', session, err)
+                self._closeSession(session)
+                return
+            session.state = PipboySession.HANDSHAKE
+            self._selector.modify(session._socket, selectors.EVENT_READ, session)
+            return
+        if mask & selectors.EVENT_READ:
+            try:
+                data = session._socket.recv(self.RECEIVE_SIZE)
+            except (BlockingIOError, InterruptedError):
+                data = None
+            except OSError as e:
+                self._closeSession(session, -2, str(e) + ' (' + str(type(e)) + ')')
+                return
+            if data != None:
+                if len(data) == 0:
+                    self._closeSession(session, -2, 'Host terminated connection.')
+                    return
+                session._lastReceiveTime = time.time()
+                try:
+                    messages = session._framer.feed(data)
+                except Exception as e:
+                    self._closeSession(session, -3, str(e) + ' (' + str(type(e)) + ')')
+                    return
+                for msg in messages:
+                    self._onMessageReceived(session, msg)
+                    if session.state == PipboySession.CLOSED:
+                        return
+        if mask & selectors.EVENT_WRITE and session.state == PipboySession.CONNECTED:
+            self._flush(session)
+
+    def _onMessageReceived(self, session, msg):
+        if session.state == PipboySession.HANDSHAKE:
+            if msg.msgType == eMessageType.CONNECTION_ACCEPTED:
+                resp = json.loads(msg.payload.decode('utf-8'))
+                self._logger.info('Successfully connected to %s.', session)
+                channel = session.networkchannel
+                channel.hostAddr = session.addr
+                channel.hostPort = session.port
+                channel.hostLang = resp['lang']
+                channel.hostVersion = resp['version']
+                session.state = PipboySession.CONNECTED
+                channel._fireConnectionEvent(True, 0, '')
+                channel.isConnected = True
+            else:
+                self._logger.info('Host %s denied connection (message type %i).', session, msg.msgType)
+                self._closeSession(session)
+        elif msg.msgType == eMessageType.KEEP_ALIVE:
+            # Same keep alive strategy as NetworkChannel._receiveMessageLoop
+            self._queueKeepAlive(session)
+        else:
+            session._inbox.append(msg)
+            if session._lastKeepAliveTime + NetworkChannel.KEEP_ALIVE_TIMER < time.time():
+                self._queueKeepAlive(session)
+            if len(session._inbox) >= self.MAX_INBOX and not session._readPaused:
+                # Stop reading till the backlog has been dispatched
+                session._readPaused = True
+                self._updateInterest(session)
+
+    def _queueKeepAlive(self, session):
+        session._lastKeepAliveTime = time.time()
+        session._outLock.acquire()
+        session._outbuffer += encodeMessage(NetworkMessage(eMessageType.KEEP_ALIVE))
+        session._outLock.release()
+        self._flush(session)
+
+    def _flush(self, session):
+        error = None
+        session._outLock.acquire()
+        if len(session._outbuffer) > 0:
+            try:
+                sent = session._socket.send(session._outbuffer)
+                del session._outbuffer[:sent]
+            except (BlockingIOError, InterruptedError):
+                pass
+            except OSError as e:
+                error = e
+        session._outLock.release()
+        if error:
+            self._closeSession(session, -4, str(error) + ' (' + str(type(error)) + ')')
+        else:
+            self._updateInterest(session)
+
+    # Adapts the selector registration to the session state, must be called from the loop thread
+    def _updateInterest(self, session):
+        if session.state != PipboySession.CONNECTED:
+            return
+        events = 0 if session._readPaused else selectors.EVENT_READ
+        if len(session._outbuffer) > 0:
+            events |= selectors.EVENT_WRITE
+        try:
+            key = self._selector.get_key(session._socket)
+        except KeyError:
+            key = None
+        if events == 0:
+            if key:
+                self._selector.unregister(session._socket)
+        elif not key:
+            self._selector.register(session._socket, events, session)
+        elif key.events != events:
+            self._selector.modify(session._socket, events, session)
+
+    def _checkTimeouts(self):
+        now = time.time()
+        for session in self._sessions:
+            session.datamanager.rpc.expire()
+            if (session.state != PipboySession.CLOSED and not session._readPaused
+                    and session._lastReceiveTime + self.RECEIVE_TIMEOUT < now):
+                self._closeSession(session, -2, 'Receive timeout')
+
+    # Dispatches up to maxMessagesPerTurn messages of every session
+    # Returns True when messages are still pending afterwards
+    def _dispatchRound(self):
+        busy = False
+        for session in self._sessions:
+            if len(session._inbox) == 0 or session._dispatching:
+                continue
+            batch = []
+            while len(batch) < self.maxMessagesPerTurn and len(session._inbox) > 0:
+                batch.append(session._inbox.popleft())
+            if self._executor:
+                session._dispatching = True
+                self._executor.submit(self._dispatchBatch, session, batch)
+            else:
+                self._dispatchBatch(session, batch)
+            if len(session._inbox) > 0:
+                busy = True
+            elif session._readPaused:
+                session._readPaused = False
+                self._updateInterest(session)
+        return busy
+
+    def _dispatchBatch(self, session, batch):
+        self._dispatchLocal.dispatching = True
+        try:
+            for msg in batch:
+                if session.state == PipboySession.CONNECTED:
+                    session.networkchannel._fireMessageEvent(msg)
+        except:
+            traceback.print_exc(file=sys.stdout)
+        finally:
+            self._dispatchLocal.dispatching = False
+            if session._dispatching:
+                session._dispatching = False
+                self._wakeup()
@@ -0,0 +1,259 @@
+# -*- coding: utf-8 -*-
+
+import time
+import threading
+import logging
+import numpy
+from pypipboy.datamanager import ePipboyValueType, eValueUpdatedEventType, resolvePipPath
+from pypipboy.types import eValueType
+
+
+
+# Fixed-size ring buffer of (timestamp, value) samples for one data path
+class PipboyTimeSeries:
+
+    # Bytes needed to store one sample (float64 timestamp + float64 value)
+    SAMPLE_SIZE = 16
+
+    def __init__(self, path, capacity):
+        self.path = path
+        self.capacity = capacity
+        self.pipId = None
+        # (container pipId, key, child pipId) for every step of the path, see PipboyTimeSeriesRecorder
+        self._trail = []
+        self._times = numpy.zeros(capacity, dtype = numpy.float64)
+        self._values = numpy.zeros(capacity, dtype = numpy.float64)
+        self._next = 0
+        self._count = 0
+        self._lock = threading.Lock()
+
+    # Appends a sample, overwriting the oldest one when the buffer is full
+    def append(self, timestamp, value):
+        self._lock.acquire()
+        self._times[self._next] = timestamp
+        self._values[self._next] = value
+        self._next = (self._next + 1) % self.capacity
+        if self._count < self.capacity:
+            self._count += 1
+        self._lock.release()
+
+    # Returns the number of stored samples
+    def __len__(self):
+        return self._count
+
+    # Returns the number of bytes allocated by this series
+    def memoryUsage(self):
+        return self.capacity * self.SAMPLE_SIZE
+
+    # Returns the latest sample as (timestamp, value) or None
+    def latest(self):
+        self._lock.acquire()
+        try:
+            if self._count == 0:
+                return None
+            i = (self._next - 1) % self.capacity
+            return (float(self._times[i]), float(self._values[i]))
+        finally:
+            self._lock.release()
+
+    # Returns the samples in chronological order as tuple (times, values) of numpy arrays
+    #    start, end: optional time range (inclusive)
+    def range(self, start = None, end = None):
+        self._lock.acquire()
+        try:
+            if self._count < self.capacity:
+                times = self._times[:self._count].copy()
+                values = self._values[:self._count].copy()
+            else:
+                times = numpy.roll(self._times, -self._next)
+                values = numpy.roll(self._values, -self._next)
+        finally:
+            self._lock.release()
+        first = 0 if start == None else numpy.searchsorted(times, start, 'left')
+        last = len(times) if end == None else numpy.searchsorted(times, end, 'right')
+        return (times[first:last], values[first:last])
+
+    # Aggregates the samples into windows of the given length (in seconds)
+    # Returns a tuple (times, mins, maxs, means) of numpy arrays, one entry for each
+    # non-empty window, times are the window start times.
+    def downsample(self, window, start = None, end = None):
+        if window <= 0:
+            raise Exception('Window length must be positive')
+        times, values = self.range(start, end)
+        if len(times) == 0:
+            empty = numpy.zeros(0, dtype = numpy.float64)
+            return (empty, empty, empty, empty)
+        origin = times[0] if start == None else start
+        bins = numpy.floor((times - origin) / window).astype(numpy.int64)
+        # times are sorted, so each bin is a contiguous run of samples
+        binStarts = numpy.flatnonzero(numpy.concatenate(([True], bins[1:] != bins[:-1])))
+        counts = numpy.diff(numpy.append(binStarts, len(values)))
+        mins = numpy.minimum.reduceat(values, binStarts)
+        maxs = numpy.maximum.reduceat(values, binStarts)
+        means = numpy.add.reduceat(values, binStarts) / counts
+        return (origin + bins[binStarts] * window, mins, maxs, means)
+
+    # Removes all samples
+    def clear(self):
+        self._lock.acquire()
+        self._next = 0
+        self._count = 0
+        self._lock.release()
+
+
+
+# Records numeric Pip-Boy values over time
+# Series are identified by their data path (e.g. 'PlayerInfo/CurrHP') and survive reconnects
+# and save loads. The memory of all series together never exceeds memoryBudget bytes.
+class PipboyTimeSeriesRecorder:
+
+    DEFAULT_CAPACITY = 4096
+    DEFAULT_MEMORY_BUDGET = 32 * 1024 * 1024
+
+    def __init__(self, datamanager, memoryBudget = DEFAULT_MEMORY_BUDGET, defaultCapacity = DEFAULT_CAPACITY):
+        self.datamanager = datamanager
+        self.memoryBudget = memoryBudget
+        self.defaultCapacity = defaultCapacity
+        self._series = dict()
+        self._seriesById = dict()
+        # container pipId -> set of series whose path goes through the container
+        self._seriesByContainer = dict()
+        self._structureChanged = True
+        self._lock = threading.RLock()
+        self._logger = logging.getLogger('pypipboy.timeseries')
+        self.datamanager.registerValueUpdatedListener(self._onValueUpdated)
+        self.datamanager.registerUpdateAppliedListener(self._onUpdateApplied)
+
+    # Starts recording the value at the given path and returns its PipboyTimeSeries
+    # Raises an exception when the memory budget would be exceeded.
+    def track(self, path, capacity = None):
+        path = path.strip('/')
+        self._lock.acquire()
+        try:
+            if path in self._series:
+                return self._series[path]
+            if not capacity:
+                capacity = self.defaultCapacity
+            if self.memoryUsage() + capacity * PipboyTimeSeries.SAMPLE_SIZE > self.memoryBudget:
+                raise Exception('Memory budget exceeded, cannot track ' + path)
+            series = PipboyTimeSeries(path, capacity)
+            self._series[path] = series
+            self._resolveSeries(series)
+            return series
+        finally:
+            self._lock.release()
+
+    # Stops recording the value at the given path
+    def untrack(self, path):
+        path = path.strip('/')
+        self._lock.acquire()
+        series = self._series.pop(path, None)
+        if series:
+            if self._seriesById.get(series.pipId) == series:
+                del self._seriesById[series.pipId]
+            self._setTrail(series, [])
+        self._lock.release()
+
+    # Returns the PipboyTimeSeries for the given path or None
+    def series(self, path):
+        return self._series.get(path.strip('/'))
+
+    # Returns a list of all tracked paths
+    def trackedPaths(self):
+        self._lock.acquire()
+        paths = list(self._series.keys())
+        self._lock.release()
+        return paths
+
+    # Returns the number of bytes allocated by all series
+    def memoryUsage(self):
+        usage = 0
+        self._lock.acquire()
+        for series in self._series.values():
+            usage += series.memoryUsage()
+        self._lock.release()
+        return usage
+
+    # Stops recording, the recorded data stays accessible
+    def close(self):
+        self.datamanager.unregisterValueUpdatedListener(self._onValueUpdated)
+        self.datamanager.unregisterUpdateAppliedListener(self._onUpdateApplied)
+
+
+    ######## Internals Begin ##############
+
+    def _onValueUpdated(self, value, eventtype):
+        self._lock.acquire()
+        try:
+            if value.pipType == ePipboyValueType.PRIMITIVE:
+                series = self._seriesById.get(value.pipId)
+                if series:
+                    self._appendValue(series, value)
+            elif not self._structureChanged:
+                # Values may have moved, resolve paths once the whole update has been applied.
+                # Only needed when a key on a tracked path now refers to another child.
+                for series in self._seriesByContainer.get(value.pipId, ()):
+                    for containerId, key, childId in series._trail:
+                        if containerId != value.pipId:
+                            continue
+                        if key == None or eventtype == eValueUpdatedEventType.NEW:
+                            self._structureChanged = True
+                        else:
+                            child = value.child(key)
+                            if (child.pipId if child else None) != childId:
+                                self._structureChanged = True
+                    if self._structureChanged:
+                        break
+        finally:
+            self._lock.release()
+
+    def _onUpdateApplied(self):
+        self._lock.acquire()
+        try:
+            if self._structureChanged:
+                self._structureChanged = False
+                for series in self._series.values():
+                    self._resolveSeries(series)
+        finally:
+            self._lock.release()
+
+    # Must be called with self._lock acquired
+    def _resolveSeries(self, series):
+        trail = []
+        if self.datamanager.rootObject:
+            value = resolvePipPath(self.datamanager.rootObject, series.path, trail)
+            self._setTrail(series, [(parent.pipId, key, child.pipId if child else None) for parent, key, child in trail])
+        else:
+            value = None
+            # Wait for the root object
+            self._setTrail(series, [(0, None, None)])
+        if value and value.pipType == ePipboyValueType.PRIMITIVE and value.valueType != eValueType.STRING:
+            pipId = value.pipId
+        else:
+            value = None
+            pipId = None
+        if pipId != series.pipId:
+            if self._seriesById.get(series.pipId) == series:
+                del self._seriesById[series.pipId]
+            series.pipId = pipId
+            if value:
+                self._seriesById[pipId] = series
+                self._appendValue(series, value)
+
+    # Must be called with self._lock acquired
+    def _setTrail(self, series, trail):
+        for containerId, key, childId in series._trail:
+            containerSeries = self._seriesByContainer.get(containerId)
+            if containerSeries != None:
+                containerSeries.discard(series)
+                if len(containerSeries) == 0:
+                    del self._seriesByContainer[containerId]
+        series._trail = trail
+        for containerId, key, childId in trail:
+            self._seriesByContainer.setdefault(containerId, set()).add(series)
+
+    def _appendValue(self, series, value):
+        try:
+            series.append(time.time(), float(value.value()))
+        except (TypeError, ValueError):
+            self._logger.debug('Could not record value of ' + series.path)
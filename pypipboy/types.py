@@ -11,6 +11,16 @@ class eMessageType:
     COUNT = 7
 
 
+
+# PyPipboy protocol extensions, only used between PyPipboy peers that negotiated them
+# (see pypipboy.extensions). The game and the official app never see these messages.
+class ePyPipboyMessageType:
+    HELLO = 100
+    LOCAL_MAP_DIFF = 101
+    COMPRESSED_BATCH = 102
+    SUBSCRIBE = 103
+
+
     
 class eValueType:
     BOOL = 0
@@ -0,0 +1,688 @@
+# -*- coding: utf-8 -*-
+
+import socket
+import selectors
+import threading
+import collections
+import heapq
+import json
+import base64
+import hashlib
+import struct
+import ipaddress
+import time
+import logging
+import traceback, sys
+from urllib.parse import urlsplit, parse_qs
+from pypipboy.datamanager import ePipboyValueType
+from pypipboy.relayfilter import subscriptionKey
+
+
+
+# Returns the JSON representation (dict, list or primitive) of a PipboySnapshotValue
+def snapshotValueToJSON(value):
+    if value.pipType == ePipboyValueType.OBJECT:
+        retval = dict()
+        for key, child in zip(value._keys, value._orderedList):
+            retval[key] = snapshotValueToJSON(child)
+        return retval
+    elif value.pipType == ePipboyValueType.ARRAY:
+        return [snapshotValueToJSON(child) for child in value._value]
+    else:
+        return value._value
+
+
+# Compares two versions of a snapshot value and returns a list of (op, path, value) tuples
+# op is 'add', 'replace' or 'remove', path is a tuple of object keys and array indices,
+# value is the new PipboySnapshotValue (None for 'remove'). Applied in order, the operations
+# turn old into new (JSON patch semantics). Subtrees shared by both versions are skipped,
+# so the costs only depend on the number of changed values.
+def diffSnapshotValues(old, new, path = (), ops = None):
+    if ops == None:
+        ops = []
+    if old is new:
+        return ops
+    if old.pipType != new.pipType or old.pipType == ePipboyValueType.PRIMITIVE:
+        if old.pipType != new.pipType or old.valueType != new.valueType or old._value != new._value:
+            ops.append(('replace', path, new))
+    elif old.pipType == ePipboyValueType.OBJECT:
+        for key, child in zip(new._keys, new._orderedList):
+            oldChild = old._value.get(key.lower())
+            if oldChild == None:
+                ops.append(('add', path + (key,), child))
+            else:
+                diffSnapshotValues(oldChild, child, path + (key,), ops)
+        for key in old._keys:
+            if not key.lower() in new._value:
+                ops.append(('remove', path + (key,), None))
+    else:
+        a = old._value
+        b = new._value
+        # Unchanged items at the beginning and the end are matched by id, so inserting or
+        # removing an item does not touch all following items
+        prefix = 0
+        while prefix < len(a) and prefix < len(b) and a[prefix].pipId == b[prefix].pipId:
+            prefix += 1
+        suffix = 0
+        while suffix < len(a) - prefix and suffix < len(b) - prefix and a[-1 - suffix].pipId == b[-1 - suffix].pipId:
+            suffix += 1
+        for i in range(prefix):
+            diffSnapshotValues(a[i], b[i], path + (i,), ops)
+        oldCount = len(a) - prefix - suffix
+        newCount = len(b) - prefix - suffix
+        common = min(oldCount, newCount)
+        for i in range(prefix, prefix + common):
+            diffSnapshotValues(a[i], b[i], path + (i,), ops)
+        for i in range(prefix + oldCount - 1, prefix + common - 1, -1):
+            ops.append(('remove', path + (i,), None))
+        for i in range(prefix + common, prefix + newCount):
+            ops.append(('add', path + (i,), b[i]))
+        for i in range(suffix):
+            diffSnapshotValues(a[len(a) - suffix + i], b[len(b) - suffix + i], path + (len(b) - suffix + i,), ops)
+    return ops
+
+
+
+# Streams the data tree of a data manager as JSON to WebSocket clients (e.g. browser dashboards)
+# Every client gets one snapshot message, followed by patch messages with the changes of each
+# data update (JSON patch operations). Clients may subscribe subtrees and choose a batching window,
+# all clients are served by one selector based event loop thread. Data manager snapshots are
+# enabled by the gateway, patches are computed by comparing consecutive snapshots.
+#
+# Server messages (text frames):
+#     {"type": "snapshot", "version": 12, "data": {...}}
+#     {"type": "patch", "version": 14, "ops": [{"op": "replace", "path": "/PlayerInfo/CurrHP", "value": 250.0}, ...]}
+#     {"type": "error", "message": "..."}
+# Client messages:
+#     {"subscribe": ["PlayerInfo", "Inventory/Version"]}   (null: everything), answered by a new snapshot
+#     {"batch": 250}                                         batching window in milliseconds
+# Both settings can also be given in the URL: ws://host:28080/?subscribe=PlayerInfo,Map&batch=250
+#
+# Browsers let any web page connect to a WebSocket server, so connections with an Origin
+# header are only accepted from allowedOrigins (see __init__), others get a 403.
+class PipboyWebSocketGateway:
+
+    DEFAULT_PORT = 28080
+    DEFAULT_BATCH_INTERVAL = 0.1
+    DEFAULT_MAX_QUEUE_BYTES = 8 * 1024 * 1024
+
+    MAX_REQUEST_SIZE = 16384
+    MAX_MESSAGE_SIZE = 65536
+    RECEIVE_SIZE = 65536
+
+    _WEBSOCKET_GUID = '258EAFA5-E914-47DA-95CA-C5AB0DC85B11'
+    # Frame header with 64-bit length and mask
+    _MAX_FRAME_HEADER_SIZE = 14
+    _OPCODE_CONTINUATION = 0x0
+    _OPCODE_TEXT = 0x1
+    _OPCODE_BINARY = 0x2
+    _OPCODE_CLOSE = 0x8
+    _OPCODE_PING = 0x9
+    _OPCODE_PONG = 0xA
+
+    # Patch operations of one data update for the connections with the same subscription
+    class _PatchChunk:
+        def __init__(self, version, text):
+            self.version = version
+            self.text = text
+            self._frame = None
+
+        # Returns the frame for a patch message containing only this chunk
+        def frame(self):
+            if self._frame == None:
+                self._frame = PipboyWebSocketGateway._encodePatchFrame(self.version, self.text)
+            return self._frame
+
+    class _Connection:
+        def __init__(self, sock, address, batchInterval):
+            self.sock = sock
+            self.address = address
+            self.open = False
+            self.subscription = None
+            self.batchInterval = batchInterval
+            self.resyncCount = 0
+            self._inBuffer = bytearray()
+            self._fragments = None
+            self._outFrames = collections.deque()
+            self._outBytes = 0
+            self._offset = 0
+            self._closeAfterFlush = False
+            self._pending = []
+            self._batchDeadline = None
+
+    # allowedOrigins: list of origins (e.g. 'http://localhost:8000') that may connect, '*' allows every
+    #                 origin. None: only pages of the same host, when it is addressed by IP or as
+    #                 localhost (host names could be rebound to this machine by other sites).
+    #                 Clients without Origin header (non-browser clients) are always accepted.
+    def __init__(self, datamanager, maxQueueBytes = DEFAULT_MAX_QUEUE_BYTES, batchInterval = DEFAULT_BATCH_INTERVAL, allowedOrigins = None):
+        self.datamanager = datamanager
+        self.maxQueueBytes = maxQueueBytes
+        self.batchInterval = batchInterval
+        self.allowedOrigins = allowedOrigins
+        self.serverAddress = None
+        self._thread = None
+        self._connections = set()
+        self._loopFlag = False
+        self._requests = collections.deque()
+        self._requestLock = threading.Lock()
+        # Last snapshot seen by the data manager thread
+        self._lastSnapshot = None
+        self._snapshotLock = threading.Lock()
+        # Last snapshot seen by the loop thread, everything sent to the clients is based on it
+        self._snapshot = None
+        self._snapshotFrames = dict()
+        self._resolvedSubscriptions = dict()
+        self._timers = []
+        self._timerSeq = 0
+        self._logger = logging.getLogger('pypipboy.wsgateway')
+
+    # Accepts WebSocket connections on the given address
+    # Enables the snapshots of the data manager (see PipboyDataManager.enableSnapshots())
+    def startGatewayService(self, addr = '', port = DEFAULT_PORT):
+        if self._thread:
+            return
+        self._listenSocket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self._listenSocket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        self._listenSocket.bind((addr, port))
+        self._listenSocket.listen(128)
+        self._listenSocket.setblocking(False)
+        self.serverAddress = self._listenSocket.getsockname()
+        self._selector = selectors.DefaultSelector()
+        self._selector.register(self._listenSocket, selectors.EVENT_READ, self._listenSocket)
+        self._wakeupReader, self._wakeupWriter = socket.socketpair()
+        self._wakeupReader.setblocking(False)
+        self._wakeupWriter.setblocking(False)
+        self._selector.register(self._wakeupReader, selectors.EVENT_READ, None)
+        self._snapshotLock.acquire()
+        self.datamanager.enableSnapshots()
+        self._lastSnapshot = self.datamanager.snapshot()
+        self._snapshot = self._lastSnapshot
+        self.datamanager.registerUpdateAppliedListener(self._onUpdateApplied)
+        self._snapshotLock.release()
+        self._loopFlag = True
+        self._thread = threading.Thread(target = self._serveForever)
+        self._thread.start()
+
+    def stopGatewayService(self):
+        if self._thread:
+            self.datamanager.unregisterUpdateAppliedListener(self._onUpdateApplied)
+            self._loopFlag = False
+            self._wakeup()
+            self._thread.join()
+            self._thread = None
+
+    # Returns the number of connected WebSocket clients
+    def connectionCount(self):
+        return len(self._connections)
+
+    # Waits till the service has been stopped
+    def join(self):
+        thread = self._thread
+        if thread:
+            thread.join()
+
+
+    ######## Internals Begin ##############
+
+    # Called by the data manager after each data update
+    def _onUpdateApplied(self):
+        self._snapshotLock.acquire()
+        try:
+            snapshot = self.datamanager.snapshot()
+            last = self._lastSnapshot
+            if snapshot == None or snapshot is last:
+                return
+            self._lastSnapshot = snapshot
+            ops = None
+            baseVersion = None
+            if last != None and len(self._connections) > 0:
+                baseVersion = last.version
+                ops = diffSnapshotValues(last.rootObject, snapshot.rootObject)
+        finally:
+            self._snapshotLock.release()
+        self._addRequest(('update', (baseVersion, snapshot, ops)))
+
+    def _wakeup(self):
+        try:
+            self._wakeupWriter.send(b'\x00')
+        except OSError:
+            pass
+
+    # Requests are coalesced, the loop is only woken up for the first one
+    def _addRequest(self, request):
+        self._requestLock.acquire()
+        wakeup = len(self._requests) == 0
+        self._requests.append(request)
+        self._requestLock.release()
+        if wakeup:
+            self._wakeup()
+
+    def _serveForever(self):
+        try:
+            while self._loopFlag:
+                timeout = None
+                if len(self._timers) > 0:
+                    timeout = max(0.0, self._timers[0][0] - time.time())
+                for key, mask in self._selector.select(timeout):
+                    if key.data == None:
+                        try:
+                            while self._wakeupReader.recv(4096):
+                                pass
+                        except BlockingIOError:
+                            pass
+                    elif key.data is self._listenSocket:
+                        self._accept()
+                    else:
+                        self._onSocketEvent(key.data, mask)
+                self._processRequests()
+                now = time.time()
+                while len(self._timers) > 0 and self._timers[0][0] <= now:
+                    deadline, seq, conn = heapq.heappop(self._timers)
+                    if conn in self._connections and conn._batchDeadline == deadline:
+                        self._sendPatches(conn)
+            for conn in list(self._connections):
+                self._closeConnection(conn)
+            self._selector.close()
+            self._listenSocket.close()
+            self._wakeupReader.close()
+            self._wakeupWriter.close()
+        except:
+            traceback.print_exc(file=sys.stdout)
+            time.sleep(1) # Just to make sure that the error is correctly written into the log file
+            raise
+
+    def _processRequests(self):
+        self._requestLock.acquire()
+        requests = self._requests
+        self._requests = collections.deque()
+        self._requestLock.release()
+        for request, args in requests:
+            if request == 'update':
+                self._onUpdate(*args)
+
+    def _accept(self):
+        while True:
+            try:
+                sock, address = self._listenSocket.accept()
+            except (BlockingIOError, InterruptedError):
+                return
+            except OSError as e:
+                self._logger.warning('Could not accept WebSocket connection: ' + str(e))
+                return
+            sock.setblocking(False)
+            conn = self._Connection(sock, address, self.batchInterval)
+            self._connections.add(conn)
+            self._selector.register(sock, selectors.EVENT_READ, conn)
+
+    def _closeConnection(self, conn):
+        if not conn in self._connections:
+            return
+        self._connections.remove(conn)
+        try:
+            self._selector.unregister(conn.sock)
+        except (KeyError, ValueError):
+            pass
+        conn.sock.close()
+        if conn.open:
+            self._logger.info('Removed WebSocket client ' + str(conn.address))
+
+    def _onSocketEvent(self, conn, mask):
+        if mask & selectors.EVENT_READ:
+            try:
+                data = conn.sock.recv(self.RECEIVE_SIZE)
+            except (BlockingIOError, InterruptedError):
+                data = None
+            except OSError:
+                data = bytes()
+            if data != None:
+                if len(data) == 0:
+                    self._closeConnection(conn)
+                    return
+                if not conn._closeAfterFlush:
+                    # Nothing is read anymore from connections that are being closed
+                    conn._inBuffer += data
+                    if conn.open:
+                        self._readFrames(conn)
+                    else:
+                        self._readHandshake(conn)
+                    if not conn in self._connections:
+                        return
+                    if not conn._closeAfterFlush and len(conn._inBuffer) > self.MAX_MESSAGE_SIZE + self._MAX_FRAME_HEADER_SIZE:
+                        self._closeConnection(conn)
+                        return
+        self._flush(conn)
+
+    # Handles the HTTP upgrade request of a new connection
+    def _readHandshake(self, conn):
+        end = conn._inBuffer.find(b'\r\n\r\n')
+        if end < 0:
+            if len(conn._inBuffer) > self.MAX_REQUEST_SIZE:
+                self._closeConnection(conn)
+            return
+        lines = bytes(conn._inBuffer[:end]).decode('latin-1').split('\r\n')
+        del conn._inBuffer[:end + 4]
+        headers = dict()
+        for line in lines[1:]:
+            if ':' in line:
+                name, value = line.split(':', 1)
+                headers[name.strip().lower()] = value.strip()
+        requestLine = lines[0].split(' ')
+        key = headers.get('sec-websocket-key')
+        if len(requestLine) != 3 or requestLine[0] != 'GET' or not key or headers.get('upgrade', '').lower() != 'websocket':
+            self._queueFrame(conn, b'HTTP/1.1 400 Bad Request\r\nConnection: close\r\nContent-Length: 0\r\n\r\n')
+            conn._closeAfterFlush = True
+            return
+        if not self._isOriginAllowed(headers.get('origin'), headers.get('host', '')):
+            self._logger.warning('Rejected WebSocket client ' + str(conn.address) + ' with origin ' + headers.get('origin'))
+            self._queueFrame(conn, b'HTTP/1.1 403 Forbidden\r\nConnection: close\r\nContent-Length: 0\r\n\r\n')
+            conn._closeAfterFlush = True
+            return
+        accept = base64.b64encode(hashlib.sha1((key + self._WEBSOCKET_GUID).encode('latin-1')).digest()).decode('latin-1')
+        self._queueFrame(conn, ('HTTP/1.1 101 Switching Protocols\r\nUpgrade: websocket\r\nConnection: Upgrade\r\n'
+                                'Sec-WebSocket-Accept: ' + accept + '\r\n\r\n').encode('latin-1'))
+        conn.open = True
+        self._logger.info('Added WebSocket client ' + str(conn.address))
+        query = parse_qs(urlsplit(requestLine[1]).query)
+        try:
+            if 'subscribe' in query:
+                conn.subscription = subscriptionKey([p for v in query['subscribe'] for p in v.split(',')])
+            if 'batch' in query:
+                conn.batchInterval = max(0.0, float(query['batch'][-1]) / 1000.0)
+        except ValueError as e:
+            self._sendError(conn, 'Invalid batch parameter: ' + str(e))
+        self._sendSnapshot(conn)
+        if len(conn._inBuffer) > 0:
+            self._readFrames(conn)
+
+    def _isOriginAllowed(self, origin, host):
+        if origin == None:
+            return True
+        if self.allowedOrigins != None:
+            allowed = [o.rstrip('/').lower() for o in self.allowedOrigins]
+            return '*' in allowed or origin.rstrip('/').lower() in allowed
+        try:
+            originHost = urlsplit(origin).hostname
+            hostName = urlsplit('//' + host).hostname
+        except ValueError:
+            return False
+        if not originHost or originHost != hostName:
+            return False
+        if hostName == 'localhost':
+            return True
+        try:
+            ipaddress.ip_address(hostName)
+            return True
+        except ValueError:
+            return False
+
+    # Parses the received WebSocket frames
+    def _readFrames(self, conn):
+        buf = conn._inBuffer
+        while conn in self._connections and not conn._closeAfterFlush:
+            if len(buf) < 2:
+                return
+            opcode = buf[0] & 0x0F
+            fin = buf[0] & 0x80
+            length = buf[1] & 0x7F
+            offset = 2
+            if length == 126:
+                if len(buf) < 4:
+                    return
+                length = struct.unpack_from('>H', buf, 2)[0]
+                offset = 4
+            elif length == 127:
+                if len(buf) < 10:
+                    return
+                length = struct.unpack_from('>Q', buf, 2)[0]
+                offset = 10
+            if not buf[1] & 0x80 or length > self.MAX_MESSAGE_SIZE:
+                # Client frames must be masked
+                self._sendClose(conn, 1002 if length <= self.MAX_MESSAGE_SIZE else 1009)
+                return
+            if len(buf) < offset + 4 + length:
+                return
+            payload = self._unmask(bytes(buf[offset:offset + 4]), bytes(buf[offset + 4:offset + 4 + length]))
+            del buf[:offset + 4 + length]
+            if opcode == self._OPCODE_CLOSE:
+                self._sendClose(conn, 1000)
+            elif opcode == self._OPCODE_PING:
+                self._queueFrame(conn, self._encodeFrame(self._OPCODE_PONG, payload))
+            elif opcode == self._OPCODE_PONG:
+                pass
+            elif opcode == self._OPCODE_CONTINUATION:
+                if conn._fragments == None or sum(len(f) for f in conn._fragments) + len(payload) > self.MAX_MESSAGE_SIZE:
+                    self._sendClose(conn, 1002)
+                    return
+                conn._fragments.append(payload)
+                if fin:
+                    message = b''.join(conn._fragments)
+                    conn._fragments = None
+                    self._onClientMessage(conn, message)
+            elif fin:
+                self._onClientMessage(conn, payload)
+            else:
+                conn._fragments = [payload]
+
+    # Handles a message of a client
+    def _onClientMessage(self, conn, message):
+        try:
+            request = json.loads(message.decode('utf-8'))
+            if type(request) != dict:
+                raise Exception('Expected a JSON object')
+            if 'batch' in request:
+                conn.batchInterval = max(0.0, float(request['batch']) / 1000.0)
+            if 'subscribe' in request:
+                conn.subscription = subscriptionKey(request['subscribe'])
+                conn._pending = []
+                conn._batchDeadline = None
+                self._sendSnapshot(conn)
+        except Exception as e:
+            self._sendError(conn, 'Invalid request: ' + str(e))
+
+    # Called in the loop thread for every new snapshot of the data manager
+    def _onUpdate(self, baseVersion, snapshot, ops):
+        current = self._snapshot
+        self._snapshot = snapshot
+        self._snapshotFrames = dict()
+        self._resolvedSubscriptions = dict()
+        if ops == None or current == None or current.version != baseVersion:
+            for conn in list(self._connections):
+                if conn.open:
+                    self._sendSnapshot(conn)
+            return
+        if len(ops) == 0:
+            return
+        chunks = dict()
+        for conn in list(self._connections):
+            if not conn.open or conn._closeAfterFlush:
+                continue
+            if not conn.subscription in chunks:
+                text = self._encodeOps(ops, conn.subscription)
+                chunks[conn.subscription] = self._PatchChunk(snapshot.version, text) if text else None
+            chunk = chunks[conn.subscription]
+            if chunk:
+                conn._pending.append(chunk)
+                if conn._batchDeadline == None:
+                    if conn.batchInterval <= 0.0:
+                        self._sendPatches(conn)
+                    else:
+                        conn._batchDeadline = time.time() + conn.batchInterval
+                        self._timerSeq += 1
+                        heapq.heappush(self._timers, (conn._batchDeadline, self._timerSeq, conn))
+
+    # Sends the patches collected during the batching window
+    def _sendPatches(self, conn):
+        pending = conn._pending
+        conn._pending = []
+        conn._batchDeadline = None
+        if len(pending) == 1:
+            frame = pending[0].frame()
+        elif len(pending) > 1:
+            frame = self._encodePatchFrame(pending[-1].version, ','.join(c.text for c in pending))
+        else:
+            return
+        self._queueFrame(conn, frame)
+        self._flush(conn)
+
+    def _sendSnapshot(self, conn):
+        if self._snapshot == None:
+            # Sent with the first data update
+            return
+        frame = self._snapshotFrames.get(conn.subscription)
+        if frame == None:
+            resolved = self._resolveSubscription(conn.subscription)
+            root = self._snapshot.rootObject
+            data = snapshotValueToJSON(root) if resolved == None else self._filteredJSON(root, resolved)
+            payload = json.dumps({'type': 'snapshot', 'version': self._snapshot.version, 'data': data}).encode('utf-8')
+            frame = self._encodeFrame(self._OPCODE_TEXT, payload)
+            self._snapshotFrames[conn.subscription] = frame
+        self._queueFrame(conn, frame)
+
+    def _sendError(self, conn, message):
+        payload = json.dumps({'type': 'error', 'message': message}).encode('utf-8')
+        self._queueFrame(conn, self._encodeFrame(self._OPCODE_TEXT, payload))
+
+    def _sendClose(self, conn, code):
+        self._queueFrame(conn, self._encodeFrame(self._OPCODE_CLOSE, struct.pack('>H', code)))
+        conn._closeAfterFlush = True
+
+    # Queues data for sending, a client that does not keep up gets a new snapshot
+    # instead of the queued patches
+    def _queueFrame(self, conn, frame):
+        if conn.open and conn._outBytes + len(frame) > self.maxQueueBytes and len(conn._outFrames) > 1:
+            head = conn._outFrames.popleft() if conn._offset > 0 else None
+            conn._outFrames.clear()
+            conn._outBytes = 0
+            if head != None:
+                conn._outFrames.append(head)
+                conn._outBytes = len(head)
+            else:
+                conn._offset = 0
+            conn._pending = []
+            conn._batchDeadline = None
+            conn.resyncCount += 1
+            self._logger.info('WebSocket client ' + str(conn.address) + ' does not keep up, resyncing.')
+            self._sendSnapshot(conn)
+            return
+        conn._outFrames.append(frame)
+        conn._outBytes += len(frame)
+
+    # Writes as much queued data as the socket accepts
+    def _flush(self, conn):
+        if not conn in self._connections:
+            return
+        while len(conn._outFrames) > 0:
+            frame = conn._outFrames[0]
+            try:
+                sent = conn.sock.send(memoryview(frame)[conn._offset:])
+            except (BlockingIOError, InterruptedError):
+                break
+            except OSError as e:
+                self._logger.info('Could not send to WebSocket client ' + str(conn.address) + ': ' + str(e))
+                self._closeConnection(conn)
+                return
+            conn._offset += sent
+            if conn._offset < len(frame):
+                break
+            conn._outFrames.popleft()
+            conn._outBytes -= len(frame)
+            conn._offset = 0
+        if len(conn._outFrames) == 0 and conn._closeAfterFlush:
+            self._closeConnection(conn)
+            return
+        events = selectors.EVENT_READ
+        if len(conn._outFrames) > 0:
+            events |= selectors.EVENT_WRITE
+        if self._selector.get_key(conn.sock).events != events:
+            self._selector.modify(conn.sock, events, conn)
+
+    # Returns the comma separated JSON patch operations for the given subscription
+    # or an empty string when no operation concerns the subscribed subtrees
+    def _encodeOps(self, ops, subscription):
+        resolved = self._resolveSubscription(subscription)
+        retval = []
+        for op, path, value in ops:
+            if resolved == None:
+                jsonValue = value
+            else:
+                lowerPath = tuple(str(k).lower() for k in path)
+                subpaths = []
+                included = False
+                for p in resolved:
+                    if lowerPath[:len(p)] == p:
+                        included = True
+                        break
+                    elif p[:len(lowerPath)] == lowerPath:
+                        subpaths.append(p[len(lowerPath):])
+                if included or (op == 'remove' and len(subpaths) > 0):
+                    jsonValue = value
+                elif len(subpaths) > 0:
+                    jsonValue = self._filteredJSON(value, subpaths)
+                else:
+                    continue
+            entry = {'op': op, 'path': self._jsonPointer(path)}
+            if value != None:
+                entry['value'] = snapshotValueToJSON(jsonValue) if jsonValue is value else jsonValue
+            retval.append(json.dumps(entry))
+        return ','.join(retval)
+
+    # Truncates the subscribed paths at arrays and primitive values of the current snapshot,
+    # paths leading through an array subscribe the whole array
+    def _resolveSubscription(self, subscription):
+        if subscription == None:
+            return None
+        resolved = self._resolvedSubscriptions.get(subscription)
+        if resolved == None:
+            resolved = set()
+            for path in subscription:
+                value = self._snapshot.rootObject
+                keys = []
+                for k in path:
+                    if value != None and value.pipType != ePipboyValueType.OBJECT:
+                        break
+                    keys.append(k)
+                    if value != None:
+                        value = value._value.get(k)
+                resolved.add(tuple(keys))
+            self._resolvedSubscriptions[subscription] = resolved
+        return resolved
+
+    # Returns the JSON representation of the parts of value that lie on the given relative paths
+    def _filteredJSON(self, value, subpaths):
+        if value.pipType != ePipboyValueType.OBJECT or () in subpaths:
+            return snapshotValueToJSON(value)
+        retval = dict()
+        for key, child in zip(value._keys, value._orderedList):
+            k = key.lower()
+            childpaths = [p[1:] for p in subpaths if p[0] == k]
+            if len(childpaths) > 0:
+                retval[key] = self._filteredJSON(child, childpaths)
+        return retval
+
+    @staticmethod
+    def _jsonPointer(path):
+        return ''.join('/' + str(k).replace('~', '~0').replace('/', '~1') for k in path)
+
+    @staticmethod
+    def _encodePatchFrame(version, text):
+        payload = ('{"type": "patch", "version": ' + str(version) + ', "ops": [' + text + ']}').encode('utf-8')
+        return PipboyWebSocketGateway._encodeFrame(PipboyWebSocketGateway._OPCODE_TEXT, payload)
+
+    @staticmethod
+    def _encodeFrame(opcode, payload):
+        length = len(payload)
+        if length < 126:
+            header = struct.pack('>BB', 0x80 | opcode, length)
+        elif length < 65536:
+            header = struct.pack('>BBH', 0x80 | opcode, 126, length)
+        else:
+            header = struct.pack('>BBQ', 0x80 | opcode, 127, length)
+        return header + payload
+
+    @staticmethod
+    def _unmask(mask, payload):
+        length = len(payload)
+        if length == 0:
+            return payload
+        mask = (mask * (length // 4 + 1))[:length]
+        return (int.from_bytes(payload, 'big') ^ int.from_bytes(mask, 'big')).to_bytes(length, 'big')
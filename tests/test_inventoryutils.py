@@ -0,0 +1,54 @@
+# -*- coding: utf-8 -*-
+
+import unittest
+
+from pypipboy.datamanager import PipboyDataManager
+from pypipboy.inventoryutils import itemFindItemCardInfos, itemFindItemCardInfo, itemFindItemCardInfoValue
+from pypipboy.types import eValueType
+
+
+def _item(values):
+    # One item whose itemCardInfoList entries have the given 'Value' records
+    records = []
+    infos = []
+    pipId = 10
+    for text, valueRecords in values:
+        valueId = valueRecords[-1][0]
+        records += valueRecords
+        records += [(pipId, eValueType.STRING, text),
+                    (pipId + 1, eValueType.OBJECT, [[('text', pipId), ('Value', valueId)], []])]
+        infos.append(pipId + 1)
+        pipId += 2
+    records += [(1, eValueType.ARRAY, infos),
+                (2, eValueType.OBJECT, [[('itemCardInfoList', 1)], []]),
+                (0, eValueType.OBJECT, [[('item', 2)], []])]
+    dm = PipboyDataManager()
+    dm.importData(records)
+    return dm.getPipValueById(2)
+
+
+class ItemCardInfoTest(unittest.TestCase):
+
+    def test_primitive_values(self):
+        item = _item([('$wt', [(100, eValueType.FLOAT, 1.5)]), ('$val', [(101, eValueType.FLOAT, 1.5)])])
+        self.assertEqual(len(itemFindItemCardInfos(item, 1.5, 'Value')), 2)
+        self.assertEqual(itemFindItemCardInfoValue(item, 1.5, 'Value', 'text'), '$wt')
+        self.assertEqual(itemFindItemCardInfoValue(item, '$val'), 1.5)
+        self.assertEqual(itemFindItemCardInfos(item, [1.5], 'Value'), [])
+        self.assertEqual(itemFindItemCardInfoValue(item, [1.5], 'Value', 'text'), None)
+
+    def test_object_and_array_values(self):
+        item = _item([('$wt', [(100, eValueType.FLOAT, 1.5)]),
+                      ('$dmg', [(102, eValueType.FLOAT, 10.0), (103, eValueType.OBJECT, [[('damage', 102)], []])]),
+                      ('$rng', [(104, eValueType.FLOAT, 2.0), (105, eValueType.ARRAY, [104])])])
+        damage = item.datamanager.getPipValueById(103).value()
+        ranges = item.datamanager.getPipValueById(105).value()
+        self.assertEqual(itemFindItemCardInfoValue(item, 1.5, 'Value', 'text'), '$wt')
+        self.assertEqual(itemFindItemCardInfoValue(item, damage, 'Value', 'text'), '$dmg')
+        self.assertEqual(itemFindItemCardInfo(item, ranges, 'Value').child('text').value(), '$rng')
+        self.assertEqual(itemFindItemCardInfos(item, [], 'Value'), [])
+        self.assertEqual(itemFindItemCardInfoValue(item, '$dmg'), damage)
+
+
+if __name__ == '__main__':
+    unittest.main()
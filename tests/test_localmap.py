@@ -0,0 +1,143 @@
+# -*- coding: utf-8 -*-
+
+import shutil
+import tempfile
+import threading
+import time
+import unittest
+
+from pypipboy.dataparser import LocalMapUpdate
+from pypipboy.localmap import LocalMapPipeline, LocalMapMosaic, LocalMapImage, numpy
+
+
+class _DataManager:
+    def registerLocalMapListener(self, listener):
+        pass
+
+    def unregisterLocalMapListener(self, listener):
+        pass
+
+    def getPipValueByPath(self, path):
+        return None
+
+
+def _frame(value):
+    return LocalMapUpdate(4, 4, (0.0, 0.0), (4.0, 0.0), (0.0, -4.0), bytes([value]) * 16)
+
+
+class LocalMapPipelineTest(unittest.TestCase):
+
+    def setUp(self):
+        self.pipeline = LocalMapPipeline(_DataManager(), workers = 2, cacheSize = 0, encodePng = False)
+
+    def tearDown(self):
+        self.pipeline.close()
+
+    # Delays processing of the given frames until the returned events are set
+    def _holdFrames(self, seqs):
+        events = dict((seq, threading.Event()) for seq in seqs)
+        process = self.pipeline._process
+        def holdingProcess(seq, lmap, worldspace):
+            if seq in events:
+                events[seq].wait(5.0)
+            return process(seq, lmap, worldspace)
+        self.pipeline._process = holdingProcess
+        return events
+
+    def test_workers_finishing_out_of_order(self):
+        events = self._holdFrames([1])
+        delivered = []
+        self.pipeline.registerImageListener(lambda image: delivered.append(image.seq))
+        self.pipeline.submit(_frame(1))
+        self.pipeline.submit(_frame(2))
+        # Frame 2 is delivered by the second worker while the first one is still busy
+        deadline = time.time() + 5.0
+        while not delivered and time.time() < deadline:
+            time.sleep(0.01)
+        events[1].set()
+        self.pipeline.close()
+        self.assertEqual(delivered, [2])
+        self.assertEqual(self.pipeline.droppedCount, 1)
+
+    def test_frames_overtaking_a_running_listener(self):
+        listenerEntered = threading.Event()
+        listenerRelease = threading.Event()
+        delivered = []
+        def listener(image):
+            delivered.append(image.seq)
+            if image.seq == 1:
+                listenerEntered.set()
+                listenerRelease.wait(5.0)
+        self.pipeline.registerImageListener(listener)
+        self.pipeline.submit(_frame(1))
+        self.assertTrue(listenerEntered.wait(5.0))
+        # While frame 1 is being delivered, frames 2 and 3 are processed by the other worker
+        self.pipeline.submit(_frame(2))
+        self.pipeline.submit(_frame(3))
+        deadline = time.time() + 5.0
+        while self.pipeline._deliveredSeq < 3 and time.time() < deadline:
+            time.sleep(0.01)
+        self.assertEqual(delivered, [1])
+        listenerRelease.set()
+        self.pipeline.close()
+        self.assertEqual(delivered, [1, 3])
+
+    def test_delivery_is_ordered_under_load(self):
+        delivered = []
+        def listener(image):
+            delivered.append(image.seq)
+            time.sleep(0.001)
+        self.pipeline.registerImageListener(listener)
+        for i in range(200):
+            self.pipeline.submit(_frame(i % 7))
+        deadline = time.time() + 5.0
+        while self.pipeline._busy and time.time() < deadline:
+            time.sleep(0.01)
+        self.pipeline.close()
+        self.assertEqual(delivered, sorted(set(delivered)))
+        self.assertEqual(delivered[-1], 200)
+
+
+
+@unittest.skipIf(numpy == None, 'LocalMapMosaic requires numpy')
+class LocalMapMosaicTest(unittest.TestCase):
+
+    def setUp(self):
+        self.cacheDir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.cacheDir)
+
+    # Frame of size x size pixels with the given value, nw corner at (x, y), 8 world units per pixel
+    def _image(self, x, y, size, value, worldspace):
+        span = size * 8.0
+        return LocalMapImage(0, size, size, (x, y), (x + span, y), (x, y - span), bytes([value]) * (size * size), None, worldspace)
+
+    def _region(self, mosaic, x, y, size, worldspace = None):
+        image = mosaic.getRegion(x, y, x + size * 8.0, y - size * 8.0, size, size, worldspace)
+        return set(image.pixels)
+
+    def test_worldspaces_have_separate_tiles(self):
+        mosaic = LocalMapMosaic(cacheDir = self.cacheDir)
+        mosaic.addFrame(self._image(0.0, 0.0, 64, 10, 'Commonwealth'))
+        mosaic.addFrame(self._image(0.0, 0.0, 64, 20, 'Commonwealth/Vault 111'))
+        self.assertEqual(mosaic.worldspace, 'Commonwealth/Vault 111')
+        self.assertEqual(self._region(mosaic, 0.0, 0.0, 64), set([20]))
+        self.assertEqual(self._region(mosaic, 0.0, 0.0, 64, 'Commonwealth'), set([10]))
+        mosaic.close()
+        # Both worldspaces are persisted separately
+        mosaic = LocalMapMosaic(cacheDir = self.cacheDir)
+        self.assertEqual(self._region(mosaic, 0.0, 0.0, 64, 'Commonwealth'), set([10]))
+        self.assertEqual(self._region(mosaic, 0.0, 0.0, 64, 'Commonwealth/Vault 111'), set([20]))
+
+    def test_frame_covering_more_than_max_tiles(self):
+        size = LocalMapMosaic.TILE_SIZE * 3
+        mosaic = LocalMapMosaic(maxTiles = 2, cacheDir = self.cacheDir)
+        mosaic.addFrame(self._image(0.0, 0.0, size, 30, ''))
+        self.assertEqual(mosaic.tileCount(), 2)
+        self.assertEqual(mosaic.coverage(0.0, 0.0, size * 8.0, -size * 8.0), 1.0)
+        self.assertEqual(self._region(mosaic, 0.0, 0.0, size), set([30]))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,34 @@
+# -*- coding: utf-8 -*-
+
+import struct
+import unittest
+
+from pypipboy.network import MessageFramer, NetworkMessage, encodeMessage
+from pypipboy.types import eMessageType
+
+
+class MessageFramerTest(unittest.TestCase):
+
+    def test_messages_split_across_chunks(self):
+        data = (encodeMessage(NetworkMessage(eMessageType.DATA_UPDATE, 3, b'abc'))
+                + encodeMessage(NetworkMessage(eMessageType.KEEP_ALIVE))
+                + encodeMessage(NetworkMessage(eMessageType.COMMAND_RESULT, 2, b'{}')))
+        framer = MessageFramer()
+        messages = []
+        for i in range(len(data)):
+            messages += framer.feed(data[i:i + 1])
+        self.assertEqual([(m.msgType, m.payload) for m in messages],
+                         [(eMessageType.DATA_UPDATE, b'abc'), (eMessageType.KEEP_ALIVE, b''), (eMessageType.COMMAND_RESULT, b'{}')])
+        self.assertEqual(framer.pendingBytes(), 0)
+
+    def test_oversized_payload_is_refused(self):
+        framer = MessageFramer(maxPayloadSize = 16)
+        self.assertEqual(len(framer.feed(encodeMessage(NetworkMessage(eMessageType.DATA_UPDATE, 16, b'x' * 16)))), 1)
+        # Refused as soon as the header is known, nothing of the payload is buffered
+        with self.assertRaises(Exception):
+            framer.feed(struct.pack('<IB', 17, eMessageType.DATA_UPDATE))
+        self.assertEqual(framer.pendingBytes(), 0)
+
+
+if __name__ == '__main__':
+    unittest.main()